@@ -0,0 +1,499 @@
+"""
+Benchmarks the stages of the getter and loader scripts against synthetic,
+local stand-ins of the source and energy databases, and reports rows/sec and
+MB/sec per stage so that runs before and after a change can be compared.
+
+The ION and Metasys databases are stood in for by a SQLite file holding
+Source, Quantity, DataLog2, tblPoint and tblActualValueFloat. The energy
+database is a scratch schema (BENCH_SCHEMA) in a local Postgres reached
+through an ODBC DSN; loader stages are skipped if no DSN is given.
+"""
+
+import collections
+import datafile
+import datetime
+import getopt
+import ion_get_data
+import jci_get_data
+import json
+import load_data_files
+import os
+import pyodbc
+import random
+import re
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+import util
+
+# Getter script of each source database.
+SOURCES = {"ion": ion_get_data, "jci": jci_get_data}
+
+# Postgres schema the energy database stand-in is (re)built in.
+BENCH_SCHEMA = "energydb_bench"
+
+# First reading timestamp of the synthetic meters.
+BENCH_START = datetime.datetime(2015, 1, 1)
+
+# Rows of the small lookup tables of the energy database stand-in.
+LOOKUP_ROWS = {
+    ("unit", "old_unit"): ["kW", "kWh", "gal", "cu ft", "btu"],
+    ("commodity", "name"): ["Electricity", "Gas", "Water"],
+    ("source_system", "name"): ["ION", "JCI"],
+    ("reading_type", "name"): ["Totalization", "Interval"],
+}
+
+PG_SCHEMA_SQL = [
+    "CREATE SCHEMA IF NOT EXISTS %s" % (BENCH_SCHEMA),
+    "SET search_path TO %s" % (BENCH_SCHEMA),
+    """DROP TABLE IF EXISTS meter_value_daily, meter_value_hourly,
+        meter_value, meter, unit, commodity, source_system, reading_type
+        CASCADE""",
+    "CREATE TABLE unit (id SERIAL PRIMARY KEY, old_unit TEXT)",
+    "CREATE TABLE commodity (id SERIAL PRIMARY KEY, name TEXT)",
+    "CREATE TABLE source_system (id SERIAL PRIMARY KEY, name TEXT)",
+    "CREATE TABLE reading_type (id SERIAL PRIMARY KEY, name TEXT)",
+    """CREATE TABLE meter
+    (
+        id                  SERIAL PRIMARY KEY,
+        description         TEXT,
+        unit_id             INTEGER REFERENCES unit,
+        commodity_id        INTEGER REFERENCES commodity,
+        source_system_id    INTEGER REFERENCES source_system,
+        reading_type_id     INTEGER REFERENCES reading_type
+    )""",
+    """CREATE TABLE meter_value
+    (
+        meter_id            INTEGER REFERENCES meter,
+        time_stamp_utc      TIMESTAMP,
+        reading             NUMERIC,
+        UNIQUE (meter_id, time_stamp_utc)
+    )""",
+]
+
+SOURCE_SCHEMA_SQL = [
+    "CREATE TABLE Source (ID INTEGER PRIMARY KEY, Name TEXT)",
+    "CREATE TABLE Quantity (ID INTEGER PRIMARY KEY, Name TEXT)",
+    """CREATE TABLE DataLog2 (SourceID INTEGER, QuantityID INTEGER,
+        TimestampUTC TIMESTAMP, Value REAL)""",
+    "CREATE TABLE tblPoint (PointID INTEGER PRIMARY KEY, PointName TEXT)",
+    """CREATE TABLE tblActualValueFloat (PointSliceID INTEGER,
+        UTCDateTime TIMESTAMP, ActualValue REAL)""",
+]
+
+SOURCE_INDEX_SQL = [
+    "CREATE INDEX ix_datalog2 ON DataLog2 (SourceID, QuantityID, TimestampUTC)",
+    """CREATE INDEX ix_actual_value
+        ON tblActualValueFloat (PointSliceID, UTCDateTime)""",
+]
+
+# Meters per query of the batched extract stage.
+BENCH_BATCH = 50
+
+# T-SQL the getters use that SQLite does not understand.
+TOP_RE = re.compile(r"SELECT\s+TOP\s+(\d+)\s", re.IGNORECASE)
+CAST_RE = re.compile(r"CAST\(('[^']*')\s+AS\s+datetime2?\)", re.IGNORECASE)
+
+class SourceCursor(object):
+    """
+    Wraps a cursor on SQLite connection CNXN so that the getter functions can
+    use it like a pyodbc cursor on the ION or Metasys database: T-SQL is
+    translated, rows from fetchone()/fetchall() allow attribute access and
+    errors are raised as pyodbc.Error. fetchmany() returns plain tuples,
+    which is all the readings path needs.
+    """
+
+    def __init__(self, cnxn):
+        self.cursor = cnxn.cursor()
+        self.row = tuple
+
+    def execute(self, sql, *params):
+        match = TOP_RE.search(sql)
+        if match:
+            sql = TOP_RE.sub("SELECT ", sql) + " LIMIT %s" % (match.group(1))
+        sql = CAST_RE.sub(r"\1", sql)
+        try:
+            self.cursor.execute(sql, params)
+        except sqlite3.Error, sqlite_err:
+            raise pyodbc.Error(str(sqlite_err))
+        if self.cursor.description:
+            self.row = collections.namedtuple("Row",
+                [d[0] for d in self.cursor.description])
+        return self
+
+    def fetchone(self):
+        row = self.cursor.fetchone()
+        return row and self.row(*row)
+
+    def fetchall(self):
+        return [self.row(*row) for row in self.cursor.fetchall()]
+
+    def fetchmany(self, size):
+        return self.cursor.fetchmany(size)
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+    def close(self):
+        self.cursor.close()
+
+class Quiet(object):
+    """
+    Context manager that discards what the getter and loader functions
+    print, so that terminal output is not part of the timings.
+    """
+
+    def write(self, text):
+        pass
+
+    def __enter__(self):
+        self.stdout = sys.stdout
+        sys.stdout = self
+        return self
+
+    def __exit__(self, *exc_info):
+        sys.stdout = self.stdout
+
+def build_source(path, meters, days, interval, seed):
+    """
+    Build the SQLite source stand-in at PATH with METERS ION meters and as
+    many JCI meters, each with a reading every INTERVAL minutes for DAYS days.
+    Odd meters are totalizers, even meters interval meters. Random values
+    come from seed SEED. Returns {'ion': meter_list, 'jci': meter_list} in
+    the form the getters read from their info files.
+    """
+    rand = random.Random(seed)
+    end = BENCH_START + datetime.timedelta(days=days)
+    stamps = [BENCH_START + datetime.timedelta(minutes=m)
+        for m in xrange(0, days * 24 * 60, interval)]
+
+    cnxn = sqlite3.connect(path)
+    for sql in SOURCE_SCHEMA_SQL:
+        cnxn.execute(sql)
+    cnxn.executemany("INSERT INTO Quantity VALUES (?, ?)",
+        [(1, "Real Energy"), (2, "Real Power")])
+    meter_lists = {"ion": [], "jci": []}
+    for m in xrange(1, meters + 1):
+        name = "Bench meter %d" % (m)
+        cnxn.execute("INSERT INTO Source VALUES (?, ?)", (m, name))
+        cnxn.execute("INSERT INTO tblPoint VALUES (?, ?)", (m, name))
+        total = 0.0
+        values = []
+        for i in xrange(len(stamps)):
+            step = rand.uniform(0.0, 10.0)
+            total += step
+            values.append(total if m % 2 else step)
+        quantity_id = 1 if m % 2 else 2
+        cnxn.executemany("INSERT INTO DataLog2 VALUES (?, ?, ?, ?)",
+            [(m, quantity_id, s, v) for s, v in zip(stamps, values)])
+        cnxn.executemany("INSERT INTO tblActualValueFloat VALUES (?, ?, ?)",
+            [(m, s, v) for s, v in zip(stamps, values)])
+        meter_lists["ion"].append([str(m), str(quantity_id),
+            str(BENCH_START.date()), str(end.date())])
+        meter_lists["jci"].append([str(m), str(BENCH_START.date()),
+            str(end.date()), "kWh"])
+    for sql in SOURCE_INDEX_SQL:
+        cnxn.execute(sql)
+    cnxn.commit()
+    cnxn.close()
+    return meter_lists
+
+def record(results, stage, seconds, rows, nbytes):
+    """
+    Add the timing of stage STAGE, which took SECONDS for ROWS rows and
+    NBYTES bytes, to RESULTS, adding to earlier timings of the same stage.
+    """
+    if stage not in results:
+        results[stage] = {"seconds": 0.0, "rows": 0, "bytes": 0}
+    results[stage]["seconds"] += seconds
+    results[stage]["rows"] += rows
+    results[stage]["bytes"] += nbytes
+
+def bench_source(source, meter_list, my_cursor, fmt, window, work_dir,
+        results):
+    """
+    Time the getter stages of database SOURCE over METER_LIST using cursor
+    MY_CURSOR, writing data files in format FMT to WORK_DIR and querying
+    readings in WINDOW-long windows. Timings are added to RESULTS. Returns
+    the paths of the data files written.
+    """
+    getter = SOURCES[source]
+    with Quiet():
+        started = time.time()
+        catalog = getter.get_catalog(meter_list, my_cursor)
+        record(results, "%s metadata lookup (catalog)" % (source),
+            time.time() - started, len(meter_list), 0)
+        started = time.time()
+        headers = [getter.describe(row, my_cursor) for row in meter_list]
+        record(results, "%s metadata lookup (per meter)" % (source),
+            time.time() - started, len(meter_list), 0)
+
+    data_files = []
+    for mtr_row, header in zip(meter_list, headers):
+        start, end = getter.get_range(mtr_row)
+        query = getter.readings_query(mtr_row, my_cursor)
+        started = time.time()
+        batches = []
+        with Quiet():
+            for lo, hi, op in util.split_windows(start, end, window):
+                query(lo, hi, op)
+                batches.extend(datafile.ReadingBuffer(rows)
+                    for rows in util.fetch_batches(my_cursor))
+        rows = sum(len(batch) for batch in batches)
+        fetch_time = time.time() - started
+
+        started = time.time()
+        tracker = datafile.ReadingTypeTracker()
+        for batch in batches:
+            tracker.update(batch.readings())
+        type_time = time.time() - started
+
+        output_path = os.path.join(work_dir, "%s_%s%s"
+            % (source.upper(), mtr_row[0], datafile.FORMATS[fmt]))
+        started = time.time()
+        with datafile.BodyWriter(datafile.body_path(output_path), fmt) as w:
+            for batch in batches:
+                w.write_batch(batch)
+        datafile.assemble(output_path, header + [tracker.reading_type()])
+        write_time = time.time() - started
+        nbytes = os.path.getsize(output_path)
+
+        record(results, "%s readings fetch" % (source), fetch_time, rows,
+            nbytes)
+        record(results, "%s reading type detection" % (source), type_time,
+            rows, nbytes)
+        record(results, "%s %s write" % (source, fmt), write_time, rows,
+            nbytes)
+
+        # The same extraction end to end, with fetching and writing
+        # overlapped as extract() does it.
+        pipelined_path = output_path + ".pipelined"
+        started = time.time()
+        with Quiet():
+            with datafile.BodyWriter(pipelined_path, fmt) as w:
+                datafile.write_readings(w, my_cursor,
+                    util.split_windows(start, end, window), query,
+                    datafile.ReadingTypeTracker())
+        record(results, "%s extract (pipelined)" % (source),
+            time.time() - started, rows, nbytes)
+        os.remove(pipelined_path)
+        data_files.append(output_path)
+
+    # All meters again, extracted with one query per group of meters that
+    # share a date range (see the getters' extract_group()).
+    batched_dir = os.path.join(work_dir, "batched_%s" % (source))
+    os.mkdir(batched_dir)
+    output_path = util.DATA_OUTPUT_FILE_PATH
+    util.DATA_OUTPUT_FILE_PATH = batched_dir + os.sep
+    started = time.time()
+    try:
+        with Quiet():
+            for group in util.batch_groups(meter_list, BENCH_BATCH,
+                    getter.group_key):
+                getter.extract_group(group, my_cursor, window=window,
+                    catalog=catalog, fmt=fmt)
+    finally:
+        util.DATA_OUTPUT_FILE_PATH = output_path
+    seconds = time.time() - started
+    nbytes = 0
+    for name in os.listdir(batched_dir):
+        nbytes += os.path.getsize(os.path.join(batched_dir, name))
+    record(results, "%s extract (batched)" % (source), seconds,
+        results["%s extract (pipelined)" % (source)]["rows"], nbytes)
+    shutil.rmtree(batched_dir)
+    return data_files
+
+def bench_loader(data_files, mycursor, results):
+    """
+    Time each loader step over DATA_FILES using cursor MYCURSOR on the
+    energy database stand-in. Timings are added to RESULTS. The server-side
+    COPY steps are only timed for csv files, and need the Postgres server to
+    be able to read them.
+    """
+    for data_file in data_files:
+        rows = sum(1 for r in datafile.read_readings(data_file))
+        nbytes = os.path.getsize(data_file)
+        header = datafile.read_header(data_file)
+        with Quiet():
+            started = time.time()
+            meter_id = load_data_files.register_meter(header, mycursor)
+            record(results, "load register_meter", time.time() - started,
+                1, 0)
+
+            if datafile.file_format(data_file) == "csv":
+                tbl = "tmp_%d" % (meter_id)
+                epoch = datafile.epoch_stamps(data_file)
+                for stage, step in [
+                        ("create_temp_table", lambda:
+                            load_data_files.create_temp_table(tbl, mycursor,
+                                epoch)),
+                        ("copy_data", lambda:
+                            load_data_files.copy_data(data_file, tbl,
+                                mycursor)),
+                        ("convert_epoch", lambda: not epoch or
+                            load_data_files.convert_epoch(tbl, mycursor)),
+                        ("add_id_col", lambda:
+                            load_data_files.add_id_col(meter_id, tbl,
+                                mycursor)),
+                        ("insert_table", lambda:
+                            load_data_files.insert_table(tbl, mycursor)),
+                        ("commit", mycursor.commit)]:
+                    started = time.time()
+                    step()
+                    record(results, "load %s" % (stage),
+                        time.time() - started, rows, nbytes)
+
+            meter_id = load_data_files.register_meter(header, mycursor)
+            started = time.time()
+            load_data_files.stream_values(meter_id, data_file, mycursor)
+            mycursor.commit()
+            record(results, "load stream_values", time.time() - started,
+                rows, nbytes)
+
+            started = time.time()
+            load_data_files.merge_values(meter_id, data_file, mycursor)
+            mycursor.commit()
+            record(results, "load merge_values (all duplicates)",
+                time.time() - started, rows, nbytes)
+
+def setup_energydb(mycursor):
+    """
+    (Re)build the energy database stand-in in BENCH_SCHEMA and point the
+    session of cursor MYCURSOR at it.
+    """
+    for sql in PG_SCHEMA_SQL:
+        mycursor.execute(sql)
+    for (table, field), values in sorted(LOOKUP_ROWS.items()):
+        for value in values:
+            mycursor.execute("INSERT INTO %s (%s) VALUES (?)"
+                % (table, field), value)
+    mycursor.commit()
+    load_data_files.id_cache.clear()
+
+def report(results, params, json_file=None):
+    """
+    Print RESULTS as a table of rows/sec and MB/sec per stage. If JSON_FILE
+    is given, also append one JSON line per stage, tagged with the run's
+    parameters PARAMS, to it.
+    """
+    print("\n%-40s %9s %10s %12s %8s %8s"
+        % ("stage", "seconds", "rows", "rows/sec", "MB", "MB/sec"))
+    for stage in sorted(results):
+        r = results[stage]
+        seconds = max(r["seconds"], 1e-9)
+        mb = r["bytes"] / 1048576.0
+        print("%-40s %9.3f %10d %12.0f %8.2f %8.2f" % (stage, r["seconds"],
+            r["rows"], r["rows"] / seconds, mb, mb / seconds))
+    if json_file:
+        with open(json_file, "a") as f:
+            for stage in sorted(results):
+                line = dict(params, stage=stage, **results[stage])
+                f.write(json.dumps(line, sort_keys=True) + "\n")
+
+def usage():
+    """
+    Usage message.
+    """
+    print("\nUSAGE:  python %s [ OPTIONS ]" % (sys.argv[0]))
+    print("\n\tBenchmarks the getter and loader stages on synthetic data.")
+    print("\nOPTIONS")
+    print("\t--meters N     -- meters per source database (default 10)")
+    print("\t--days D       -- days of readings per meter (default 30)")
+    print("\t--interval M   -- minutes between readings (default 1)")
+    print("\t--format F     -- data file format: csv, epoch, gzip, binary")
+    print("\t--window W     -- query readings in W-long windows")
+    print("\t--seed S       -- random seed (default 0)")
+    print("\t--pg DSN       -- ODBC DSN of a local Postgres to benchmark the")
+    print("\t                  loader against (its '%s' schema is rebuilt)"
+        % (BENCH_SCHEMA))
+    print("\t--json FILE    -- append the results to FILE as JSON lines")
+    print("\t--keep         -- keep the stand-in database and data files\n")
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "", ["meters=", "days=",
+            "interval=", "format=", "window=", "seed=", "pg=", "json=",
+            "keep"])
+    except getopt.GetoptError, opt_err:
+        print(opt_err)
+        usage()
+        exit()
+    params = {"meters": 10, "days": 30, "interval": 1, "format": "csv",
+        "window": None, "seed": 0}
+    pg_dsn = json_file = None
+    keep = False
+    try:
+        for opt, val in opts:
+            if opt in ("--meters", "--days", "--interval"):
+                params[opt[2:]] = util.get_workers(val)
+            elif opt == "--seed":
+                params["seed"] = int(val)
+            elif opt == "--format":
+                params["format"] = datafile.get_format(val)
+            elif opt == "--window":
+                params["window"] = util.get_window(val)
+            elif opt == "--pg":
+                pg_dsn = val
+            elif opt == "--json":
+                json_file = val
+            elif opt == "--keep":
+                keep = True
+    except ValueError, opt_err:
+        print(opt_err)
+        usage()
+        exit()
+    if args:
+        usage()
+        exit()
+
+    work_dir = tempfile.mkdtemp(prefix="energydb_bench_")
+    # Keep catalog snapshots and other state out of the real state directory.
+    util.STATE_DIR = work_dir
+    source_path = os.path.join(work_dir, "source.db")
+    print("Building source stand-in in '%s' ..." % (work_dir)),
+    sys.stdout.flush()
+    meter_lists = build_source(source_path, params["meters"], params["days"],
+        params["interval"], params["seed"])
+    util.done()
+
+    results = {}
+    data_files = []
+    # datafile.write_readings() fetches on a thread of its own.
+    src_cnxn = sqlite3.connect(source_path,
+        detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=False)
+    for source in sorted(SOURCES):
+        print("Benchmarking %s getter stages ..." % (source.upper())),
+        sys.stdout.flush()
+        src_cursor = SourceCursor(src_cnxn)
+        data_files += bench_source(source, meter_lists[source], src_cursor,
+            params["format"], params["window"], work_dir, results)
+        src_cursor.close()
+        util.done()
+    src_cnxn.close()
+
+    if pg_dsn:
+        print("Benchmarking loader stages ..."),
+        sys.stdout.flush()
+        try:
+            pg_cnxn = pyodbc.connect("DSN=%s" % (pg_dsn))
+        except pyodbc.Error, connect_err:
+            util.fail()
+            print(connect_err)
+            exit()
+        pg_cursor = pg_cnxn.cursor()
+        setup_energydb(pg_cursor)
+        bench_loader(data_files, pg_cursor, results)
+        pg_cursor.close()
+        pg_cnxn.close()
+        util.done()
+
+    report(results, params, json_file)
+    if keep:
+        print("\nStand-in database and data files kept in '%s'" % (work_dir))
+    else:
+        shutil.rmtree(work_dir)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,564 @@
+"""
+Writes and reads the meter data files passed from the getter scripts
+(ion_get_data.py, jci_get_data.py) to the loader script (load_data_files.py).
+
+The first line of a data file is always the csv meter header:
+
+    description, original unit, commodity, source system name, reading type
+
+The readings that follow, in time order, are stored in one of FORMATS:
+
+    csv     -- 'timestamp, reading' lines (FILE.csv)
+    epoch   -- the same, with the timestamps in microseconds since the Unix
+               epoch, which are cheaper to write and to load (FILE.csv)
+    gzip    -- the whole file, header included, as gzip'd csv (FILE.csv.gz)
+    binary  -- blocks of readings (FILE.bin), each made of a little-endian
+               uint32 row count N, N int64 timestamps in microseconds since
+               the Unix epoch, N float64 readings and N bytes that are 1
+               where the reading is NULL
+
+The loader tells epoch files from csv files by their first reading (see
+epoch_stamps()). While extracting, fetched readings are held in
+ReadingBuffers, compact arrays that are written out a whole batch at a time;
+csv timestamps are formatted with NumPy, if it is installed.
+"""
+
+import array
+import csv
+import datetime
+import gzip
+import itertools
+import os
+import Queue
+import shutil
+import struct
+import sys
+import threading
+import util
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Reading fields that stand for a NULL reading.
+NULL_READINGS = ("NULL", "Null", "")
+
+# Data file formats and the file name extension of each.
+FORMATS = {"csv": ".csv", "epoch": ".csv", "gzip": ".csv.gz",
+    "binary": ".bin"}
+
+# Start of the timestamps of binary data files.
+EPOCH = datetime.datetime(1970, 1, 1)
+
+# Typecode of the int64 timestamp arrays of a ReadingBuffer. Python 2's array
+# module has no 'q'; 'l' is 64 bits on the Linux hosts these scripts run on.
+STAMP_TYPECODE = "l"
+
+# 'HH:MM:SS' of each second of a day, built on first use (see iso_stamps()).
+_times_of_day = []
+
+# Suffix of files that are still being written. The loader skips them.
+PARTIAL_SUFFIX = ".part"
+
+# Fraction of a totalizer's steps that may be resets (see ReadingTypeTracker).
+RESET_TOLERANCE = 0.001
+
+# A drop to at most this fraction of the previous reading counts as a reset.
+RESET_RATIO = 0.1
+
+class ReadingTypeTracker(object):
+    """
+    Works out the reading type of a meter (Totalization or Interval) from its
+    readings as they stream past, so the source table is scanned only once.
+
+    A totalizer never decreases, except when its counter is reset: the reading
+    drops to at most RESET_RATIO of the previous one. The series is judged to
+    be a totalizer if it has no other decreases and at most RESET_TOLERANCE of
+    its steps (but always at least one) are resets. NULL readings are skipped.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.resets = 0
+        self.interval = False
+        self.first = None
+        self.prev = None
+
+    def update(self, values):
+        """
+        Add the readings in VALUES, in time order, to the series.
+        """
+        if (self.interval):
+            return
+        prev = self.prev
+        for v in values:
+            if (v is None):
+                continue
+            if (self.first is None):
+                self.first = v
+            self.count += 1
+            if (prev is not None and v < prev):
+                if (v > prev * RESET_RATIO):
+                    self.interval = True
+                    return
+                self.resets += 1
+            prev = v
+        self.prev = prev
+
+    def merge(self, later):
+        """
+        Add the series seen by tracker LATER, whose readings all come after
+        the ones seen by this one, as if they had been fed to this one.
+        """
+        if (later.first is not None):
+            self.update([later.first])
+        if (self.interval or later.interval):
+            self.interval = True
+            return
+        if (later.count):
+            self.count += later.count - 1
+            self.resets += later.resets
+            self.prev = later.prev
+
+    def reading_type(self):
+        """
+        Return the reading type of the series seen so far, or None if it has
+        no readings.
+        """
+        if (self.count == 0 and not self.interval):
+            return None
+        if (self.interval
+            or self.resets > max(1, int(self.count * RESET_TOLERANCE))):
+            return "Interval"
+        return "Totalization"
+
+def body_path(output_path, piece=None):
+    """
+    Return the path of the temporary file holding the readings of the data
+    file OUTPUT_PATH until its header is known, or those of its PIECE-th
+    piece if it is extracted in pieces (see workplan.py).
+    """
+    if piece is None:
+        return output_path + ".body" + PARTIAL_SUFFIX
+    return "%s.body%d%s" % (output_path, piece, PARTIAL_SUFFIX)
+
+def get_format(value):
+    """
+    Returns VALUE, the argument of a '--format' option, if it is one of
+    FORMATS. Raises ValueError otherwise.
+    """
+    if value not in FORMATS:
+        raise ValueError("ERROR: Unknown data file format '%s'.\n" % (value))
+    return value
+
+def file_format(data_file):
+    """
+    Return the format of DATA_FILE, judged by its file name extension.
+    Files with an unknown extension are taken to be csv, as are epoch files
+    (see epoch_stamps()).
+    """
+    for fmt, extension in FORMATS.items():
+        if extension != FORMATS["csv"] and data_file.endswith(extension):
+            return fmt
+    return "csv"
+
+def is_epoch(stamp):
+    """
+    Return TRUE if timestamp field STAMP is written as microseconds since
+    EPOCH, as in epoch files, rather than as 'YYYY-MM-DD HH:MM:SS'.
+    """
+    return stamp.lstrip("-").isdigit()
+
+def epoch_stamps(data_file):
+    """
+    Return TRUE if DATA_FILE is an epoch file, judged by its first reading.
+    A file without readings is taken to be csv.
+    """
+    if file_format(data_file) == "binary":
+        return False
+    with open_data(data_file) as f:
+        reader = csv.reader(f)
+        reader.next()
+        row = next(reader, None)
+    return bool(row) and is_epoch(row[0])
+
+def open_data(data_file, mode="rb"):
+    """
+    Open DATA_FILE in MODE, decompressing or compressing it if its format
+    calls for it.
+    """
+    if file_format(data_file) == "gzip":
+        return gzip.open(data_file, mode)
+    return open(data_file, mode)
+
+def to_epoch(timestamp):
+    """
+    Return datetime TIMESTAMP as microseconds since EPOCH.
+    """
+    delta = timestamp - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+def from_epoch(micros):
+    """
+    Return MICROS microseconds since EPOCH as a datetime.
+    """
+    return EPOCH + datetime.timedelta(microseconds=micros)
+
+class ReadingBuffer(object):
+    """
+    Holds a batch of fetched readings in compact arrays rather than as a row
+    object per reading: 'stamps' holds the timestamps as microseconds since
+    EPOCH, 'values' the readings as floats (0.0 where NULL), and 'nulls' is
+    1 where the reading is NULL. ROWS are (timestamp, reading) rows or, from
+    a query over several meters, (meter, timestamp, reading) rows, in which
+    case 'meters' holds the meter of each row.
+    """
+
+    def __init__(self, rows=()):
+        self.meters = None
+        stamp, value = 0, 1
+        if rows and len(rows[0]) == 3:
+            self.meters = [row[0] for row in rows]
+            stamp, value = 1, 2
+        self.stamps = array.array(STAMP_TYPECODE,
+            [to_epoch(row[stamp]) for row in rows])
+        self.values = array.array("d",
+            [0.0 if row[value] is None else row[value] for row in rows])
+        self.nulls = bytearray(row[value] is None for row in rows)
+
+    def __len__(self):
+        return len(self.stamps)
+
+    def __iter__(self):
+        """
+        Yield the readings as (timestamp, reading) pairs, with a datetime
+        timestamp and None for a NULL reading.
+        """
+        for i in xrange(len(self.stamps)):
+            yield (from_epoch(self.stamps[i]),
+                None if self.nulls[i] else self.values[i])
+
+    def first(self):
+        """
+        Return the timestamp of the first reading as a datetime.
+        """
+        return from_epoch(self.stamps[0])
+
+    def last(self):
+        """
+        Return the timestamp of the last reading as a datetime.
+        """
+        return from_epoch(self.stamps[-1])
+
+    def readings(self):
+        """
+        Return the readings in order, with None for a NULL reading.
+        """
+        if 1 not in self.nulls:
+            return self.values
+        return [None if null else v for v, null
+            in itertools.izip(self.values, self.nulls)]
+
+    def runs(self):
+        """
+        Yield (meter, buffer) for each run of rows of one meter, the buffer
+        holding the run's readings.
+        """
+        start = 0
+        for meter, run in itertools.groupby(self.meters):
+            end = start + sum(1 for m in run)
+            part = ReadingBuffer()
+            part.stamps = self.stamps[start:end]
+            part.values = self.values[start:end]
+            part.nulls = self.nulls[start:end]
+            yield meter, part
+            start = end
+
+def little_endian(values):
+    """
+    Return the bytes of array VALUES in little-endian order.
+    """
+    if sys.byteorder == "little":
+        return values.tostring()
+    swapped = array.array(values.typecode, values)
+    swapped.byteswap()
+    return swapped.tostring()
+
+def iso_stamps(stamps):
+    """
+    Return the timestamps in array STAMPS, in microseconds since EPOCH, as
+    a list of 'YYYY-MM-DD HH:MM:SS' strings, with '.ffffff' added to those
+    that have a fraction of a second, as str() writes datetimes.
+    """
+    if not stamps:
+        return []
+    global _times_of_day
+    if not _times_of_day:
+        _times_of_day = ["%02d:%02d:%02d" % (h, m, s) for h in xrange(24)
+            for m in xrange(60) for s in xrange(60)]
+    times = _times_of_day
+    if numpy is not None:
+        micros = numpy.frombuffer(stamps, dtype=numpy.int64)
+        seconds, fractions = numpy.divmod(micros, 1000000)
+        days, second = numpy.divmod(seconds, 86400)
+        day_list, day_index = numpy.unique(days, return_inverse=True)
+        dates = [str((EPOCH + datetime.timedelta(day)).date()) + " "
+            for day in day_list.tolist()]
+        text = map(str.__add__, map(dates.__getitem__, day_index.tolist()),
+            map(times.__getitem__, second.tolist()))
+        for i in numpy.flatnonzero(fractions).tolist():
+            text[i] = "%s.%06d" % (text[i], fractions[i])
+        return text
+    text = []
+    append = text.append
+    day = None
+    # Readings come in time order, so the date changes rarely.
+    for stamp in stamps:
+        seconds, micros = divmod(stamp, 1000000)
+        days, second = divmod(seconds, 86400)
+        if days != day:
+            day = days
+            date = str((EPOCH + datetime.timedelta(days)).date()) + " "
+        if micros:
+            append("%s%s.%06d" % (date, times[second], micros))
+        else:
+            append(date + times[second])
+    return text
+
+def format_csv(buf, epoch=False):
+    """
+    Return the readings of ReadingBuffer BUF as 'timestamp,reading' csv
+    lines, with the timestamps as iso_stamps() writes them or, if EPOCH, as
+    microseconds since EPOCH. Readings are written as repr() writes floats,
+    and NULL readings as "NULL".
+    """
+    if epoch:
+        stamps = map(str, buf.stamps)
+    else:
+        stamps = iso_stamps(buf.stamps)
+    readings = map(repr, buf.values)
+    for i in itertools.compress(xrange(len(buf)), buf.nulls):
+        readings[i] = "NULL"
+    lines = "\r\n".join(itertools.imap(",".join,
+        itertools.izip(stamps, readings)))
+    return lines + "\r\n" if lines else ""
+
+class BodyWriter(object):
+    """
+    Writes ReadingBuffers to the body of a data file in format FMT. Use as a
+    context manager (the file is closed on exit) or call close().
+    """
+
+    def __init__(self, path, fmt):
+        self.fmt = fmt
+        if fmt == "gzip":
+            self.file = gzip.open(path, "wb")
+        else:
+            self.file = open(path, "wb")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """
+        Close the file.
+        """
+        self.file.close()
+
+    def write_batch(self, buf):
+        """
+        Write the readings of ReadingBuffer BUF.
+        """
+        if self.fmt != "binary":
+            self.file.write(format_csv(buf, self.fmt == "epoch"))
+            return
+        self.file.write(struct.pack("<I", len(buf)))
+        self.file.write(little_endian(buf.stamps))
+        self.file.write(little_endian(buf.values))
+        self.file.write(str(buf.nulls))
+
+class DemuxWriter(object):
+    """
+    Stands in for a BodyWriter when one query returns the readings of several
+    meters as (meter, timestamp, reading) rows ordered by meter and time. Each
+    run of a meter's rows is written with its BodyWriter in WRITERS and fed to
+    its ReadingTypeTracker in TRACKERS, both keyed by meter. 'last' maps each
+    meter to the timestamp of its last reading written.
+    """
+
+    def __init__(self, writers, trackers):
+        self.writers = writers
+        self.trackers = trackers
+        self.last = {}
+
+    def write_batch(self, buf):
+        """
+        Write the readings of ReadingBuffer BUF, which has 'meters'.
+        """
+        for meter, run in buf.runs():
+            self.writers[meter].write_batch(run)
+            self.trackers[meter].update(run.readings())
+            self.last[meter] = run.last()
+
+def write_readings(writer, my_cursor, windows, get_readings, tracker=None,
+        item=None):
+    """
+    Write the readings of every (start, end, start_op) window in WINDOWS with
+    BodyWriter WRITER. GET_READINGS(start, end, start_op) must run the
+    readings query for one window on cursor MY_CURSOR and return TRUE if it
+    succeeds. Rows are fetched util.FETCH_SIZE at a time and handed to
+    WRITER as ReadingBuffers. The readings are also fed to reading type
+    tracker TRACKER, if given.
+
+    Rows are fetched on a separate thread (see fetch_readings()) while the
+    batches before them are written, at most util.PIPELINE_DEPTH batches
+    ahead, so that waiting on the database and writing overlap. MY_CURSOR
+    must not be used by anything else until this returns.
+
+    The query, fetch, write and reading type stages are timed separately
+    (see util.Stage) for ITEM.
+    Returns (COMPLETE, LAST), where COMPLETE is FALSE if a query failed and
+    LAST is the timestamp of the last reading written (NONE if none were).
+    """
+    batches = Queue.Queue(util.PIPELINE_DEPTH)
+    stop = threading.Event()
+    producer = threading.Thread(target=fetch_readings, args=(batches, stop,
+        my_cursor, windows, get_readings, item))
+    producer.daemon = True
+    producer.start()
+
+    write = util.Stage("write", item)
+    detect = util.Stage("reading type", item)
+    last = None
+    try:
+        while True:
+            # A timeout lets Ctrl-C interrupt the wait in Python 2.
+            kind, value = batches.get(True, 365 * 24 * 60 * 60)
+            if kind == "done":
+                return value, last
+            if kind == "error":
+                raise value[0], value[1], value[2]
+            with write:
+                writer.write_batch(value)
+                write.count(len(value))
+            if (tracker is not None):
+                with detect:
+                    tracker.update(value.readings())
+                    detect.count(len(value))
+            last = value.last()
+    finally:
+        stop.set()
+        producer.join()
+
+def fetch_readings(batches, stop, my_cursor, windows, get_readings,
+        item=None):
+    """
+    Producer half of write_readings(), whose arguments these are: run the
+    readings query of each window and put ('rows', buffer) on queue BATCHES
+    for every batch fetched, as a ReadingBuffer, then ('done', COMPLETE). An
+    exception is put on the queue as ('error', exc_info) rather than raised.
+    Gives up as soon as event STOP is set.
+    """
+    def put(message):
+        while not stop.is_set():
+            try:
+                batches.put(message, True, 0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    query = util.Stage("query", item)
+    fetch = util.Stage("fetch", item)
+    try:
+        for window_start, window_end, start_op in windows:
+            with query:
+                if (not get_readings(window_start, window_end, start_op)):
+                    query.fail()
+                    put(("done", False))
+                    return
+            rows_left = util.fetch_batches(my_cursor)
+            while True:
+                with fetch:
+                    rows = next(rows_left, None)
+                    if (rows):
+                        fetch.count(len(rows))
+                        rows = ReadingBuffer(rows)
+                if (not rows):
+                    break
+                if (not put(("rows", rows))):
+                    return
+        put(("done", True))
+    except Exception:
+        put(("error", sys.exc_info()))
+
+def assemble(output_path, header):
+    """
+    Write the data file OUTPUT_PATH from meter header HEADER and the readings
+    already written to body_path(OUTPUT_PATH), which is removed. The file is
+    built under a PARTIAL_SUFFIX name and renamed into place once complete.
+    A gzip body is a complete gzip member, so the header is written as a
+    member of its own and the two are simply concatenated.
+    """
+    partial_path = output_path + PARTIAL_SUFFIX
+    readings_path = body_path(output_path)
+    if file_format(output_path) == "gzip":
+        header_file = gzip.GzipFile(partial_path, "wb")
+    else:
+        header_file = open(partial_path, "wb")
+    with header_file:
+        csv.writer(header_file, delimiter=',').writerow(header)
+    with open(partial_path, "ab") as output_file:
+        with open(readings_path, "rb") as readings_file:
+            shutil.copyfileobj(readings_file, output_file)
+    os.remove(readings_path)
+    os.rename(partial_path, output_path)
+
+def read_header(data_file):
+    """
+    Return the meter header of DATA_FILE as a list.
+    """
+    with open_data(data_file) as f:
+        return csv.reader(f).next()
+
+def read_readings(data_file):
+    """
+    Yield the (timestamp, reading) pairs of DATA_FILE, skipping its header.
+    Pairs from csv files are strings; pairs from binary files are a datetime
+    and a float, and epoch files yield a datetime and a string. NULL
+    readings are yielded as None.
+    """
+    if file_format(data_file) == "binary":
+        for reading in read_binary(data_file):
+            yield reading
+        return
+    epoch = epoch_stamps(data_file)
+    with open_data(data_file) as f:
+        reader = csv.reader(f)
+        reader.next()
+        for row in reader:
+            yield (from_epoch(int(row[0])) if epoch else row[0],
+                None if row[1] in NULL_READINGS else row[1])
+
+def read_binary(data_file):
+    """
+    Yield the (timestamp, reading) pairs of binary DATA_FILE, skipping its
+    header.
+    """
+    with open(data_file, "rb") as f:
+        f.readline()
+        while True:
+            count = f.read(4)
+            if not count:
+                return
+            n = struct.unpack("<I", count)[0]
+            stamps = struct.unpack("<%dq" % (n), f.read(8 * n))
+            values = struct.unpack("<%dd" % (n), f.read(8 * n))
+            nulls = bytearray(f.read(n))
+            for i in xrange(n):
+                yield (from_epoch(stamps[i]),
+                    None if nulls[i] else values[i])
@@ -0,0 +1,291 @@
+"""
+Streams the result set of an ad-hoc query, as run by ion_run_sql.py and
+jci_run_sql.py, to a file or to stdout in one of FORMATS:
+
+    csv     -- a line per row, after a line of column names if asked for
+               with '--header'; NULL is empty
+    gzip    -- the same, gzip'd
+    binary  -- the csv line of column names, then blocks of rows, each made
+               of a little-endian uint32 row count N and, per column, a type
+               code byte, N bytes that are 1 where the value is NULL, and
+               the values (NULLs included, as zeros or empty strings):
+
+                   q -- N int64
+                   d -- N float64 (also used for Decimal columns)
+                   t -- N int64 microseconds since the Unix epoch
+                   s -- N uint32 byte lengths, then the UTF-8 bytes
+
+               A column's type code is chosen per block, from its values;
+               columns of mixed types are written as strings
+
+Rows are fetched ARRAY_SIZE at a time and written a batch at a time, so the
+result set is never held in memory. While writing, the rows written and the
+rate are shown on stderr.
+"""
+
+import cStringIO
+import csv
+import datafile
+import datetime
+import decimal
+import gzip
+import struct
+import sys
+import time
+import util
+
+# Output formats, see above.
+FORMATS = ("csv", "gzip", "binary")
+
+# Output path standing for stdout.
+STDOUT = "-"
+
+# Rows fetched per fetchmany() call unless '--array-size' says otherwise.
+ARRAY_SIZE = util.FETCH_SIZE
+
+# Seconds between progress lines.
+PROGRESS_INTERVAL = 1.0
+
+# gzip compression level; the default of 9 costs much time for little gain.
+GZIP_LEVEL = 6
+
+# Long options of the scripts that export, see get_options().
+OPTIONS = ["format=", "output=", "array-size=", "header"]
+
+# Range of the values of an int64 ('q') column.
+INT64_RANGE = (-2 ** 63, 2 ** 63 - 1)
+
+def get_options(opts, output):
+    """
+    Returns (FMT, OUTPUT, ARRAY_SIZE, HEADER) from OPTS, the (option, value)
+    pairs parsed by getopt from the OPTIONS, where OUTPUT is the output path
+    to use if there is no '--output' option and HEADER is TRUE if csv output
+    starts with a line of column names. Raises ValueError if an option's
+    value is not valid.
+    """
+    fmt = "csv"
+    array_size = ARRAY_SIZE
+    header = False
+    for opt, val in opts:
+        if opt == "--format":
+            if val not in FORMATS:
+                raise ValueError("ERROR: Unknown output format '%s'.\n"
+                    % (val))
+            fmt = val
+        elif opt == "--output":
+            output = val
+        elif opt == "--header":
+            header = True
+        elif opt == "--array-size":
+            try:
+                array_size = int(val)
+            except ValueError:
+                array_size = 0
+            if array_size < 1:
+                raise ValueError("ERROR: Array size must be a positive "
+                    "number.\n")
+    return fmt, output, array_size, header
+
+class CountingFile(object):
+    """
+    Wraps open file F, counting the bytes written to it in 'bytes'.
+    """
+
+    def __init__(self, f):
+        self.file = f
+        self.bytes = 0
+
+    def write(self, data):
+        self.file.write(data)
+        self.bytes += len(data)
+
+    def flush(self):
+        self.file.flush()
+
+def column_type(values):
+    """
+    Return the type code (see above) of the column values VALUES.
+    """
+    present = [v for v in values if v is not None]
+    types = set(type(v) for v in present)
+    if not types:
+        return "q"
+    if types <= set([int, long, bool]):
+        if INT64_RANGE[0] <= min(present) and max(present) <= INT64_RANGE[1]:
+            return "q"
+        return "d"
+    if types <= set([int, long, bool, float, decimal.Decimal]):
+        return "d"
+    if types == set([datetime.datetime]):
+        return "t"
+    return "s"
+
+def encode(value):
+    """
+    Return VALUE as a UTF-8 byte string.
+    """
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    if isinstance(value, (str, bytearray, buffer)):
+        return str(value)
+    return unicode(value).encode("utf-8")
+
+def pack_column(values):
+    """
+    Return the block of a binary output holding the column values VALUES.
+    """
+    n = len(values)
+    code = column_type(values)
+    nulls = bytearray(v is None for v in values)
+    if code == "q":
+        data = struct.pack("<%dq" % (n), *[0 if v is None else v
+            for v in values])
+    elif code == "d":
+        data = struct.pack("<%dd" % (n), *[0.0 if v is None else float(v)
+            for v in values])
+    elif code == "t":
+        data = struct.pack("<%dq" % (n), *[0 if v is None
+            else datafile.to_epoch(v) for v in values])
+    else:
+        strings = ["" if v is None else encode(v) for v in values]
+        data = (struct.pack("<%dI" % (n), *[len(s) for s in strings])
+            + "".join(strings))
+    return code + str(nulls) + data
+
+def format_csv(rows):
+    """
+    Return ROWS as csv lines, with unicode values encoded as UTF-8.
+    """
+    buf = cStringIO.StringIO()
+    try:
+        csv.writer(buf, delimiter=',').writerows(rows)
+    except UnicodeEncodeError:
+        # Only batches holding non-ASCII text pay for encoding every value.
+        buf = cStringIO.StringIO()
+        csv.writer(buf, delimiter=',').writerows([encode(v)
+            if isinstance(v, unicode) else v for v in row] for row in rows)
+    return buf.getvalue()
+
+class ResultWriter(object):
+    """
+    Writes batches of result rows, of a query with column names COLUMNS, to
+    open file F in format FMT. The column names are written first if HEADER
+    is TRUE, and always in the binary format, which needs them.
+    """
+
+    def __init__(self, f, fmt, columns, header=False):
+        self.fmt = fmt
+        self.file = f
+        if fmt == "gzip":
+            self.file = gzip.GzipFile(fileobj=f, mode="wb",
+                compresslevel=GZIP_LEVEL)
+        if header or fmt == "binary":
+            csv.writer(self.file, delimiter=',').writerow(
+                [encode(c) for c in columns])
+
+    def write_batch(self, rows):
+        """
+        Write the rows in ROWS.
+        """
+        if self.fmt != "binary":
+            self.file.write(format_csv(rows))
+            return
+        self.file.write(struct.pack("<I", len(rows)))
+        for values in zip(*rows):
+            self.file.write(pack_column(values))
+
+    def close(self):
+        """
+        Finish the output; the underlying file is left open.
+        """
+        if self.fmt == "gzip":
+            self.file.close()
+
+def export(columns, batches, output, fmt, item=None, header=False):
+    """
+    Write the rows yielded in lists by BATCHES, of a query with column names
+    COLUMNS, to path OUTPUT (STDOUT for stdout) in format FMT, showing
+    progress on stderr, after a line of column names if HEADER is TRUE (see
+    ResultWriter). Timed as stage 'export' of ITEM. Return the number of
+    rows written.
+    """
+    if output == STDOUT:
+        f = sys.__stdout__
+    else:
+        f = open(output, "wb")
+    counter = CountingFile(f)
+    started = shown = time.time()
+    rows = 0
+    try:
+        with util.Stage("export", item) as stage:
+            writer = ResultWriter(counter, fmt, columns, header)
+            for batch in batches:
+                writer.write_batch(batch)
+                rows += len(batch)
+                stage.count(len(batch))
+                if time.time() - shown >= PROGRESS_INTERVAL:
+                    shown = time.time()
+                    show_progress(rows, shown - started)
+            writer.close()
+            counter.flush()
+            stage.count(nbytes=counter.bytes)
+    finally:
+        if output != STDOUT:
+            f.close()
+    show_progress(rows, time.time() - started, True)
+    return rows
+
+def show_progress(rows, seconds, last=False):
+    """
+    Show on stderr that ROWS rows were written in SECONDS seconds, ending the
+    progress line if LAST.
+    """
+    rate = rows / seconds if seconds else 0
+    sys.stderr.write("\r%d rows written (%d rows/sec)%s"
+        % (rows, rate, "\n" if last else ""))
+    sys.stderr.flush()
+
+def read_binary(path):
+    """
+    Return binary output file PATH as (COLUMNS, BATCHES), where COLUMNS are
+    the column names and BATCHES yields lists of row tuples. Values are read
+    back as int, float, datetime or UTF-8 byte strings, and NULLs as None.
+    """
+    f = open(path, "rb")
+    columns = csv.reader([f.readline()]).next()
+    return columns, read_blocks(f, len(columns))
+
+def read_blocks(f, width):
+    """
+    Yield the blocks of rows, WIDTH columns each, of open binary output file
+    F, and close it.
+    """
+    with f:
+        while True:
+            count = f.read(4)
+            if not count:
+                return
+            n = struct.unpack("<I", count)[0]
+            yield zip(*[read_column(f, n) for i in xrange(width)])
+
+def read_column(f, n):
+    """
+    Return the N values of the next column block of open binary output file
+    F as a list.
+    """
+    code = f.read(1)
+    nulls = bytearray(f.read(n))
+    if code == "s":
+        lengths = struct.unpack("<%dI" % (n), f.read(4 * n))
+        data = f.read(sum(lengths))
+        values = []
+        offset = 0
+        for length in lengths:
+            values.append(data[offset:offset + length])
+            offset += length
+    else:
+        values = list(struct.unpack("<%d%s" % (n, "d" if code == "d" else "q"),
+            f.read(8 * n)))
+        if code == "t":
+            values = [datafile.from_epoch(v) for v in values]
+    return [None if nulls[i] else values[i] for i in xrange(n)]
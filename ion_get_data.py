@@ -4,11 +4,16 @@ energy data is requested and pulls that data from the ION database. The
 extracted data is saved in csv form in the ~/data directory.
 """
 
+import collections
 import csv
+import datafile
+import functools
+import getopt
 import os
 import pyodbc
 import sys
 import util
+import workplan
 
 DB = util.ION_DB
 USER = util.ION_USER
@@ -41,43 +46,137 @@ def get_meter_list(extract_file):
         del meter_list[0]
         return meter_list
 
-def extract_meter_data(extract_file):
+def mark_key(mtr_row):
+    """
+    Returns the key of the meter described by MTR_ROW in the watermark file.
+    """
+    return "%d:%d" % (int(mtr_row[0]), int(mtr_row[1]))
+
+def get_catalog(meter_list, my_cursor):
+    """
+    Returns the metadata catalog (see util.load_catalog()) holding the Source
+    and Quantity names of every meter in METER_LIST. Names missing from
+    today's snapshot are fetched with set-based queries on cursor MY_CURSOR
+    and the snapshot is updated. Meters whose names cannot be fetched are
+    left to the per-meter lookups in extract().
+    """
+    catalog = util.load_catalog(DB)
+    print("Getting meter catalog ..."),
+    with util.Stage("catalog") as stage:
+        try:
+            added = util.fetch_names(catalog, "Source",
+                "SELECT ID, Name FROM Source WHERE ID IN (%s)",
+                set(int(row[0]) for row in meter_list), my_cursor)
+            added += util.fetch_names(catalog, "Quantity",
+                "SELECT ID, Name FROM Quantity WHERE ID IN (%s)",
+                set(int(row[1]) for row in meter_list), my_cursor)
+        except pyodbc.Error, catalog_err:
+            stage.fail()
+            util.fail()
+            print(catalog_err)
+            return catalog
+    if (added):
+        util.save_catalog(DB, catalog)
+    util.done()
+    return catalog
+
+def extract_meter_data(extract_file, workers=1, incremental=False,
+        window=None, fmt="csv", metrics_file=None, batch=1, split=None):
     """
     Extract meter reading data from the database as .csv files. The meters are
     from the EXTRACT_FILE.
     Also collects and writes meter metadata to a meter information file that
     will be used to import the data into the central database.
+    If WORKERS is greater than 1, that many meters are extracted at the same
+    time, each over its own connection.
+    If INCREMENTAL is TRUE, only readings newer than each meter's high-water
+    mark are extracted (see extract()).
+    If WINDOW is given, readings are queried one WINDOW-long time window at a
+    time (see util.split_windows()).
+    The data files are written in format FMT (see datafile.FORMATS).
+    The time spent in each stage is summed up at the end of the run and, if
+    METRICS_FILE is given, appended to it (see util.report_metrics()).
+    If BATCH is greater than 1, up to BATCH meters sharing a date range and
+    QuantityID are extracted with one query (see extract_group()).
+    If SPLIT is given, each meter's readings are counted first and its range
+    is split into pieces of about SPLIT readings, which are extracted
+    longest first (see workplan.py).
     """
+    cnxn_str = "DSN=%s;UID=%s;PWD=%s" % (DB, USER, PASSWD)
     try:
-        print("Using database '%s':" % (DB.upper()))
-        print("Connecting to database ..."),
-        cnxn_str = "DSN=%s;UID=%s;PWD=%s" % (DB, USER, PASSWD)
-        cnxn = pyodbc.connect(cnxn_str)
-        util.done()
-    except pyodbc.Error, connect_err:
-        util.fail()
-        print(connect_err)
-        exit()
-    cursor = cnxn.cursor()
-    try:
-        meter_list = get_meter_list(extract_file)    
+        meter_list = get_meter_list(extract_file)
     except ValueError, badHeader:
         print(badHeader)
         usage()
-        util.abort(cursor, cnxn)
-    
-    print("Begin data extraction ...\n")
-    err_count = 0
-    for meter_row in meter_list:
-        err_count += extract(meter_row, cursor, cnxn)
+        exit()
+
+    marks = seeds = None
+    if (incremental):
+        marks = util.load_watermarks(DB)
+        seeds = {}
+        if (any(mark_key(row) not in marks for row in meter_list)):
+            seeds = util.get_loaded_watermarks(DB.upper(), 6)
+
+    print("Using database '%s':" % (DB.upper()))
+    if (workers > 1 or split):
+        try:
+            pool = util.connect_pool(cnxn_str,
+                max(1, min(workers, len(meter_list))))
+        except pyodbc.Error, connect_err:
+            print(connect_err)
+            exit()
+        cnxn = pool.get()
+        cursor = cnxn.cursor()
+        catalog = get_catalog(meter_list, cursor)
+        cursor.close()
+        pool.put(cnxn)
+        if (split):
+            err_count = workplan.extract_split(sys.modules[__name__],
+                meter_list, pool, workers, split, marks, seeds, window,
+                catalog, fmt)
+        else:
+            if (batch > 1):
+                meter_extract = functools.partial(extract_group, marks=marks,
+                    seeds=seeds, window=window, catalog=catalog, fmt=fmt)
+                jobs = util.batch_groups(meter_list, batch, group_key)
+            else:
+                meter_extract = functools.partial(extract, marks=marks,
+                    seeds=seeds, window=window, catalog=catalog, fmt=fmt)
+                jobs = meter_list
+            print("Begin data extraction with %d workers ...\n" % (workers))
+            err_count = util.run_parallel(meter_extract, jobs, pool, workers)
+        util.close_pool(pool)
+    else:
+        try:
+            print("Connecting to database ..."),
+            cnxn = pyodbc.connect(cnxn_str)
+            util.done()
+        except pyodbc.Error, connect_err:
+            util.fail()
+            print(connect_err)
+            exit()
+        cursor = cnxn.cursor()
+        catalog = get_catalog(meter_list, cursor)
+        print("Begin data extraction ...\n")
+        err_count = 0
+        if (batch > 1):
+            for group in util.batch_groups(meter_list, batch, group_key):
+                err_count += extract_group(group, cursor, marks, seeds,
+                    window, catalog, fmt)
+        else:
+            for meter_row in meter_list:
+                err_count += extract(meter_row, cursor, marks, seeds, window,
+                    catalog, fmt)
+        util.close_cnxn(cursor, cnxn)
     print("\nExtraction finished.")
     if (err_count == 0):
         print("No errors encountered.")
     else:
         print("%d of %d IDs failed to process" % (err_count, len(meter_list)))
-    util.close_cnxn(cursor, cnxn)
+    util.report_metrics(metrics_file)
 
-def extract(mtr_row, my_cursor, my_cnxn):
+def extract(mtr_row, my_cursor, marks=None, seeds=None, window=None,
+        catalog=None, fmt="csv"):
     """
     Extract reading data for the meter described in MTR_ROW to a csv file in the
     following format:
@@ -86,46 +185,243 @@ def extract(mtr_row, my_cursor, my_cnxn):
 
     This method will write the information necessary to import the reading into
     the database to the header of the files above.
+    Return 0 if successful, 1 if error(s) occur.
+    Uses cursor MY_CURSOR.
+
+    If MARKS (see util.load_watermarks()) is given, only readings after the
+    meter's high-water mark are extracted, a blank end date means "now", and
+    the mark is moved to the last reading written. Meters without a mark fall
+    back to their entry in SEEDS (see util.get_loaded_watermarks()).
+
+    If WINDOW is given, the readings are queried one WINDOW-long time window
+    at a time and appended to the same file.
+
+    The reading type is worked out from the readings as they are written, so
+    the header is added once all readings are in (see datafile.assemble()).
+
+    Names found in CATALOG (see get_catalog()) are not queried again.
+
+    The file is written in format FMT (see datafile.FORMATS), whose extension
+    replaces '.csv' above.
+    """
+    plan = plan_extract(mtr_row, my_cursor, marks, seeds, window, catalog, fmt)
+    if (not plan):
+        return 1
+    meter_info, windows, output_path = plan
+
+    tracker = datafile.ReadingTypeTracker()
+    with datafile.BodyWriter(datafile.body_path(output_path), fmt) as writer:
+        complete, last = datafile.write_readings(writer, my_cursor, windows,
+            readings_query(mtr_row, my_cursor), tracker, mark_key(mtr_row))
+    return finish_extract(mtr_row, meter_info, output_path, complete, last,
+        tracker, marks)
+
+def extract_group(mtr_rows, my_cursor, marks=None, seeds=None, window=None,
+        catalog=None, fmt="csv"):
+    """
+    Extract the meters described in MTR_ROWS, which share a QuantityID and a
+    date range (see group_key()), as extract() does, but with one readings
+    query per time window for all of them (see get_group_readings()). The
+    rows of the query are split into the meters' files as they are fetched
+    (see datafile.DemuxWriter). Meters whose range differs after applying
+    MARKS are queried separately. Return the number of meters that failed.
+    """
+    err_count = 0
+    ranges = collections.OrderedDict()
+    for mtr_row in mtr_rows:
+        plan = plan_extract(mtr_row, my_cursor, marks, seeds, window, catalog,
+            fmt)
+        if (not plan):
+            err_count += 1
+            continue
+        members = ranges.setdefault(tuple(plan[1]), collections.OrderedDict())
+        if (int(mtr_row[0]) in members):
+            print("Source ID %d is listed twice; extracted once.\n"
+                % (int(mtr_row[0])))
+            continue
+        members[int(mtr_row[0])] = (mtr_row, plan)
+
+    for windows, members in ranges.items():
+        item = "%s+%d" % (mark_key(members.values()[0][0]), len(members) - 1)
+        print("Extracting readings of Source IDs %s ..."
+            % (", ".join(str(meter_id) for meter_id in members)))
+        trackers = dict((meter_id, datafile.ReadingTypeTracker())
+            for meter_id in members)
+        writers = {}
+        try:
+            for meter_id, (mtr_row, plan) in members.items():
+                writers[meter_id] = datafile.BodyWriter(
+                    datafile.body_path(plan[2]), fmt)
+            demux = datafile.DemuxWriter(writers, trackers)
+            complete, last = datafile.write_readings(demux, my_cursor,
+                list(windows), group_query(members.keys(),
+                int(members.values()[0][0][1]), my_cursor), None, item)
+        finally:
+            for writer in writers.values():
+                writer.close()
+        print("")
+        for meter_id, (mtr_row, plan) in members.items():
+            print("Processing Source ID: %d" % (meter_id))
+            err_count += finish_extract(mtr_row, plan[0], plan[2], complete,
+                demux.last.get(meter_id), trackers[meter_id], marks)
+    return err_count
+
+def plan_extract(mtr_row, my_cursor, marks=None, seeds=None, window=None,
+        catalog=None, fmt="csv"):
+    """
+    First half of extract(), whose arguments these are: describe the meter
+    and work out its time windows and data file. Returns (METER_INFO,
+    WINDOWS, OUTPUT_PATH), or None if the meter cannot be extracted.
     """
     meter_id = int(mtr_row[0])
-    quantity_id = int(mtr_row[1])
-    start = mtr_row[2]
-    end = mtr_row[3]
-    
+    start, end = get_range(mtr_row)
+    start_op = ">="
+
     print("Processing Source ID: %d" % (meter_id))
     
-    description = get_description(meter_id, my_cursor)
-    if (not description
-        or not get_unit(get_quantity_name(quantity_id, my_cursor))
-        or not get_commodity(unit)
-        or not get_reading_type(meter_id, quantity_id, start, end, my_cursor)
-        or not get_readings(meter_id, quantity_id, start, end)):
+    meter_info = describe(mtr_row, my_cursor, catalog)
+    if (not meter_info):
         util.tryNext()
-        return 1
+        return None
+    try:
+        if (marks is not None):
+            mark = (marks.get(mark_key(mtr_row))
+                or seeds.get((meter_info[0].lower(), meter_info[1].lower())))
+            start, end, start_op = util.incremental_range(mark, start, end)
+            print("Extracting readings %s '%s' ..." % (start_op, start))
+        windows = util.split_windows(start, end, window, start_op)
+    except ValueError, window_err:
+        print(window_err)
+        util.tryNext()
+        return None
 
-    output_filename = "%s_%s_%s_%s.csv" % (DB.upper(), str(meter_id), start, end)
-    output_path = util.DATA_OUTPUT_FILE_PATH + output_filename
+    if (marks is not None):
+        output_filename = "%s_%s_%s_%s%s" % (DB.upper(), str(meter_id),
+            util.file_stamp(start), util.file_stamp(end),
+            datafile.FORMATS[fmt])
+    else:
+        output_filename = "%s_%s_%s_%s%s" % (DB.upper(), str(meter_id),
+            start, end, datafile.FORMATS[fmt])
+    return meter_info, windows, util.DATA_OUTPUT_FILE_PATH + output_filename
 
-    with open(output_path, "wb") as output_file:
-        writer = csv.writer(output_file, delimiter=',')
-        header = [description, unit, commodity, DB.upper(), reading_type]
-        writer.writerow(header)
-        for row in my_cursor:
-            writer.writerow(["NULL" if r is None else r for r in row])
+def finish_extract(mtr_row, meter_info, output_path, complete, last, tracker,
+        marks=None):
+    """
+    Second half of extract(): once the readings of the meter described in
+    MTR_ROW have been written to the body of OUTPUT_PATH (COMPLETE and LAST
+    as returned by datafile.write_readings(), TRACKER fed with them), add
+    header METER_INFO and move its high-water mark in MARKS. Return 0 if
+    successful, 1 if error(s) occur.
+    """
+    body_path = datafile.body_path(output_path)
+    if (not complete):
+        os.remove(body_path)
+        util.tryNext()
+        return 1
+    if (marks is not None and last is None):
+        os.remove(body_path)
+        print("No new readings.\n")
+        return 0
+
+    print("Getting reading type ..."),
+    # A meter without readings has always been written as a totalizer.
+    reading_type = tracker.reading_type() or "Totalization"
+    util.done()
+    with util.Stage("assemble", mark_key(mtr_row)) as stage:
+        datafile.assemble(output_path, meter_info + [reading_type])
+        stage.count(nbytes=os.path.getsize(output_path))
+    if (marks is not None):
+        util.save_watermark(DB, marks, mark_key(mtr_row), util.format_mark(last))
 
     print("Processing finished.\n")
     return 0
 
-def get_description(meter_id, my_cursor):
+def get_range(mtr_row):
+    """
+    Returns the (start_date, end_date) of the meter described in MTR_ROW.
+    """
+    return mtr_row[2], mtr_row[3]
+
+def describe(mtr_row, my_cursor, catalog=None):
+    """
+    Returns the data file header of the meter described in MTR_ROW, minus its
+    reading type: [description, unit, commodity, source system name]. Returns
+    None if any of these cannot be found. Uses cursor MY_CURSOR; names found
+    in CATALOG (see get_catalog()) are not queried again.
+    """
+    with util.Stage("describe", mark_key(mtr_row)) as stage:
+        description = get_description(int(mtr_row[0]), my_cursor, catalog)
+        unit = description and get_unit(get_quantity_name(int(mtr_row[1]),
+            my_cursor, catalog))
+        commodity = unit and get_commodity(unit)
+        if (not commodity):
+            stage.fail()
+            return None
+    return [description, unit, commodity, DB.upper()]
+
+def readings_query(mtr_row, my_cursor):
+    """
+    Returns a function of (start_date, end_date, start_op) that runs
+    get_readings() for the meter described in MTR_ROW on cursor MY_CURSOR.
+    """
+    meter_id = int(mtr_row[0])
+    quantity_id = int(mtr_row[1])
+    return lambda start_date, end_date, start_op: get_readings(meter_id,
+        quantity_id, start_date, end_date, my_cursor, start_op)
+
+def group_key(mtr_row):
+    """
+    Returns what meters extracted by one query (see extract_group()) must
+    share: the date range and QuantityID of the meter described in MTR_ROW.
+    """
+    return get_range(mtr_row), int(mtr_row[1])
+
+def group_query(meter_ids, quantity_id, my_cursor):
+    """
+    Returns a function of (start_date, end_date, start_op) that runs
+    get_group_readings() for meters METER_IDS with QUANTITY_ID on cursor
+    MY_CURSOR.
+    """
+    return lambda start_date, end_date, start_op: get_group_readings(
+        meter_ids, quantity_id, start_date, end_date, my_cursor, start_op)
+
+def count_readings(mtr_row, slices, my_cursor):
+    """
+    Returns the number of readings of the meter described in MTR_ROW in each
+    of the consecutive (start_date, end_date) time ranges SLICES, counted
+    with a single query on cursor MY_CURSOR. Raises pyodbc.Error if the
+    query fails.
+    """
+    counts = ",\n            ".join(
+        "SUM(CASE WHEN TimestampUTC >= CAST('%s' AS datetime2) "
+        "AND TimestampUTC < CAST('%s' AS datetime2) THEN 1 ELSE 0 END) AS c%d"
+        % (lo, hi, i) for i, (lo, hi) in enumerate(slices))
+    count_sql = """
+        SELECT %s
+        FROM DataLog2
+        WHERE TimestampUTC >= CAST('%s' AS datetime2)
+        AND TimestampUTC < CAST('%s' AS datetime2)
+        AND SourceID = %d
+        AND QuantityID = %d
+    """ % (counts, slices[0][0], slices[-1][1], int(mtr_row[0]),
+        int(mtr_row[1]))
+    my_cursor.execute(count_sql)
+    row = my_cursor.fetchone()
+    return [int(c or 0) for c in row]
+
+def get_description(meter_id, my_cursor, catalog=None):
     """
     Returns the string containing the meter description corresponding to METER_ID
     or None if no description can be found or an error occurs. Uses cursor
-    MY_CURSOR.
+    MY_CURSOR, unless the description is in CATALOG.
     """
     get_description_sql = """
         SELECT TOP 1 Name FROM Source WHERE ID = %d
     """ % (meter_id)
     print("Getting meter name ..."),
+    if (catalog and str(meter_id) in catalog.get("Source", {})):
+        util.done()
+        return catalog["Source"][str(meter_id)]
     try:
         my_cursor.execute(get_description_sql)
     except pyodbc.Error, meter_name_err:
@@ -141,14 +437,17 @@ def get_description(meter_id, my_cursor):
         util.done()
         return description_result.Name
 
-def get_quantity_name(quantity_id, my_cursor):
+def get_quantity_name(quantity_id, my_cursor, catalog=None):
     """
     Returns the string containing the quantity name for QUANTITY_ID, or None if
-    the name cannot be found. Uses cursor MY_CURSOR.
+    the name cannot be found. Uses cursor MY_CURSOR, unless the name is in
+    CATALOG.
     """
     get_quantity_name_sql = """
         SELECT TOP 1 Name FROM Quantity WHERE ID = %d
     """ % (quantity_id)
+    if (catalog and str(quantity_id) in catalog.get("Quantity", {})):
+        return catalog["Quantity"][str(quantity_id)].lower()
     try:
         my_cursor.execute(get_quantity_name_sql)
     except pyodbc.Error, get_qty_name_err:
@@ -187,68 +486,49 @@ def get_commodity(unit):
 
     return commodity
 
-def get_reading_type(meter_id, quantity_id, start_date, end_date, my_cursor):
-    """
-    Return the reading type for meter METER_ID with quantity id QUANTITY_ID
-    between START_DATE and END_DATE (Totalization, Interval) or NONE if an error
-    occurs. Uses cursor MY_CURSOR.
-    """
-    monotonic_sql = """
-        SELECT
-            CASE WHEN COUNT(*) = 0 THEN 1 ELSE 0 END
-            AS IsMonotone
-        FROM (
-            SELECT TOP 100 ROW_NUMBER() OVER (ORDER BY TimestampUTC)
-            AS RowNum, Value
-            FROM DataLog2
-            WHERE SourceID = %d AND QuantityID = %d
-            AND TimestampUTC >= CAST('%s' AS datetime2)
-            AND TimestampUTC < CAST('%s' AS datetime2)
-        ) T1 INNER JOIN (
-            SELECT TOP 100 ROW_NUMBER() OVER (ORDER BY Value)
-            AS RowNum, Value
-            FROM DataLog2
-            WHERE SourceID = %d AND QuantityID = %d
-            AND TimestampUTC >= CAST('%s' AS datetime2)
-            AND TimestampUTC < CAST('%s' AS datetime2)
-        ) T2 ON T1.RowNum = T2.RowNum
-            WHERE T1.Value <> T2.Value
-    """ % (meter_id, quantity_id, start_date, end_date,
-            meter_id, quantity_id, start_date, end_date)
-    print("Getting reading type ..."),
-    try:
-        my_cursor.execute(monotonic_sql)
-    except pyodbc.Error, monotonic_err:
-        util.fail()
-        print(monotonic_err)
-        return None
-    monotoneResult = my_cursor.fetchone().IsMonotone
-    if (monotoneResult is None):
-        util.fail()
-        print("ERROR: Reading type cannot be determined")
-        return None
-    elif (monotoneResult == 0):
-        reading_type = "Interval"
-    else:
-        reading_type = "Totalization"
-    util.done()
-    return reading_type
-
-def get_readings(meter_id, quantity_id, start_date, end_date):
+def get_readings(meter_id, quantity_id, start_date, end_date, my_cursor,
+        start_op=">="):
     """
     Run the SQL to get readings for meter METER_ID with QUANTITY_ID between
     START_DATE and END_DATE. Return TRUE if successful, FALSE otherwise.
     The readings are stored in MY_CURSOR for later iteration.
+    START_OP compares TimestampUTC to START_DATE ('>=' or '>').
     """
     get_data_sql = """
         SELECT TimestampUTC, Value
         FROM DataLog2
-        WHERE TimestampUTC >= CAST('%s' AS datetime2)
+        WHERE TimestampUTC %s CAST('%s' AS datetime2)
         AND TimestampUTC < CAST('%s' AS datetime2)
         AND SourceID = %d
         AND QuantityID = %d
         ORDER BY TimestampUTC ASC
-    """ % (start_date, end_date, meter_id, quantity_id)
+    """ % (start_op, start_date, end_date, meter_id, quantity_id)
+    print("Getting meter readings ..."),
+    try:
+        my_cursor.execute(get_data_sql)
+        util.done()
+        return True
+    except pyodbc.Error, get_data_err:
+        util.fail()
+        print(get_data_err)
+        return False
+
+def get_group_readings(meter_ids, quantity_id, start_date, end_date,
+        my_cursor, start_op=">="):
+    """
+    As get_readings(), but for all meters METER_IDS with QUANTITY_ID at once.
+    The rows are (SourceID, TimestampUTC, Value), ordered by meter and time.
+    """
+    get_data_sql = """
+        SELECT SourceID, TimestampUTC, Value
+        FROM DataLog2
+        WHERE TimestampUTC %s CAST('%s' AS datetime2)
+        AND TimestampUTC < CAST('%s' AS datetime2)
+        AND SourceID IN (%s)
+        AND QuantityID = %d
+        ORDER BY SourceID ASC, TimestampUTC ASC
+    """ % (start_op, start_date, end_date,
+        ", ".join(str(int(meter_id)) for meter_id in meter_ids), quantity_id)
     print("Getting meter readings ..."),
     try:
         my_cursor.execute(get_data_sql)
@@ -263,10 +543,36 @@ def usage():
     """
     Usage message.
     """
-    print("\nUsage: python %s [ FILE.csv ]" % (sys.argv[0]))
+    print("\nUsage: python %s [ --workers N ] [ --incremental ] "
+        "[ --window W ] [ --format F ] [ --batch N | --split ROWS ] "
+        "[ --metrics M ] [ FILE.csv ]"
+        % (sys.argv[0]))
     print("    -- FILE.csv contains a list of ION meter information needed ")
     print("       to extract reading data from the ION datasource\n")
     print("    -- The absolute path to FILE.csv must be specified.")
+    print("    -- --workers N extracts N meters at the same time, each over")
+    print("       its own connection (default 1).")
+    print("    -- --incremental extracts only readings newer than the last")
+    print("       reading extracted (or loaded) for each meter. end_date may")
+    print("       then be left blank to extract up to the current time.")
+    print("    -- --window W queries readings one time window at a time, where")
+    print("       W is 'month', 'week', 'day' or a number of days. Use this")
+    print("       for long date ranges on dense meters.")
+    print("    -- --format F writes the data files as F: 'csv' (default),")
+    print("       'epoch' (csv with timestamps in microseconds since the Unix")
+    print("       epoch, cheaper to write and to load), 'gzip' (compressed")
+    print("       csv) or 'binary' (see datafile.py).")
+    print("    -- --batch N extracts up to N meters with the same date range")
+    print("       and QuantityID with a single query per time window, which")
+    print("       saves round trips when many meters are listed.")
+    print("    -- --split ROWS counts each meter's readings first and splits")
+    print("       its date range into pieces of about ROWS readings, which")
+    print("       the workers extract largest first. Use this when a few")
+    print("       dense meters would otherwise keep one worker busy long")
+    print("       after the others are done.")
+    print("    -- --metrics M appends the time, rows and bytes of each stage")
+    print("       of each meter to file M as JSON lines. A summary per stage")
+    print("       is always printed at the end of the run.")
     print("\nThe structure of FILE.csv is as follows:")
     print("File must have a header line EXACTLY as follows:\n")
     print("    SourceID, QuantityID, start_date, end_date")
@@ -274,17 +580,73 @@ def usage():
           "above.\n")
 
 def main():
-    arg_len = len(sys.argv)
-    if (arg_len != 2):
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "w:",
+            ["workers=", "incremental", "window=", "format=", "metrics=",
+            "batch=", "split="])
+    except getopt.GetoptError, opt_err:
+        print(opt_err)
+        usage()
+        exit()
+    workers = 1
+    incremental = False
+    window = None
+    fmt = "csv"
+    metrics_file = None
+    batch = 1
+    split = None
+    for opt, val in opts:
+        if (opt in ("-w", "--workers")):
+            try:
+                workers = util.get_workers(val)
+            except ValueError:
+                usage()
+                exit()
+        elif (opt == "--batch"):
+            try:
+                batch = util.get_workers(val)
+            except ValueError:
+                usage()
+                exit()
+        elif (opt == "--split"):
+            try:
+                split = util.get_workers(val)
+            except ValueError:
+                usage()
+                exit()
+        elif (opt == "--metrics"):
+            metrics_file = val
+        elif (opt == "--incremental"):
+            incremental = True
+        elif (opt == "--format"):
+            try:
+                fmt = datafile.get_format(val)
+            except ValueError, format_err:
+                print(format_err)
+                usage()
+                exit()
+        elif (opt == "--window"):
+            try:
+                window = util.get_window(val)
+            except ValueError, window_err:
+                print(window_err)
+                usage()
+                exit()
+    if (len(args) != 1):
+        usage()
+        exit()
+    if (batch > 1 and split):
+        print("ERROR: --batch and --split cannot be used together.\n")
         usage()
         exit()
-    extract_info_file = sys.argv[1] 
+    extract_info_file = args[0]
     if (not os.path.isfile(extract_info_file)):
         print("ERROR: file '%s' not found!\n" % (extract_info_file))
         exit()
     else:
         print("\nUsing file '%s' ...\n" % (extract_info_file))
-    extract_meter_data( extract_info_file )
+    extract_meter_data(extract_info_file, workers, incremental, window, fmt,
+        metrics_file, batch, split)
 
 if __name__ == "__main__":
     main()
@@ -1,10 +1,13 @@
 """
 Runs the user-supplied SQL query on the ION database and writes the results
-to 'ion_sql_output.csv'.
+to 'ion_sql_output.csv', or to the output and in the format asked for (see
+export.py). The results can be cached (see sqlcache.py).
 """
 
-import csv
+import export
+import getopt
 import pyodbc
+import sqlcache
 import sys
 import util
 
@@ -12,34 +15,81 @@ db = util.ION_DB
 user = util.ION_USER
 pwd = util.ION_PWD
 
+# Output path unless '--output' says otherwise.
+OUTPUT_FILE = "ion_sql_output.csv"
+
 def usage():
-    print("USAGE:\n\tpython ion_run_sql.py [YOUR SQL file]\n")
+    print("USAGE:\n\tpython ion_run_sql.py [--format F] [--output PATH] "
+        "[--array-size N] [--header] [--cache] [--refresh] [--no-cache] "
+        "[YOUR SQL file]\n")
+    print("\t--format F -- write the results as 'csv' (the default), 'gzip'")
+    print("\t(gzip'd csv) or 'binary' (columnar, see export.py).")
+    print("\t--output PATH -- write the results to PATH instead of")
+    print("\t'%s'; '-' writes them to stdout." % (OUTPUT_FILE))
+    print("\t--array-size N -- fetch N rows at a time (default %d)."
+        % (export.ARRAY_SIZE))
+    print("\t--header -- start csv and gzip output with a line of column")
+    print("\tnames.")
+    print("\t--cache -- reuse the results of the same query if it was run in")
+    print("\tthe last hour, or else cache its results. Also turned on by")
+    print("\tsetting %s in the environment." % (sqlcache.CACHE_ENV))
+    print("\t--refresh -- run the query even if its results are cached, and")
+    print("\tcache the new results.")
+    print("\t--no-cache -- neither use nor update the cache.\n")
 
 def main():
-    if len(sys.argv) < 2:
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "",
+            export.OPTIONS + sqlcache.OPTIONS)
+        fmt, output, array_size, header = export.get_options(opts,
+            OUTPUT_FILE)
+    except (getopt.GetoptError, ValueError), opt_err:
+        print(opt_err)
         usage()
         exit()
+    if len(args) != 1:
+        usage()
+        exit()
+    if (output == export.STDOUT):
+        # Keep stdout for the results.
+        sys.stdout = sys.stderr
+    use_cache, refresh = sqlcache.get_options(opts)
+    dsn = "DSN=%s;UID=%s" % (db, user)
 
-    cnxn_str = "DSN=%s;UID=%s;PWD=%s" % (db, user, pwd)
-    cnxn = pyodbc.connect(cnxn_str)
-    cursor = cnxn.cursor()
-
-    with open(sys.argv[1], 'r') as inp:
+    with open(args[0], 'r') as inp:
         my_sql = inp.read()
 
-    cursor.execute(my_sql)
+    cached = None
+    if (use_cache and not refresh):
+        cached = sqlcache.load(my_sql, dsn)
+    cnxn = None
+    if (cached):
+        print("Using cached results ...")
+        columns, batches = cached
+    else:
+        cnxn_str = "DSN=%s;UID=%s;PWD=%s" % (db, user, pwd)
+        cnxn = pyodbc.connect(cnxn_str)
+        cursor = cnxn.cursor()
+        cursor.arraysize = array_size
+        with util.Stage("query", args[0]):
+            cursor.execute(my_sql)
+        columns = batches = None
+        if (cursor.description):
+            columns = [d[0] for d in cursor.description]
+            batches = util.fetch_batches(cursor, array_size)
+            if (use_cache):
+                batches = sqlcache.store(my_sql, dsn, columns, batches)
 
-    if (cursor):
-        with open("ion_sql_output.csv", "wb") as f:
-            writer = csv.writer(f)
-            for r in cursor:
-                writer.writerow(r)
+    if (batches):
+        export.export(columns, batches, output, fmt, args[0], header)
     else:
         print("SQL query returned no results.\n")
 
-    cursor.close()
-    del cursor
-    cnxn.close()
+    if (cnxn):
+        cursor.close()
+        del cursor
+        cnxn.close()
+    util.report_metrics()
 
 if __name__ == "__main__":
     main()
@@ -1,8 +1,13 @@
+import collections
 import csv
+import datafile
+import functools
+import getopt
 import os
 import pyodbc
 import sys
 import util
+import workplan
 
 DB = util.METASYS_DB
 USER = util.METASYS_USER
@@ -35,43 +40,135 @@ def get_meter_list(extract_file):
         del meter_list[0]
         return meter_list
 
-def extract_meter_data(extract_file):
+def mark_key(mtr_row):
+    """
+    Returns the key of the meter described by MTR_ROW in the watermark file.
+    """
+    return "%d" % (int(mtr_row[0]))
+
+def get_catalog(meter_list, my_cursor):
+    """
+    Returns the metadata catalog (see util.load_catalog()) holding the point
+    name of every meter in METER_LIST. Names missing from today's snapshot are
+    fetched with set-based queries on cursor MY_CURSOR and the snapshot is
+    updated. Meters whose names cannot be fetched are left to the per-meter
+    lookups in extract().
+    """
+    catalog = util.load_catalog(DB)
+    print("Getting meter catalog ..."),
+    with util.Stage("catalog") as stage:
+        try:
+            added = util.fetch_names(catalog, "tblPoint",
+                "SELECT PointID, PointName FROM tblPoint WHERE PointID IN (%s)",
+                set(int(row[0]) for row in meter_list), my_cursor)
+        except pyodbc.Error, catalog_err:
+            stage.fail()
+            util.fail()
+            print(catalog_err)
+            return catalog
+    if added:
+        util.save_catalog(DB, catalog)
+    util.done()
+    return catalog
+
+def extract_meter_data(extract_file, workers=1, incremental=False,
+        window=None, fmt="csv", metrics_file=None, batch=1, split=None):
     """
     Extract meter reading data from the database as .csv files. The meters are
     from the EXTRACT_FILE.
     Also collects and writes meter metadata to a meter information file that
     will be used to import the data into the central database.
+    If WORKERS is greater than 1, that many meters are extracted at the same
+    time, each over its own connection.
+    If INCREMENTAL is TRUE, only readings newer than each meter's high-water
+    mark are extracted (see extract()).
+    If WINDOW is given, readings are queried one WINDOW-long time window at a
+    time (see util.split_windows()).
+    The data files are written in format FMT (see datafile.FORMATS).
+    The time spent in each stage is summed up at the end of the run and, if
+    METRICS_FILE is given, appended to it (see util.report_metrics()).
+    If BATCH is greater than 1, up to BATCH meters sharing a date range are
+    extracted with one query (see extract_group()).
+    If SPLIT is given, each meter's readings are counted first and its range
+    is split into pieces of about SPLIT readings, which are extracted
+    longest first (see workplan.py).
     """
+    cnxn_str = "DSN=%s;UID=%s;PWD=%s" % (DB, USER, PASSWD)
     try:
-        print("Using database '%s':" % (DB.upper()))
-        print("Connecting to database ..."),
-        cnxn_str = "DSN=%s;UID=%s;PWD=%s" % (DB, USER, PASSWD)
-        cnxn = pyodbc.connect(cnxn_str)
-        util.done()
-    except pyodbc.Error, connect_err:
-        util.fail()
-        print(connect_err)
-        exit()
-    cursor = cnxn.cursor()
-    try:
-        meter_list = get_meter_list(extract_file)    
+        meter_list = get_meter_list(extract_file)
     except ValueError, badHeader:
         print(badHeader)
         usage()
-        util.abort(cursor, cnxn)
+        exit()
 
-    print("Begin data extraction ...\n")
-    err_count = 0
-    for meter_row in meter_list:
-        err_count += extract(meter_row, cursor)
+    marks = seeds = None
+    if incremental:
+        marks = util.load_watermarks(DB)
+        seeds = {}
+        if any(mark_key(row) not in marks for row in meter_list):
+            # SQL Server's datetime takes at most 3 fractional digits.
+            seeds = util.get_loaded_watermarks("JCI", 3)
+
+    print("Using database '%s':" % (DB.upper()))
+    if workers > 1 or split:
+        try:
+            pool = util.connect_pool(cnxn_str,
+                max(1, min(workers, len(meter_list))))
+        except pyodbc.Error, connect_err:
+            print(connect_err)
+            exit()
+        cnxn = pool.get()
+        cursor = cnxn.cursor()
+        catalog = get_catalog(meter_list, cursor)
+        cursor.close()
+        pool.put(cnxn)
+        if split:
+            err_count = workplan.extract_split(sys.modules[__name__],
+                meter_list, pool, workers, split, marks, seeds, window,
+                catalog, fmt)
+        else:
+            if batch > 1:
+                meter_extract = functools.partial(extract_group, marks=marks,
+                    seeds=seeds, window=window, catalog=catalog, fmt=fmt)
+                jobs = util.batch_groups(meter_list, batch, group_key)
+            else:
+                meter_extract = functools.partial(extract, marks=marks,
+                    seeds=seeds, window=window, catalog=catalog, fmt=fmt)
+                jobs = meter_list
+            print("Begin data extraction with %d workers ...\n" % (workers))
+            err_count = util.run_parallel(meter_extract, jobs, pool, workers)
+        util.close_pool(pool)
+    else:
+        try:
+            print("Connecting to database ..."),
+            cnxn = pyodbc.connect(cnxn_str)
+            util.done()
+        except pyodbc.Error, connect_err:
+            util.fail()
+            print(connect_err)
+            exit()
+        cursor = cnxn.cursor()
+        catalog = get_catalog(meter_list, cursor)
+        print("Begin data extraction ...\n")
+        err_count = 0
+        if batch > 1:
+            for group in util.batch_groups(meter_list, batch, group_key):
+                err_count += extract_group(group, cursor, marks, seeds,
+                    window, catalog, fmt)
+        else:
+            for meter_row in meter_list:
+                err_count += extract(meter_row, cursor, marks, seeds, window,
+                    catalog, fmt)
+        util.close_cnxn(cursor, cnxn)
     print("\nExtraction finished.")
     if err_count == 0:
         print("No errors encountered.")
     else:
         print("%d of %d IDs failed to process" % (err_count, len(meter_list)))
-    util.close_cnxn(cursor, cnxn)
+    util.report_metrics(metrics_file)
 
-def extract(mtr_row, my_cursor):
+def extract(mtr_row, my_cursor, marks=None, seeds=None, window=None,
+        catalog=None, fmt="csv"):
     """
     Extract reading data for the meter described in MTR_ROW to a csv file in the
     following format:    JCI_meterID_start_end.csv
@@ -79,45 +176,237 @@ def extract(mtr_row, my_cursor):
     the database to the header of the files above.
     Return 0 if succesful, 1 if error(s) occur.
     Uses cursor MY_CURSOR.
+    If MARKS (see util.load_watermarks()) is given, only readings after the
+    meter's high-water mark are extracted, a blank end date means "now", and
+    the mark is moved to the last reading written. Meters without a mark fall
+    back to their entry in SEEDS (see util.get_loaded_watermarks()).
+    If WINDOW is given, the readings are queried one WINDOW-long time window
+    at a time and appended to the same file.
+    The reading type is worked out from the readings as they are written, so
+    the header is added once all readings are in (see datafile.assemble()).
+    Names found in CATALOG (see get_catalog()) are not queried again.
+    The file is written in format FMT (see datafile.FORMATS), whose extension
+    replaces '.csv' above.
+    """
+    plan = plan_extract(mtr_row, my_cursor, marks, seeds, window, catalog, fmt)
+    if not plan:
+        return 1
+    meter_info, windows, output_path = plan
+
+    tracker = datafile.ReadingTypeTracker()
+    with datafile.BodyWriter(datafile.body_path(output_path), fmt) as writer:
+        complete, last = datafile.write_readings(writer, my_cursor, windows,
+            readings_query(mtr_row, my_cursor), tracker, mark_key(mtr_row))
+    return finish_extract(mtr_row, meter_info, output_path, complete, last,
+        tracker, marks)
+
+def extract_group(mtr_rows, my_cursor, marks=None, seeds=None, window=None,
+        catalog=None, fmt="csv"):
+    """
+    Extract the meters described in MTR_ROWS, which share a date range (see
+    group_key()), as extract() does, but with one readings query per time
+    window for all of them (see get_group_readings()). The rows of the query
+    are split into the meters' files as they are fetched (see
+    datafile.DemuxWriter). Meters whose range differs after applying MARKS
+    are queried separately. Return the number of meters that failed.
+    """
+    err_count = 0
+    ranges = collections.OrderedDict()
+    for mtr_row in mtr_rows:
+        plan = plan_extract(mtr_row, my_cursor, marks, seeds, window, catalog,
+            fmt)
+        if not plan:
+            err_count += 1
+            continue
+        members = ranges.setdefault(tuple(plan[1]), collections.OrderedDict())
+        if int(mtr_row[0]) in members:
+            print("Source ID %d is listed twice; extracted once.\n"
+                % (int(mtr_row[0])))
+            continue
+        members[int(mtr_row[0])] = (mtr_row, plan)
+
+    for windows, members in ranges.items():
+        item = "%s+%d" % (mark_key(members.values()[0][0]), len(members) - 1)
+        print("Extracting readings of Source IDs %s ..."
+            % (", ".join(str(meter_id) for meter_id in members)))
+        trackers = dict((meter_id, datafile.ReadingTypeTracker())
+            for meter_id in members)
+        writers = {}
+        try:
+            for meter_id, (mtr_row, plan) in members.items():
+                writers[meter_id] = datafile.BodyWriter(
+                    datafile.body_path(plan[2]), fmt)
+            demux = datafile.DemuxWriter(writers, trackers)
+            complete, last = datafile.write_readings(demux, my_cursor,
+                list(windows), group_query(members.keys(), my_cursor), None,
+                item)
+        finally:
+            for writer in writers.values():
+                writer.close()
+        print("")
+        for meter_id, (mtr_row, plan) in members.items():
+            print("Processing Source ID: %d" % (meter_id))
+            err_count += finish_extract(mtr_row, plan[0], plan[2], complete,
+                demux.last.get(meter_id), trackers[meter_id], marks)
+    return err_count
+
+def plan_extract(mtr_row, my_cursor, marks=None, seeds=None, window=None,
+        catalog=None, fmt="csv"):
+    """
+    First half of extract(), whose arguments these are: describe the meter
+    and work out its time windows and data file. Returns (METER_INFO,
+    WINDOWS, OUTPUT_PATH), or None if the meter cannot be extracted.
     """
     meter_id = int(mtr_row[0])
-    start = mtr_row[1]
-    end = mtr_row[2]
-    unit = mtr_row[3]
-    
+    start, end = get_range(mtr_row)
+    start_op = ">="
+
     print("Processing Source ID: %d" % (meter_id))
-    description = get_description(meter_id, my_cursor)
-    if (not description
-        or not get_reading_type(meter_id, my_cursor, start, end)
-        or not get_commodity(unit, description)
-        or not get_readings(meter_id, start, end, my_cursor)):
+    meter_info = describe(mtr_row, my_cursor, catalog)
+    if not meter_info:
         util.tryNext()
-        return 1
+        return None
+    try:
+        if marks is not None:
+            mark = (marks.get(mark_key(mtr_row))
+                or seeds.get((meter_info[0].lower(), meter_info[1].lower())))
+            start, end, start_op = util.incremental_range(mark, start, end)
+            print("Extracting readings %s '%s' ..." % (start_op, start))
+        windows = util.split_windows(start, end, window, start_op)
+    except ValueError, window_err:
+        print(window_err)
+        util.tryNext()
+        return None
 
-    output_filename = "JCI_%s_%s_%s.csv" % (str(meter_id), start, end)
-    output_path = util.DATA_OUTPUT_FILE_PATH + output_filename
+    if marks is not None:
+        output_filename = "JCI_%s_%s_%s%s" % (str(meter_id),
+            util.file_stamp(start), util.file_stamp(end),
+            datafile.FORMATS[fmt])
+    else:
+        output_filename = "JCI_%s_%s_%s%s" % (str(meter_id), start, end,
+            datafile.FORMATS[fmt])
+    return meter_info, windows, util.DATA_OUTPUT_FILE_PATH + output_filename
 
-    with open(output_path, "wb") as output_file:
-        writer = csv.writer(output_file, delimiter=',')
-        header = [description, unit, commodity, "JCI", reading_type]
-        writer.writerow(header)
-        for row in my_cursor:
-            writer.writerow(["NULL" if r is None else r for r in row])
+def finish_extract(mtr_row, meter_info, output_path, complete, last, tracker,
+        marks=None):
+    """
+    Second half of extract(): once the readings of the meter described in
+    MTR_ROW have been written to the body of OUTPUT_PATH (COMPLETE and LAST
+    as returned by datafile.write_readings(), TRACKER fed with them), add
+    header METER_INFO and move its high-water mark in MARKS. Return 0 if
+    successful, 1 if error(s) occur.
+    """
+    body_path = datafile.body_path(output_path)
+    if not complete:
+        os.remove(body_path)
+        util.tryNext()
+        return 1
+    if marks is not None and last is None:
+        os.remove(body_path)
+        print("No new readings.\n")
+        return 0
+
+    print("Getting reading type ..."),
+    reading_type = tracker.reading_type()
+    if not reading_type:
+        util.fail()
+        print("ERROR: No meter values found in input date range")
+        os.remove(body_path)
+        util.tryNext()
+        return 1
+    util.done()
+    with util.Stage("assemble", mark_key(mtr_row)) as stage:
+        datafile.assemble(output_path, meter_info + [reading_type])
+        stage.count(nbytes=os.path.getsize(output_path))
+    if marks is not None:
+        util.save_watermark(DB, marks, mark_key(mtr_row),
+            util.format_mark(last, 3))
 
     print("Processing finished.\n")
     return 0
 
-def get_description(meter_id, my_cursor):
+def get_range(mtr_row):
+    """
+    Returns the (start_date, end_date) of the meter described in MTR_ROW.
+    """
+    return mtr_row[1], mtr_row[2]
+
+def describe(mtr_row, my_cursor, catalog=None):
+    """
+    Returns the data file header of the meter described in MTR_ROW, minus its
+    reading type: [description, unit, commodity, source system name]. Returns
+    None if any of these cannot be found. Uses cursor MY_CURSOR; names found
+    in CATALOG (see get_catalog()) are not queried again.
+    """
+    with util.Stage("describe", mark_key(mtr_row)) as stage:
+        unit = mtr_row[3]
+        description = get_description(int(mtr_row[0]), my_cursor, catalog)
+        commodity = description and get_commodity(unit, description)
+        if not commodity:
+            stage.fail()
+            return None
+    return [description, unit, commodity, "JCI"]
+
+def readings_query(mtr_row, my_cursor):
+    """
+    Returns a function of (start_date, end_date, start_op) that runs
+    get_readings() for the meter described in MTR_ROW on cursor MY_CURSOR.
+    """
+    meter_id = int(mtr_row[0])
+    return lambda start_date, end_date, start_op: get_readings(meter_id,
+        start_date, end_date, my_cursor, start_op)
+
+def group_key(mtr_row):
+    """
+    Returns what meters extracted by one query (see extract_group()) must
+    share: the date range of the meter described in MTR_ROW.
+    """
+    return get_range(mtr_row)
+
+def group_query(meter_ids, my_cursor):
+    """
+    Returns a function of (start_date, end_date, start_op) that runs
+    get_group_readings() for meters METER_IDS on cursor MY_CURSOR.
+    """
+    return lambda start_date, end_date, start_op: get_group_readings(
+        meter_ids, start_date, end_date, my_cursor, start_op)
+
+def count_readings(mtr_row, slices, my_cursor):
+    """
+    Returns the number of readings of the meter described in MTR_ROW in each
+    of the consecutive (start_date, end_date) time ranges SLICES, counted
+    with a single query on cursor MY_CURSOR. Raises pyodbc.Error if the
+    query fails.
+    """
+    counts = ",\n            ".join(
+        "SUM(CASE WHEN UTCDateTime >= CAST('%s' AS datetime) "
+        "AND UTCDateTime < CAST('%s' AS datetime) THEN 1 ELSE 0 END) AS c%d"
+        % (lo, hi, i) for i, (lo, hi) in enumerate(slices))
+    count_sql = """
+        SELECT %s
+        FROM tblActualValueFloat
+        WHERE UTCDateTime >= CAST('%s' AS datetime)
+        AND UTCDateTime < CAST('%s' AS datetime)
+        AND PointSliceID = %d
+    """ % (counts, slices[0][0], slices[-1][1], int(mtr_row[0]))
+    my_cursor.execute(count_sql)
+    row = my_cursor.fetchone()
+    return [int(c or 0) for c in row]
+
+def get_description(meter_id, my_cursor, catalog=None):
     """
     Returns the string containing the meter description corresponding to METER_ID
     or None if no description can be found or an error occurs. Uses cursor
-    MY_CURSOR
+    MY_CURSOR, unless the description is in CATALOG.
     """
     get_description_sql = """
         SELECT TOP 1 PointName FROM tblPoint WHERE PointID = %d
     """ % (meter_id)
 
     print("Getting meter name ..."),
+    if catalog and str(meter_id) in catalog.get("tblPoint", {}):
+        util.done()
+        return catalog["tblPoint"][str(meter_id)]
     
     try:
         my_cursor.execute(get_description_sql)
@@ -134,62 +423,6 @@ def get_description(meter_id, my_cursor):
         util.done()
         return description_result.PointName
 
-def get_reading_type(meter_id, my_cursor, start_date, end_date):
-    """
-    Returns the reading type of meter METER_ID (Totalization, Interval), using
-    cursor MY_CURSOR. If reading type cannot be determined, return NONE.
-    Readings are limited to those between START_DATE and END_DATE
-    """
-    check_sql = """
-        SELECT TOP 100 ActualValue FROM tblActualValueFloat
-        WHERE PointSliceID = %d
-        AND UTCDateTime >= CAST('%s' AS datetime)
-        AND UTCDateTime < CAST('%s' AS datetime)
-        ORDER BY UTCDateTime ASC
-    """ % (meter_id, start_date, end_date)
-
-    print("Getting reading type ..."),
-
-    try:
-        my_cursor.execute(check_sql)
-    except pyodbc.Error, monotonic_err:
-        util.fail()
-        print(monotonic_err)
-        return None
-    try:
-        if (isMonotonic(my_cursor)):
-            return "Totalization"
-        else:
-            return "Interval"
-    except ValueError, empty_value_err:
-        print(empty_value_err) 
-        return None
-
-def isMonotonic(my_cursor):
-    """
-    Given a list of values stored in cursor MY_CURSOR, return TRUE if values
-    are totalized (i.e. monotonic), FALSE if values are in interval form.
-    """
-    first = my_cursor.fetchone()
-    if not first:
-        util.fail()
-        raise ValueError("ERROR: No meter values found in input date range")
-    else:
-        count = 0
-        prev = first.ActualValue
-        for v in my_cursor:
-            curr = v.ActualValue 
-            diff = curr - prev
-            if (diff < 0):
-                util.done()
-                return False
-            elif (count >= 100):
-                break
-            count += 1
-            prev = curr
-        util.done()
-        return True
-
 def get_commodity(orig_unit, desc):
     """
     Return the commodity type (Water, Gas, Electricity) based on ORIG_UNIT and
@@ -215,20 +448,46 @@ def get_commodity(orig_unit, desc):
         util.done()
         return output
 
-def get_readings(meter_id, start_date, end_date, my_cursor):
+def get_readings(meter_id, start_date, end_date, my_cursor, start_op=">="):
     """
     Run the SQL to get readings for meter METER_ID between START_DATE and
     END_DATE. Return TRUE if successful, FALSE otherwise. The readings are
-    stored in MY_CURSOR for later iteration.
+    stored in MY_CURSOR for later iteration. START_OP compares UTCDateTime to
+    START_DATE ('>=' or '>').
     """
     get_data_sql = """
         SELECT UTCDateTime, ActualValue
         FROM tblActualValueFloat
-        WHERE UTCDateTime >= CAST('%s' AS datetime)
+        WHERE UTCDateTime %s CAST('%s' AS datetime)
         AND UTCDateTime < CAST('%s' AS datetime)
         AND PointSliceID = %d
         ORDER BY UTCDateTime ASC
-    """ % (start_date, end_date, meter_id)
+    """ % (start_op, start_date, end_date, meter_id)
+    print("Getting meter readings ..."),
+    try:
+        my_cursor.execute(get_data_sql)
+        util.done()
+        return True
+    except pyodbc.Error, get_data_err:
+        util.fail()
+        print(get_data_err)
+        return False
+
+def get_group_readings(meter_ids, start_date, end_date, my_cursor,
+        start_op=">="):
+    """
+    As get_readings(), but for all meters METER_IDS at once. The rows are
+    (PointSliceID, UTCDateTime, ActualValue), ordered by meter and time.
+    """
+    get_data_sql = """
+        SELECT PointSliceID, UTCDateTime, ActualValue
+        FROM tblActualValueFloat
+        WHERE UTCDateTime %s CAST('%s' AS datetime)
+        AND UTCDateTime < CAST('%s' AS datetime)
+        AND PointSliceID IN (%s)
+        ORDER BY PointSliceID ASC, UTCDateTime ASC
+    """ % (start_op, start_date, end_date,
+        ", ".join(str(int(meter_id)) for meter_id in meter_ids))
     print("Getting meter readings ..."),
     try:
         my_cursor.execute(get_data_sql)
@@ -243,7 +502,10 @@ def usage():
     """
     Usage message.
     """
-    print("\nUSAGE:  python %s [ FILE.csv ]" % (sys.argv[0]))
+    print("\nUSAGE:  python %s [ --workers N ] [ --incremental ] "
+        "[ --window W ] [ --format F ] [ --batch N | --split ROWS ] "
+        "[ --metrics M ] [ FILE.csv ]"
+        % (sys.argv[0]))
     print("\n\tGiven a file containing JCI meter information, this script")
     print("\textracts reading data into .csv files.")
     print("\nDESCRIPTION")
@@ -254,19 +516,98 @@ def usage():
     print("\n\t\tSourceID, start_date, end_date, unit")
     print("\n\tRows in this file must be in the form dictated by the header " \
         "above\n")
+    print("\nOPTIONS")
+    print("\t--workers N -- extract N meters at the same time, each over its")
+    print("\town connection (default 1).")
+    print("\t--incremental -- extract only readings newer than the last")
+    print("\treading extracted (or loaded) for each meter. end_date may then")
+    print("\tbe left blank to extract up to the current time.")
+    print("\t--window W -- query readings one time window at a time, where W")
+    print("\tis 'month', 'week', 'day' or a number of days. Use this for long")
+    print("\tdate ranges on dense meters.")
+    print("\t--format F -- write the data files as F: 'csv' (default),")
+    print("\t'epoch' (csv with timestamps in microseconds since the Unix")
+    print("\tepoch, cheaper to write and to load), 'gzip' (compressed csv) or")
+    print("\t'binary' (see datafile.py).")
+    print("\t--batch N -- extract up to N meters with the same date range")
+    print("\twith a single query per time window, which saves round trips")
+    print("\twhen many meters are listed.")
+    print("\t--split ROWS -- count each meter's readings first and split its")
+    print("\tdate range into pieces of about ROWS readings, which the workers")
+    print("\textract largest first. Use this when a few dense meters would")
+    print("\totherwise keep one worker busy long after the others are done.")
+    print("\t--metrics M -- append the time, rows and bytes of each stage of")
+    print("\teach meter to file M as JSON lines. A summary per stage is always")
+    print("\tprinted at the end of the run.\n")
 
 def main():
-    arg_len = len(sys.argv)
-    if (arg_len != 2):
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "w:",
+            ["workers=", "incremental", "window=", "format=", "metrics=",
+            "batch=", "split="])
+    except getopt.GetoptError, opt_err:
+        print(opt_err)
+        usage()
+        exit()
+    workers = 1
+    incremental = False
+    window = None
+    fmt = "csv"
+    metrics_file = None
+    batch = 1
+    split = None
+    for opt, val in opts:
+        if opt in ("-w", "--workers"):
+            try:
+                workers = util.get_workers(val)
+            except ValueError:
+                usage()
+                exit()
+        elif opt == "--batch":
+            try:
+                batch = util.get_workers(val)
+            except ValueError:
+                usage()
+                exit()
+        elif opt == "--split":
+            try:
+                split = util.get_workers(val)
+            except ValueError:
+                usage()
+                exit()
+        elif opt == "--metrics":
+            metrics_file = val
+        elif opt == "--incremental":
+            incremental = True
+        elif opt == "--format":
+            try:
+                fmt = datafile.get_format(val)
+            except ValueError, format_err:
+                print(format_err)
+                usage()
+                exit()
+        elif opt == "--window":
+            try:
+                window = util.get_window(val)
+            except ValueError, window_err:
+                print(window_err)
+                usage()
+                exit()
+    if len(args) != 1:
+        usage()
+        exit()
+    if batch > 1 and split:
+        print("ERROR: --batch and --split cannot be used together.\n")
         usage()
         exit()
-    extract_info_file = sys.argv[1] 
+    extract_info_file = args[0]
     if (not os.path.isfile(extract_info_file)):
         print("ERROR: file '%s' not found!\n" % (extract_info_file))
         exit()
     else:
         print("\nUsing file '%s' ...\n" % (extract_info_file))
-    extract_meter_data( extract_info_file )
+    extract_meter_data(extract_info_file, workers, incremental, window, fmt,
+        metrics_file, batch, split)
 
 if __name__ == "__main__":
     main()
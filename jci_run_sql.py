@@ -1,10 +1,13 @@
 """
 Runs the SQL query from a user-supplied input file on the JCI database and
-prints the results.
+writes the results as csv to stdout, or to the output and in the format
+asked for (see export.py). The results can be cached (see sqlcache.py).
 """
 
-import os
+import export
+import getopt
 import pyodbc
+import sqlcache
 import sys
 import util
 
@@ -13,26 +16,75 @@ user = util.METASYS_USER
 pwd = util.METASYS_PWD
 
 def usage():
-    print("USAGE:\n\tpython jci_run_sql.py [YOUR SQL file]\n")
+    print("USAGE:\n\tpython jci_run_sql.py [--format F] [--output PATH] "
+        "[--array-size N] [--header] [--cache] [--refresh] [--no-cache] "
+        "[YOUR SQL file]\n")
+    print("\t--format F -- write the results as 'csv' (the default), 'gzip'")
+    print("\t(gzip'd csv) or 'binary' (columnar, see export.py).")
+    print("\t--output PATH -- write the results to PATH instead of stdout.")
+    print("\t--array-size N -- fetch N rows at a time (default %d)."
+        % (export.ARRAY_SIZE))
+    print("\t--header -- start csv and gzip output with a line of column")
+    print("\tnames.")
+    print("\t--cache -- reuse the results of the same query if it was run in")
+    print("\tthe last hour, or else cache its results. Also turned on by")
+    print("\tsetting %s in the environment." % (sqlcache.CACHE_ENV))
+    print("\t--refresh -- run the query even if its results are cached, and")
+    print("\tcache the new results.")
+    print("\t--no-cache -- neither use nor update the cache.\n")
 
 def main():
-    if len(sys.argv) < 2:
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "",
+            export.OPTIONS + sqlcache.OPTIONS)
+        fmt, output, array_size, header = export.get_options(opts,
+            export.STDOUT)
+    except (getopt.GetoptError, ValueError), opt_err:
+        print(opt_err)
         usage()
         exit()
-    cnxn_str = "DSN=%s;UID=%s;PWD=%s" % (db, user, pwd)
-    cnxn = pyodbc.connect(cnxn_str)
-    cursor = cnxn.cursor()
+    if len(args) != 1:
+        usage()
+        exit()
+    if output == export.STDOUT:
+        # Keep stdout for the results.
+        sys.stdout = sys.stderr
+    use_cache, refresh = sqlcache.get_options(opts)
+    dsn = "DSN=%s;UID=%s" % (db, user)
 
-    f = open(sys.argv[1], 'r')
+    f = open(args[0], 'r')
     my_sql = f.read()
-    cursor.execute(my_sql)
 
-    for r in cursor:
-        print(r)
+    cached = None
+    if use_cache and not refresh:
+        cached = sqlcache.load(my_sql, dsn)
+    cnxn = None
+    if cached:
+        columns, batches = cached
+    else:
+        cnxn_str = "DSN=%s;UID=%s;PWD=%s" % (db, user, pwd)
+        cnxn = pyodbc.connect(cnxn_str)
+        cursor = cnxn.cursor()
+        cursor.arraysize = array_size
+        with util.Stage("query", args[0]):
+            cursor.execute(my_sql)
+        batches = None
+        if cursor.description:
+            columns = [d[0] for d in cursor.description]
+            batches = util.fetch_batches(cursor, array_size)
+            if use_cache:
+                batches = sqlcache.store(my_sql, dsn, columns, batches)
+
+    if batches:
+        export.export(columns, batches, output, fmt, args[0], header)
+    else:
+        print("SQL query returned no results.\n")
 
-    cursor.close()
-    del cursor
-    cnxn.close()
+    if cnxn:
+        cursor.close()
+        del cursor
+        cnxn.close()
+    util.report_metrics()
 
 if __name__ == "__main__":
     main()
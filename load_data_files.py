@@ -4,15 +4,25 @@ Loads the energy data csv files acquired through the loader scripts
 energy database.
 """
 
-import csv
+import datafile
+import datetime
+import getopt
+import itertools
+import json
+import multiprocessing
 import os
 import pyodbc
+import signal
 import sys
+import threading
+import time
 import util
+import validate
+import watch
 
 DB = util.PG_DB
 USER = util.PG_USER
-PWD = uti.PG_PWD
+PWD = util.PG_PWD
 
 # Default data directory if none is supplied at script invocation.
 DEFAULT_DATA_DIR = util.DATA_OUTPUT_FILE_PATH
@@ -20,6 +30,56 @@ DEFAULT_DATA_DIR = util.DATA_OUTPUT_FILE_PATH
 # Default processed data directory if none is supplied at script invocation.
 DEFAULT_PROCESSED_DIR = DEFAULT_DATA_DIR + "processed/"
 
+# Number of readings sent in one INSERT statement by stream_values().
+INSERT_BATCH = 1000
+
+# Session table that merge_values() stages readings in.
+MERGE_TABLE = "merge_stage"
+
+# Rollup tables kept by update_rollups(), with the date_trunc() unit of
+# their buckets. Each is built from the one before it.
+ROLLUPS = [("meter_value_hourly", "hour"), ("meter_value_daily", "day")]
+
+# Layouts of a partitioned 'meter_value' table: monthly range partitions, or
+# monthly range partitions each split into HASH_PARTITIONS by meter.
+PARTITION_LAYOUTS = ("month", "meter-month")
+
+# Number of meter hash partitions of each month in the 'meter-month' layout.
+HASH_PARTITIONS = 8
+
+# Names of the 'meter_value' partitions this process knows to exist.
+known_partitions = set()
+
+# TRUE once this process has made sure the ROLLUPS tables exist.
+rollups_created = False
+
+# Journal of the state of each data file's load, one JSON line per change
+# (see record_load()), so that an interrupted run can be resumed.
+JOURNAL_FILE = os.path.join(util.STATE_DIR, "load_journal.jsonl")
+
+# Database cursor of a load_files() worker process, opened by load_job().
+job_cursor = None
+
+# IDs of the small lookup tables read by get_id(), keyed by (table, field),
+# then by the lowercase field value.
+id_cache = {}
+
+# Seconds watch_data() waits for new files before checking whether it was
+# asked to stop.
+WATCH_TIMEOUT = 1.0
+
+# Seconds watch_data() waits before connecting again after a failed attempt.
+RECONNECT_DELAY = 30.0
+
+def get_layout(value):
+    """
+    Returns VALUE, the argument of a '--partition' option, if it is one of
+    PARTITION_LAYOUTS. Raises ValueError otherwise.
+    """
+    if value not in PARTITION_LAYOUTS:
+        raise ValueError("ERROR: Unknown partition layout '%s'.\n" % (value))
+    return value
+
 def tryNext():
     """
     Print 'Trying next meter in list ...'
@@ -34,21 +94,14 @@ def exec_and_commit(my_cursor, sql_stmt):
     my_cursor.execute(sql_stmt)
     my_cursor.commit()
 
-def drop_tmp_table(my_cursor, table_name):
-    """
-    Drop temporary table TABLE_NAME using cursor MY_CURSOR.
-    """
-    print("Deleting temporary table '%s' ..." % (table_name)),
-    dele_sql = "DROP TABLE IF EXISTS %s" % (table_name)
-    exec_and_commit(my_cursor, dele_sql)
-    util.done()
-
 def get_data_files(datadir):
     """
-    Return a list of the absolute path to the files in DATADIR.
+    Return a list of the absolute path to the files in DATADIR, leaving out
+    files that a getter is still writing.
     """
     return [os.path.join(datadir, f) for f in os.listdir(datadir)
-        if os.path.isfile(os.path.join(datadir, f))]
+        if os.path.isfile(os.path.join(datadir, f))
+        and not f.endswith(datafile.PARTIAL_SUFFIX)]
 
 def get_header(data_file):
     """
@@ -56,44 +109,428 @@ def get_header(data_file):
     DESCRIPTION, ORIGINAL UNIT, COMMODITY, SOURCE SYSTEM NAME, READING TYPE
     NOTE: call this ONLY once per data file.
     """
-    with open(data_file, "rb") as f:
-        reader = csv.reader(f)
-        header = reader.next()
-        if len(header) != 5:
-            raise ValueError("Incorrect file header")
-        return header
+    header = datafile.read_header(data_file)
+    if len(header) != 5:
+        raise ValueError("Incorrect file header")
+    return header
+
+def journal_key(data_file):
+    """
+    Return the key of DATA_FILE in the load journal: its name and size, so
+    that a different file arriving later under the same name is not taken
+    for one already loaded.
+    """
+    return "%s:%d" % (os.path.basename(data_file), os.path.getsize(data_file))
+
+def read_journal():
+    """
+    Return the latest load journal entry of each data file, keyed by
+    journal_key(). An entry is a dict whose 'state' is 'loading' (its
+    transaction was begun, in which the meter 'meter_id' was created, if
+    any), 'loaded' (committed) or 'done' (moved to the processed directory).
+    A line cut short by a crash is ignored.
+    """
+    journal = {}
+    if not os.path.isfile(JOURNAL_FILE):
+        return journal
+    with open(JOURNAL_FILE, "rb") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            journal[entry["key"]] = entry
+    return journal
 
-def load_files(file_list, mycursor, process_dir):
+def compact_journal(journal):
+    """
+    Rewrite the load journal with only the entries of JOURNAL, as returned
+    by read_journal(), whose files are not done, and return those.
+    """
+    journal = dict((key, entry) for key, entry in journal.items()
+        if entry["state"] != "done")
+    if not os.path.isdir(util.STATE_DIR):
+        os.makedirs(util.STATE_DIR)
+    tmp_path = JOURNAL_FILE + ".tmp"
+    with open(tmp_path, "wb") as f:
+        for key in sorted(journal):
+            f.write(json.dumps(journal[key], sort_keys=True) + "\n")
+    os.rename(tmp_path, JOURNAL_FILE)
+    return journal
+
+def record_load(key, state, meter_id=None):
+    """
+    Append the new STATE (see read_journal()) of the data file with journal
+    key KEY to the load journal, and flush it to disk. Lines are short and
+    appended in one write, so worker processes can share the file.
+    """
+    entry = {"key": key, "state": state, "run": util.RUN_STARTED}
+    if meter_id is not None:
+        entry["meter_id"] = meter_id
+    with open(JOURNAL_FILE, "ab") as f:
+        f.write(json.dumps(entry, sort_keys=True) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+def committed(entry, mycursor):
+    """
+    Returns TRUE if the load recorded by journal entry ENTRY was committed:
+    its state is 'loaded', or it is 'loading' and the meter created in its
+    transaction exists. Uses cursor MYCURSOR.
+    """
+    if entry["state"] == "loaded":
+        return True
+    if entry["state"] != "loading" or "meter_id" not in entry:
+        return False
+    sql = "SELECT id FROM meter WHERE id = %d" % (entry["meter_id"])
+    found = mycursor.execute(sql).fetchone() is not None
+    mycursor.rollback()
+    return found
+
+def load_files(file_list, mycursor, process_dir, options=None, jobs=1,
+        metrics_file=None, stop=None):
     """
     Load the data files in FILE_LIST into the database with cursor MYCURSOR
     Data files are moved to PROCESS_DIR if they are
-    loaded successfully.
+    loaded successfully. OPTIONS is as in load().
+    If JOBS is greater than 1, the files are spread over that many worker
+    processes, each with its own connection, and MYCURSOR is not used.
+    The time spent in each stage is summed up at the end and, if
+    METRICS_FILE is given, appended to it (see util.report_metrics()).
+    The state of each file's load is kept in the load journal, so a run
+    that was interrupted can simply be started again: files it committed
+    are moved without being loaded again (see load()). Files that are gone
+    by the time they are loaded are skipped.
+    If event STOP is given, no more files are loaded once it is set; it is
+    only checked between files, and only if JOBS is 1.
+    Returns the number of files that could not be loaded.
     """
     err_count = 0
+    journal = compact_journal(read_journal())
+    files = []
     for f in file_list:
-        print("Processing file '%s'" % (f))
-        err_count += load(f, mycursor, process_dir)
+        try:
+            files.append((f, journal.get(journal_key(f))))
+        except OSError:
+            # Moved or removed since it was listed.
+            print("File '%s' is gone; skipped." % (f))
+    entries = [entry for f, entry in files]
+    if any(entries):
+        print("Resuming the loads of %d files recorded in '%s'.\n"
+            % (len([e for e in entries if e]), JOURNAL_FILE))
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs)
+        try:
+            # A timeout lets Ctrl-C interrupt the wait in Python 2.
+            results = pool.map_async(load_job,
+                [(f, process_dir, options, entry) for f, entry in files],
+                chunksize=1).get(365 * 24 * 60 * 60)
+        except BaseException:
+            pool.terminate()
+            pool.join()
+            raise
+        pool.close()
+        pool.join()
+        for errors, records in results:
+            err_count += errors
+            util.merge_metrics(records)
+    else:
+        for f, entry in files:
+            if stop is not None and stop.is_set():
+                print("\nStopped before loading the rest of the files.")
+                break
+            print("Processing file '%s'" % (f))
+            err_count += load(f, mycursor, process_dir, options, entry)
     print
     if (err_count == 0):
         print("All files loaded into database.")
     else:
         print("%d of %d files could not be loaded into the database\n"
                 % (err_count, len(file_list)))
+    util.report_metrics(metrics_file)
+    return err_count
+
+def watch_data(data_dir, process_dir, options=None, metrics_file=None,
+        poll=False):
+    """
+    Load the data files in DATA_DIR as they arrive, until SIGTERM or SIGINT
+    (Ctrl-C) is received, moving those loaded to PROCESS_DIR. Files already
+    there are loaded first. New files are found with watch.watcher() (by
+    polling if POLL is TRUE) and loaded with load_files(), whose OPTIONS and
+    METRICS_FILE these are, as soon as they are ready, over one connection
+    kept open throughout, so that the ID and partition caches stay warm.
+
+    A signal lets the file being loaded finish; a second one interrupts it,
+    which the load journal recovers from (see load()). A file that fails is
+    not tried again until it changes or the script is restarted, unless the
+    connection was lost, in which case the connection is made again.
+    """
+    stop = threading.Event()
+
+    def request_stop(signum, frame):
+        if stop.is_set():
+            raise KeyboardInterrupt
+        print("\nStopping once the current file is loaded ...")
+        stop.set()
+
+    handlers = dict((signum, signal.signal(signum, request_stop))
+        for signum in (signal.SIGINT, signal.SIGTERM))
+    watcher = watch.watcher(data_dir, poll)
+    cnxn_str = "DSN=%s;UID=%s;PWD=%s" % (DB, USER, PWD)
+    cnxn = None
+    failed = set()
+    pending = get_data_files(data_dir)
+    print("Watching '%s' for data files. Press Ctrl-C to stop.\n"
+        % (data_dir))
+    try:
+        while not stop.is_set():
+            files = sorted(f for f, key in ready_keys(pending).items()
+                if key not in failed)
+            if files and cnxn is None:
+                try:
+                    print("Connecting to database ..."),
+                    cnxn = pyodbc.connect(cnxn_str)
+                    cursor = cnxn.cursor()
+                    util.done()
+                except pyodbc.Error, conn_err:
+                    util.fail()
+                    print(conn_err)
+                    stop.wait(RECONNECT_DELAY)
+                    continue
+            if files:
+                errors = load_files(files, cursor, process_dir, options,
+                    metrics_file=metrics_file, stop=stop)
+                left = [f for f in files if os.path.isfile(f)]
+                if errors and not connected(cursor):
+                    print("Lost the connection to the database.")
+                    cnxn = None
+                    pending = left
+                    continue
+                if not stop.is_set():
+                    failed.update(ready_keys(left).values())
+                print("\nWaiting for data files ...\n")
+            pending = watcher.wait(WATCH_TIMEOUT)
+    finally:
+        watcher.close()
+        for signum, handler in handlers.items():
+            signal.signal(signum, handler)
+        if cnxn is not None:
+            try:
+                util.close_cnxn(cursor, cnxn)
+            except pyodbc.Error, close_err:
+                print(close_err)
+    print("Stopped watching '%s'." % (data_dir))
+
+def ready_keys(paths):
+    """
+    Return the load journal keys (see journal_key()) of the files in PATHS
+    that are ready to be loaded (see watch.is_ready()), by path. Files that
+    are gone by the time they are looked at are left out.
+    """
+    keys = {}
+    for path in set(paths):
+        try:
+            if watch.is_ready(path):
+                keys[path] = journal_key(path)
+        except OSError:
+            # Moved or removed since it was seen.
+            continue
+    return keys
+
+def connected(mycursor):
+    """
+    Returns TRUE if the connection of cursor MYCURSOR still works.
+    """
+    try:
+        mycursor.execute("SELECT 1").fetchall()
+        mycursor.rollback()
+        return True
+    except pyodbc.Error:
+        return False
 
-def load(data_file, mycursor, process_dir):
+def load_job(job):
+    """
+    Load one data file in a load_files() worker process. JOB is a
+    (data_file, process_dir, options, entry) tuple of arguments for load(). The
+    process connects to the database on its first job and keeps the
+    connection for the jobs after it.
+    Returns (ERRORS, RECORDS): ERRORS is 0 if successful, 1 on error, and
+    RECORDS the job's stage timings (see util.take_metrics()).
+    """
+    global job_cursor
+    data_file, process_dir, options, entry = job
+    print("Processing file '%s'" % (data_file))
+    if job_cursor is None:
+        try:
+            cnxn = pyodbc.connect("DSN=%s;UID=%s;PWD=%s" % (DB, USER, PWD))
+        except pyodbc.Error, conn_err:
+            print(conn_err)
+            tryNext()
+            return 1, util.take_metrics()
+        job_cursor = cnxn.cursor()
+    errors = load(data_file, job_cursor, process_dir, options, entry)
+    return errors, util.take_metrics()
+
+def load(data_file, mycursor, process_dir, options=None, entry=None):
     """
     Loads the contents of DATA_FILE's header into the 'meter' table.
     Also loads the readings in the file into the 'meter_value' table.
     Afterwards, moves DATA_FILE to PROCESS_DIR.
     Returns 0 if successful, 1 on error.
     Uses cursor MYCURSOR.
+
+    The meter, its readings and its rollups are committed in one
+    transaction, so a file that fails, or a run that is interrupted, leaves
+    nothing of the file behind. Each step is recorded in the load journal
+    (see record_load()); ENTRY is the file's entry from an earlier run, if
+    any (see read_journal()). A file whose load was committed but not moved
+    is only moved.
+
+    OPTIONS is a dict of the following, all off by default:
+        stream -- load readings with stream_values() rather than with
+                  load_values(). Files that are not plain csv, which the
+                  server cannot COPY, are always streamed.
+        reload -- reuse a matching meter (see register_meter()) and merge
+                  the readings with merge_values(), so that loading a file
+                  again, or one that overlaps it, adds no duplicates.
+        validate -- a validation mode (see validate.py) to check and clean
+                  the readings in first. The cleaned readings are streamed.
+        partition -- the layout (one of PARTITION_LAYOUTS) of a partitioned
+                  'meter_value' table. Missing partitions are created for
+                  the readings loaded (see ensure_partitions()).
     """
+    options = options or {}
+    try:
+        key = journal_key(data_file)
+    except OSError, stat_err:
+        # Moved or removed since it was listed.
+        print(stat_err)
+        tryNext()
+        return 1
+    if entry:
+        try:
+            loaded = committed(entry, mycursor)
+        except pyodbc.Error, journal_err:
+            print(journal_err)
+            tryNext()
+            return 1
+        if loaded:
+            print("Loaded by an earlier run.")
+            util.move(data_file, process_dir)
+            record_load(key, "done")
+            return 0
+
     try:
         header = get_header(data_file)
-    except ValueError, badHeader:
+    except (ValueError, IOError), badHeader:
         print(badHeader)
         tryNext()
         return 1
+
+    readings = None
+    if options.get("validate"):
+        readings = check_readings(data_file, header[4], options["validate"],
+            process_dir)
+        if readings is None:
+            tryNext()
+            return 1
+
+    if not rollups_created:
+        try:
+            create_rollup_tables(mycursor)
+        except pyodbc.Error, rollup_err:
+            # Reported again, per file, by refresh_rollups(). The failed
+            # statement must not abort the file's transaction.
+            mycursor.rollback()
+            print(rollup_err)
+
+    with util.Stage("register", os.path.basename(data_file)) as stage:
+        meter_id = register_meter(header, mycursor, options.get("reload"))
+        if (meter_id == -1):
+            stage.fail()
+    if (meter_id == -1):
+        mycursor.rollback()
+        tryNext()
+        return 1
+    print("Meter ID: %d" % (meter_id))
+    # A reused meter already exists, so it cannot tell whether the load
+    # was committed; merging the file again is harmless.
+    record_load(key, "loading",
+        None if options.get("reload") else meter_id)
+
+    span = []
+    layout = options.get("partition")
+    if options.get("reload"):
+        loaded = merge_values(meter_id, data_file, mycursor, readings, span,
+            layout)
+    elif (options.get("stream") or readings is not None
+            or datafile.file_format(data_file) != "csv"):
+        loaded = stream_values(meter_id, data_file, mycursor, readings, span,
+            layout)
+    else:
+        loaded = load_values(meter_id, data_file, mycursor, span, layout)
+    if loaded and span:
+        refresh_rollups(meter_id, span, header[4], mycursor,
+            os.path.basename(data_file))
+    if loaded:
+        try:
+            mycursor.commit()
+        except pyodbc.Error, commit_err:
+            print(commit_err)
+            loaded = False
+    if not loaded:
+        mycursor.rollback()
+        known_partitions.clear()
+        print("Nothing of '%s' was loaded." % (data_file))
+        tryNext()
+        return 1
+    record_load(key, "loaded")
+    util.move(data_file, process_dir)
+    record_load(key, "done")
+    return 0
+
+def check_readings(data_file, reading_type, mode, process_dir):
+    """
+    Check and clean the readings of DATA_FILE, whose meter has reading type
+    READING_TYPE, in validation mode MODE and print what was found (see
+    validate.py). Rows quarantined are written under PROCESS_DIR.
+    Returns the cleaned (timestamp, reading) pairs, or None on error.
+    """
+    print("Validating readings ..."),
+
+    with util.Stage("validate", os.path.basename(data_file)) as stage:
+        try:
+            stamps, values, rejects, report = validate.check(data_file,
+                reading_type, mode)
+            if rejects:
+                quarantine_path = validate.quarantine(data_file, rejects,
+                    process_dir)
+        except (ValueError, IOError), validate_err:
+            stage.fail()
+            util.fail()
+            print(validate_err)
+            return None
+        stage.count(report["rows"], os.path.getsize(data_file))
+    util.done()
+    print("%(rows)d readings: %(out of order)d out of order, %(duplicate)d "
+        "duplicate, %(sentinel)d sentinel, %(rollback)d rollback, "
+        "%(NULL run)d NULL runs (longest %(longest NULL run)d), %(gap)d gaps."
+        % report)
+    print("%d readings removed (%s)." % (report["removed"], mode))
+    if rejects:
+        print("Removed readings written to '%s'." % (quarantine_path))
+    return validate.to_readings(stamps, values)
+
+def register_meter(header, mycursor, reuse=False):
+    """
+    Insert the meter described by data file header HEADER into the 'meter'
+    table and return the meter ID created, or -1 on error.
+    If REUSE is TRUE and a meter with the same description, unit, commodity
+    and source system already exists, its ID is returned instead. The reading
+    type is left out of the match, since it is judged from whichever
+    readings a file happens to hold.
+    Uses cursor MYCURSOR.
+    """
     description     = header[0]
     orig_unit       = header[1]
     commodity       = header[2]
@@ -108,52 +545,91 @@ def load(data_file, mycursor, process_dir):
         reading_type_id     = get_id(reading_type, "reading_type", "name"
             , mycursor)
         print("\nID collection finished.\n") 
+        if (reuse and unit_id != -1 and commodity_id != -1
+                and source_system_id != -1):
+            existing_id = find_meter(description, unit_id, commodity_id,
+                source_system_id, mycursor)
+            if (existing_id != -1):
+                return existing_id
     except pyodbc.Error, general_err:
         print("SQL ERROR!")
         print(general_err)
-        tryNext()
-        return 1 
+        return -1
     if (unit_id == -1 or commodity_id == -1 or source_system_id == -1
             or reading_type_id == -1):
         print("ERROR: Some IDs not found!")
-        tryNext()
-        return 1
+        return -1
     l = [description, unit_id, commodity_id, source_system_id, reading_type_id]
 
-    meter_id = load_ids(l, mycursor)
-    if (meter_id == -1):
-        return 1
-    print("Meter ID: %d" % (meter_id))
+    return load_ids(l, mycursor)
 
-    if not load_values(meter_id, data_file, mycursor):
-        print("NOTE! Meter ID (%d) created for '%s'" % (meter_id, data_file))
-        return 1
-    else:
-        util.move(data_file, process_dir)
-        return 0
+def find_meter(description, unit_id, commodity_id, source_system_id,
+        mycursor):
+    """
+    Returns the ID of the oldest meter in the 'meter' table with DESCRIPTION,
+    UNIT_ID, COMMODITY_ID and SOURCE_SYSTEM_ID, or -1 if there is none.
+    Uses cursor MYCURSOR.
+    """
+    sql = """
+        SELECT      id
+        FROM        meter
+        WHERE       description = ?
+        AND         unit_id = %d
+        AND         commodity_id = %d
+        AND         source_system_id = %d
+        ORDER BY    id
+        LIMIT       1
+    """ % (unit_id, commodity_id, source_system_id)
+
+    print("Looking for existing meter ..."),
+
+    result = mycursor.execute(sql, description).fetchone()
+    util.done()
+    if not result:
+        return -1
+    print("Reusing meter ID %d" % (result.id))
+    return result.id
 
 def get_id(item, table, field, mycursor):
     """
     Returns the ID from table TABLE whose FIELD is "ilike" to ITEM. Uses
     cursor MYCURSOR. If no ID is found, returns -1.
+    The whole table is cached on first use (see load_id_cache()) and read
+    again only when ITEM is not in the cache.
     """
-    sql = "SELECT id FROM %s WHERE %s ILIKE '%s' LIMIT 1" % (table, field, item)
-
     print("Getting %s ID ..." % (table)),
-    
-    mycursor.execute(sql)
-    result = mycursor.fetchone()
-    if not result:
+
+    key = (table, field)
+    if key not in id_cache or item.lower() not in id_cache[key]:
+        load_id_cache(table, field, mycursor)
+    result = id_cache[key].get(item.lower())
+    if result is None:
         util.fail()
         return -1
     else:
         util.done()
-        return result.id
+        return result
+
+def load_id_cache(table, field, mycursor):
+    """
+    Read the ID and FIELD of every row in table TABLE into 'id_cache', keyed
+    by the lowercase FIELD value so lookups are case-insensitive like ILIKE.
+    When several rows share a value, the first one read is kept.
+    Uses cursor MYCURSOR.
+    """
+    sql = "SELECT id, %s AS name FROM %s ORDER BY id" % (field, table)
+
+    ids = {}
+    for row in mycursor.execute(sql).fetchall():
+        if row.name is not None:
+            ids.setdefault(row.name.lower(), row.id)
+    id_cache[(table, field)] = ids
 
 def load_ids(id_list, mycursor):
     """
     Insert ID list ID_LIST into the 'meter' table and return the meter ID
-    created by the insertion. Returns -1 in case of failure.
+    created by the insertion. Returns -1 in case of failure. Nothing is
+    committed.
     The order of ID_LIST is as follows:
     [ description, unit_id, commodity_id, source_system_id, reading_type_id ]
     Uses cursor MYCURSOR.
@@ -174,8 +650,7 @@ def load_ids(id_list, mycursor):
     print("Inserting ID's into 'meter' table ..."),
     
     try:
-        exec_and_commit(mycursor, sql)
-        result = mycursor.fetchone()
+        result = mycursor.execute(sql).fetchone()
         util.done()
         return result.id
     except pyodbc.Error, get_meter_id_err:
@@ -183,49 +658,415 @@ def load_ids(id_list, mycursor):
         print(get_meter_id_err)
         return -1
 
-def load_values(m_id, data_file, mycursor):
+def load_values(m_id, data_file, mycursor, span=None, layout=None):
     """
     Insert reading values into the 'meter_value' table from DATA_FILE for a
     meter with id M_ID. Returns TRUE if successful, FALSE otherwise.
-    Uses cursor MYCURSOR.
+    Uses cursor MYCURSOR. If list SPAN is given, it is set to the
+    [first, last] timestamps loaded (left empty if there were none).
+    If LAYOUT is given, 'meter_value' is partitioned that way (see
+    ensure_partitions()). Nothing is committed; the temporary table the
+    file is copied into is dropped at the end of the transaction.
     """
     
     print("Begin inserting readings into 'meter_value' table ...\n")
+    item = os.path.basename(data_file)
     tbl = "tmp_%d" % (m_id)
-    if not create_temp_table(tbl, mycursor):
+    epoch = datafile.epoch_stamps(data_file)
+    if not create_temp_table(tbl, mycursor, epoch):
         return False
-    if not copy_data(data_file, tbl, mycursor):
-        drop_tmp_table(mycursor, tbl)
+    with util.Stage("copy", item) as stage:
+        copied = copy_data(data_file, tbl, mycursor)
+        if copied and epoch:
+            copied = convert_epoch(tbl, mycursor)
+        stage.count(nbytes=os.path.getsize(data_file))
+        if not copied:
+            stage.fail()
+    if not copied:
         return False
     if not add_id_col(m_id, tbl, mycursor):
-        drop_tmp_table(mycursor, tbl)
         return False
-    if not insert_table(tbl, mycursor):
-        drop_tmp_table(mycursor, tbl)
+    if layout and not ensure_table_partitions(tbl, layout, mycursor):
+        return False
+    with util.Stage("insert", item) as stage:
+        inserted = insert_table(tbl, mycursor)
+        if inserted:
+            stage.count(mycursor.rowcount)
+        else:
+            stage.fail()
+    if not inserted:
         return False
+    if span is not None:
+        row = mycursor.execute("SELECT MIN(time_stamp_utc) AS first, "
+            "MAX(time_stamp_utc) AS last FROM %s" % (tbl)).fetchone()
+        if row.first is not None:
+            span[:] = [row.first, row.last]
 
     print("\nReading insertion finished.\n")
-    drop_tmp_table(mycursor, tbl)
     return True
 
-def create_temp_table(table_name, mycursor):
+def stream_values(m_id, data_file, mycursor, readings=None, span=None,
+        layout=None):
+    """
+    Insert reading values into the 'meter_value' table from DATA_FILE for a
+    meter with id M_ID. The file is read on the client and its readings are
+    sent INSERT_BATCH rows at a time, all in one transaction, so the server
+    needs no access to DATA_FILE and no temporary table is made. Nothing is
+    committed.
+    If READINGS is given, those (timestamp, reading) pairs are inserted
+    instead of the file's (see check_readings()). SPAN and LAYOUT are as in
+    load_values().
+    Returns TRUE if successful, FALSE otherwise. Uses cursor MYCURSOR.
+    """
+    if readings is None:
+        readings = datafile.read_readings(data_file)
+    if span is not None:
+        readings = track_span(readings, span)
+    print("Streaming readings into 'meter_value' table ..."),
+
+    with util.Stage("stream", os.path.basename(data_file)) as stage:
+        try:
+            count = insert_readings(m_id, readings, mycursor, layout=layout)
+        except pyodbc.Error, stream_err:
+            stage.fail()
+            util.fail()
+            print(stream_err)
+            return False
+        stage.count(count, os.path.getsize(data_file))
+    util.done()
+    print("%d readings inserted.\n" % (count))
+    return True
+
+def merge_values(m_id, data_file, mycursor, readings=None, span=None,
+        layout=None):
+    """
+    Merge reading values from DATA_FILE into the 'meter_value' table for a
+    meter with id M_ID. The readings are streamed into the session's
+    MERGE_TABLE and merged with one set-based INSERT ... ON CONFLICT:
+    readings already present are kept unless their value changed. Of
+    readings with the same timestamp within the file, the last one is kept,
+    as validate.py's 'repair' mode does. Nothing is committed.
+    Needs a unique index on meter_value (meter_id, time_stamp_utc).
+    READINGS, SPAN and LAYOUT are as in stream_values().
+    Returns TRUE if successful, FALSE otherwise. Uses cursor MYCURSOR.
+    """
+    if readings is None:
+        readings = datafile.read_readings(data_file)
+    if span is not None:
+        readings = track_span(readings, span)
+    create_sql = """
+        CREATE TEMPORARY TABLE IF NOT EXISTS %s
+        (
+            pos             BIGSERIAL,
+            meter_id        INTEGER,
+            time_stamp_utc  TIMESTAMP,
+            reading         NUMERIC
+        ) ON COMMIT DELETE ROWS
+    """ % (MERGE_TABLE)
+    merge_sql = """
+        INSERT INTO meter_value (meter_id, time_stamp_utc, reading)
+        SELECT DISTINCT ON (time_stamp_utc) meter_id, time_stamp_utc, reading
+        FROM        %s
+        ORDER BY    time_stamp_utc, pos DESC
+        ON CONFLICT (meter_id, time_stamp_utc) DO UPDATE
+        SET         reading = EXCLUDED.reading
+        WHERE       meter_value.reading IS DISTINCT FROM EXCLUDED.reading
+    """ % (MERGE_TABLE)
+
+    print("Merging readings into 'meter_value' table ..."),
+
+    with util.Stage("merge", os.path.basename(data_file)) as stage:
+        try:
+            mycursor.execute(create_sql)
+            count = insert_readings(m_id, readings, mycursor, MERGE_TABLE)
+            if layout:
+                ensure_partitions(table_months(MERGE_TABLE, mycursor),
+                    layout, mycursor)
+            mycursor.execute(merge_sql)
+            merged = mycursor.rowcount
+        except pyodbc.Error, merge_err:
+            stage.fail()
+            util.fail()
+            print(merge_err)
+            return False
+        stage.count(count, os.path.getsize(data_file))
+    util.done()
+    print("%d of %d readings were new or changed.\n" % (merged, count))
+    return True
+
+def insert_readings(m_id, readings, mycursor, table="meter_value",
+        layout=None):
+    """
+    Insert the (timestamp, reading) pairs in READINGS into table TABLE (by
+    default 'meter_value') for a meter with id M_ID, INSERT_BATCH rows per
+    statement. Nothing is committed. Returns the number of readings inserted.
+    If LAYOUT is given, the partitions each batch needs are created first
+    (see ensure_partitions()). Uses cursor MYCURSOR.
+    """
+    readings = iter(readings)
+    count = 0
+    while True:
+        batch = list(itertools.islice(readings, INSERT_BATCH))
+        if not batch:
+            return count
+        if layout:
+            ensure_partitions(set(str(r[0])[:7] for r in batch), layout,
+                mycursor)
+        sql = """
+            INSERT INTO %s (meter_id, time_stamp_utc, reading)
+            VALUES %s
+        """ % (table, ",".join(["(%d, CAST(? AS TIMESTAMP), CAST(? AS NUMERIC))"
+            % (m_id)] * len(batch)))
+        mycursor.execute(sql, [v for reading in batch for v in reading])
+        count += len(batch)
+
+def partition_name(month):
+    """
+    Return the name of the 'meter_value' partition of MONTH ('YYYY-MM').
+    """
+    return "meter_value_%s" % (month.replace("-", "_"))
+
+def ensure_partitions(months, layout, mycursor):
+    """
+    Create the partitions of 'meter_value' for the MONTHS ('YYYY-MM' strings)
+    that do not exist yet, in partition layout LAYOUT (see
+    PARTITION_LAYOUTS). Nothing is committed, so a caller that rolls back
+    must clear 'known_partitions'. Uses cursor MYCURSOR.
+    """
+    for month in sorted(set(months)):
+        table = partition_name(month)
+        if table in known_partitions:
+            continue
+        start = datetime.datetime.strptime(month, "%Y-%m")
+        sql = """
+            CREATE TABLE IF NOT EXISTS %s PARTITION OF meter_value
+            FOR VALUES FROM ('%s') TO ('%s')
+        """ % (table, start, util.next_window(start, "month"))
+        if layout == "meter-month":
+            sql += " PARTITION BY HASH (meter_id)"
+        mycursor.execute(sql)
+        if layout == "meter-month":
+            for i in range(HASH_PARTITIONS):
+                mycursor.execute("""
+                    CREATE TABLE IF NOT EXISTS %s_h%d PARTITION OF %s
+                    FOR VALUES WITH (MODULUS %d, REMAINDER %d)
+                """ % (table, i, table, HASH_PARTITIONS, i))
+        known_partitions.add(table)
+
+def table_months(table, mycursor):
+    """
+    Return the months ('YYYY-MM') of the readings in table TABLE.
+    Uses cursor MYCURSOR.
+    """
+    sql = """
+        SELECT DISTINCT to_char(time_stamp_utc, 'YYYY-MM') AS month
+        FROM %s
+        WHERE time_stamp_utc IS NOT NULL
+    """ % (table)
+    return [row.month for row in mycursor.execute(sql).fetchall()]
+
+def ensure_table_partitions(table, layout, mycursor):
+    """
+    Create the 'meter_value' partitions, in layout LAYOUT, needed by the
+    readings in table TABLE. Nothing is committed (see ensure_partitions()).
+    Returns TRUE if successful, FALSE otherwise. Uses cursor MYCURSOR.
+    """
+    print("Creating missing partitions of 'meter_value' ..."),
+
+    try:
+        ensure_partitions(table_months(table, mycursor), layout, mycursor)
+    except pyodbc.Error, partition_err:
+        util.fail()
+        print(partition_err)
+        return False
+    util.done()
+    return True
+
+def track_span(readings, span):
+    """
+    Yield the (timestamp, reading) pairs in READINGS, setting list SPAN to
+    [first, last], the earliest and latest timestamps yielded so far.
+    """
+    for reading in readings:
+        if not span:
+            span[:] = [reading[0], reading[0]]
+        elif reading[0] < span[0]:
+            span[0] = reading[0]
+        elif reading[0] > span[1]:
+            span[1] = reading[0]
+        yield reading
+
+def refresh_rollups(m_id, span, reading_type, mycursor, item=None):
+    """
+    Update the rollups of meter M_ID, whose reading type is READING_TYPE, for
+    the readings from SPAN[0] to SPAN[1] just loaded (see update_rollups()).
+    Nothing is committed. A failure is reported but not returned: the update
+    is undone back to a savepoint, so that the readings can still be
+    committed. Uses cursor MYCURSOR; the update is timed for ITEM.
+    """
+    print("Updating hourly and daily rollups ..."),
+
+    with util.Stage("rollup", item) as stage:
+        try:
+            mycursor.execute("SAVEPOINT rollups")
+            update_rollups(m_id, span[0], span[1], reading_type, mycursor)
+            mycursor.execute("RELEASE SAVEPOINT rollups")
+        except pyodbc.Error, rollup_err:
+            stage.fail()
+            mycursor.execute("ROLLBACK TO SAVEPOINT rollups")
+            util.fail()
+            print(rollup_err)
+            print("NOTE! Rollups of meter ID %d not updated from '%s' to '%s'"
+                % (m_id, span[0], span[1]))
+            return
+    util.done()
+
+def create_rollup_tables(mycursor):
+    """
+    Create the ROLLUPS tables if they do not exist yet, and commit. Each row
+    holds the sum, average, minimum, maximum and count of a meter's readings
+    (of its consumption, for Totalization meters) in the bucket starting at
+    time_stamp_utc. Uses cursor MYCURSOR.
+    """
+    global rollups_created
+    for table, unit in ROLLUPS:
+        sql = """
+            CREATE TABLE IF NOT EXISTS %s
+            (
+                meter_id        INTEGER REFERENCES meter,
+                time_stamp_utc  TIMESTAMP,
+                reading_sum     NUMERIC,
+                reading_avg     NUMERIC,
+                reading_min     NUMERIC,
+                reading_max     NUMERIC,
+                reading_count   INTEGER,
+                PRIMARY KEY (meter_id, time_stamp_utc)
+            )
+        """ % (table)
+        try:
+            exec_and_commit(mycursor, sql)
+        except pyodbc.Error:
+            # Another loader process may have created it at the same time.
+            mycursor.rollback()
+            mycursor.execute("SELECT 1 FROM %s LIMIT 1" % (table))
+    rollups_created = True
+
+def update_rollups(m_id, first, last, reading_type, mycursor):
+    """
+    Recompute the ROLLUPS buckets of meter M_ID touched by readings from
+    timestamp FIRST to LAST, and nothing else. The readings of a
+    Totalization meter are turned into consumption first: the increase
+    since the previous reading (or the reading itself after a counter
+    reset), so the bucket of the first reading after LAST, whose increase
+    depends on the readings before it, is recomputed too. Coarser rollups
+    are built from the hourly buckets. Nothing is committed; the ROLLUPS
+    tables must exist (see create_rollup_tables()). Uses cursor MYCURSOR.
+    """
+    stop = last
+    if reading_type == "Totalization":
+        value = "CASE WHEN step < 0 THEN reading ELSE step END"
+        row = mycursor.execute("""
+            SELECT      MIN(time_stamp_utc) AS next_reading
+            FROM        meter_value
+            WHERE       meter_id = %d
+            AND         reading IS NOT NULL
+            AND         time_stamp_utc > CAST('%s' AS TIMESTAMP)
+        """ % (m_id, last)).fetchone()
+        stop = row.next_reading or last
+    else:
+        value = "reading"
+    upsert = """
+        ON CONFLICT (meter_id, time_stamp_utc) DO UPDATE
+        SET         reading_sum = EXCLUDED.reading_sum,
+                    reading_avg = EXCLUDED.reading_avg,
+                    reading_min = EXCLUDED.reading_min,
+                    reading_max = EXCLUDED.reading_max,
+                    reading_count = EXCLUDED.reading_count
+    """
+    # Buckets from the one holding FIRST up to and including the one
+    # holding STOP.
+    bounds = """
+        time_stamp_utc >= date_trunc('%(unit)s', CAST('%(first)s' AS TIMESTAMP))
+        AND time_stamp_utc < date_trunc('%(unit)s',
+            CAST('%(stop)s' AS TIMESTAMP)) + INTERVAL '1 %(unit)s'
+    """
+    table, unit = ROLLUPS[0]
+    sql = """
+        INSERT INTO %(table)s (meter_id, time_stamp_utc, reading_sum,
+                    reading_avg, reading_min, reading_max, reading_count)
+        SELECT      %(m_id)d, date_trunc('%(unit)s', time_stamp_utc),
+                    SUM(%(value)s), AVG(%(value)s), MIN(%(value)s),
+                    MAX(%(value)s), COUNT(%(value)s)
+        FROM
+        (
+            SELECT  time_stamp_utc, reading,
+                    reading - LAG(reading) OVER (ORDER BY time_stamp_utc)
+                        AS step
+            FROM    meter_value
+            WHERE   meter_id = %(m_id)d
+            AND     reading IS NOT NULL
+            AND     time_stamp_utc >= COALESCE(
+                    (
+                        SELECT  MAX(time_stamp_utc)
+                        FROM    meter_value
+                        WHERE   meter_id = %(m_id)d
+                        AND     reading IS NOT NULL
+                        AND     time_stamp_utc < date_trunc('%(unit)s',
+                                    CAST('%(first)s' AS TIMESTAMP))
+                    ), '-infinity')
+            AND     time_stamp_utc < date_trunc('%(unit)s',
+                        CAST('%(stop)s' AS TIMESTAMP)) + INTERVAL '1 %(unit)s'
+        ) readings
+        WHERE       %(bounds)s
+        GROUP BY    2
+        %(upsert)s
+    """
+    params = {"table": table, "unit": unit, "m_id": m_id, "first": first,
+        "stop": stop, "value": value, "upsert": upsert}
+    params["bounds"] = bounds % params
+    mycursor.execute(sql % params)
+
+    for (table, unit), (source, source_unit) in zip(ROLLUPS[1:], ROLLUPS):
+        sql = """
+            INSERT INTO %(table)s (meter_id, time_stamp_utc, reading_sum,
+                        reading_avg, reading_min, reading_max, reading_count)
+            SELECT      meter_id, date_trunc('%(unit)s', time_stamp_utc),
+                        SUM(reading_sum),
+                        SUM(reading_sum) / NULLIF(SUM(reading_count), 0),
+                        MIN(reading_min), MAX(reading_max),
+                        SUM(reading_count)
+            FROM        %(source)s
+            WHERE       meter_id = %(m_id)d
+            AND         %(bounds)s
+            GROUP BY    1, 2
+            %(upsert)s
+        """
+        params = {"table": table, "unit": unit, "source": source,
+            "m_id": m_id, "first": first, "stop": stop, "upsert": upsert}
+        params["bounds"] = bounds % params
+        mycursor.execute(sql % params)
+
+def create_temp_table(table_name, mycursor, epoch=False):
     """
     Create temporary table with name TABLE_NAME to hold timestamp, reading data 
-    in the data file currently being processed.
+    in the data file currently being processed. The table is only seen by
+    this session and is dropped when the transaction ends. If EPOCH is TRUE,
+    the timestamps are held as the BIGINTs of an epoch file until
+    convert_epoch() is called.
     Returns TRUE if successful, FALSE otherwise. Uses cursor MYCURSOR.
     """
     sql = """
-        CREATE TABLE IF NOT EXISTS %s
+        CREATE TEMPORARY TABLE %s
         (
-            time_stamp_utc  TIMESTAMP,
+            time_stamp_utc  %s,
             reading         NUMERIC
-        )
-    """ % (table_name)
+        ) ON COMMIT DROP
+    """ % (table_name, "BIGINT" if epoch else "TIMESTAMP")
 
     print("Creating temporary table '%s' ..." % (table_name)),
 
     try:
-        exec_and_commit(mycursor, sql)
+        mycursor.execute(sql)
         util.done()
         return True
     except pyodbc.Error, create_tbl_err:
@@ -252,7 +1093,7 @@ def copy_data(data_file, table, mycursor):
     print("Copying data to temporary table '%s' ..." % (table)),
     
     try:
-        exec_and_commit(mycursor, sql)
+        mycursor.execute(sql)
         util.done()
         return True
     except pyodbc.Error, copy_err:
@@ -260,6 +1101,28 @@ def copy_data(data_file, table, mycursor):
         print(copy_err)
         return False
 
+def convert_epoch(table, mycursor):
+    """
+    Turn the 'time_stamp_utc' column of temporary table TABLE, copied from
+    an epoch file, from microseconds since the Unix epoch into timestamps.
+    Returns TRUE if successful, FALSE otherwise. Uses cursor MYCURSOR.
+    """
+    sql = """
+        ALTER TABLE %s ALTER COLUMN time_stamp_utc TYPE TIMESTAMP
+        USING TIMESTAMP 'epoch' + time_stamp_utc * INTERVAL '1 microsecond'
+    """ % (table)
+
+    print("Converting timestamps in temporary table '%s' ..." % (table)),
+
+    try:
+        mycursor.execute(sql)
+        util.done()
+        return True
+    except pyodbc.Error, convert_err:
+        util.fail()
+        print(convert_err)
+        return False
+
 def add_id_col(m_id, table, mycursor):
     """
     Add a 'id' column with default value M_ID to table TABLE using cursor
@@ -270,7 +1133,7 @@ def add_id_col(m_id, table, mycursor):
     print("Adding column to table '%s' with id value %d ..." % (table, m_id)),
 
     try:
-        exec_and_commit(mycursor, sql)
+        mycursor.execute(sql)
         util.done()
         return True
     except pyodbc.Error, add_col_err:
@@ -291,7 +1154,7 @@ def insert_table(table, mycursor):
     print("Inserting readings into 'meter_value' table ..."),
     
     try:
-        exec_and_commit(mycursor, sql)
+        mycursor.execute(sql)
         util.done()
         return True
     except pyodbc.Error, insert_table_err:
@@ -303,7 +1166,9 @@ def usage():
     """
     Print usage message.
     """
-    print("\nUSAGE: python load_data_files.py [DIRECTORIES] ")
+    print("\nUSAGE: python load_data_files.py [--stream] [--reload] "
+        "[--jobs N] [--validate MODE] [--partition LAYOUT] [--metrics M] "
+        "[--watch] [--poll] [DIRECTORIES] ")
     print("\nDESCRIPTION:")
     print("\tLoads meter data files in a data directory into the energy")
     print("\tdatabase. After loading, the files are then moved to a ")
@@ -318,7 +1183,43 @@ def usage():
     print("\t\treading type")
     print("\n\tSubsequent lines must be in the following format:")
     print("\tTimestamp, Reading\n")
+    print("\tgzip'd (.csv.gz) and binary (.bin) files written by the getters'")
+    print("\t--format option are also loaded; see datafile.py.")
+    print("\n\tEach file's meter, readings and rollups are committed in one")
+    print("\ttransaction, and the progress of each file is kept in")
+    print("\t'%s'." % (JOURNAL_FILE))
+    print("\tIf a run is interrupted, run it again: files whose load was")
+    print("\tcommitted are only moved, and the rest are loaded afresh.")
     print("\nOPTIONS:")
+    print("\t--stream -- read each data file on this host and stream its")
+    print("\treadings into the database in one transaction, instead of")
+    print("\thaving the database server COPY the file from its own disk.")
+    print("\tUse this when the loader runs on a different host.\n")
+    print("\t--reload -- load files into an existing meter with the same")
+    print("\tdescription, unit, commodity and source system, if there is")
+    print("\tone, and merge their readings so that files can be loaded")
+    print("\tagain, or overlap, without duplicating readings. Needs a unique")
+    print("\tindex on meter_value (meter_id, time_stamp_utc).\n")
+    print("\t--jobs N -- load N files at the same time in separate worker")
+    print("\tprocesses, each with its own connection (default 1).\n")
+    print("\t--validate MODE -- check each file's readings for duplicate,")
+    print("\tout of order, sentinel and NULL readings, gaps and totalizer")
+    print("\trollbacks before loading, and 'drop', 'repair' or 'quarantine'")
+    print("\tthe flagged rows (see validate.py). Needs NumPy.\n")
+    print("\t--partition LAYOUT -- 'meter_value' is partitioned by 'month'")
+    print("\tor by 'meter-month' (each month split by meter hash); create")
+    print("\tthe partitions each file's readings need before loading them.\n")
+    print("\t--metrics M -- append the time, rows and bytes of each stage of")
+    print("\teach file to file M as JSON lines. A summary per stage is always")
+    print("\tprinted at the end of the run.\n")
+    print("\t--watch -- keep running after the files in the data directory")
+    print("\tare loaded, and load new ones as soon as the getters have")
+    print("\tfinished writing them, over the same connection. Stops after")
+    print("\tthe file being loaded on SIGTERM or Ctrl-C. Cannot be combined")
+    print("\twith --jobs.\n")
+    print("\t--poll -- as --watch, but list the data directory every %g"
+        % (watch.POLL_INTERVAL))
+    print("\tseconds instead of using inotify, e.g. on NFS.\n")
     print("\tDIRECTORIES -- [data_dir processed_dir]")
     print("\n\tDATA_DIR PROCESSED_DIR are absolute paths to the data and")
     print("\tprocessed directories, respectively")
@@ -331,20 +1232,72 @@ def usage():
     print("\n\t'%s'" % (DEFAULT_PROCESSED_DIR))
 
 def main():
-    arg_len = len(sys.argv)
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "j:", ["stream", "reload",
+            "jobs=", "validate=", "partition=", "metrics=", "watch", "poll"])
+    except getopt.GetoptError, opt_err:
+        print(opt_err)
+        usage()
+        exit()
+    options = {}
+    jobs = 1
+    metrics_file = None
+    watch_mode = False
+    poll = False
+    for opt, val in opts:
+        if opt in ("--stream", "--reload"):
+            options[opt[2:]] = True
+        elif opt in ("-j", "--jobs"):
+            try:
+                jobs = util.get_workers(val)
+            except ValueError:
+                usage()
+                exit()
+        elif opt == "--validate":
+            try:
+                options["validate"] = validate.get_mode(val)
+            except ValueError, mode_err:
+                print(mode_err)
+                usage()
+                exit()
+        elif opt == "--partition":
+            try:
+                options["partition"] = get_layout(val)
+            except ValueError, layout_err:
+                print(layout_err)
+                usage()
+                exit()
+        elif opt == "--metrics":
+            metrics_file = val
+        elif opt == "--watch":
+            watch_mode = True
+        elif opt == "--poll":
+            watch_mode = poll = True
+    if watch_mode and jobs > 1:
+        print("ERROR: --watch cannot be combined with --jobs")
+        usage()
+        exit()
+    arg_len = len(args) + 1
     if (arg_len > 3 or arg_len == 2):
         usage()
         exit()
     elif (arg_len == 3):
-        data_dir = sys.argv[1]
-        processed_dir = sys.argv[2]
+        data_dir = args[0]
+        processed_dir = args[1]
     elif (arg_len == 1):
         data_dir = DEFAULT_DATA_DIR
         processed_dir = DEFAULT_PROCESSED_DIR
     if (not os.path.isdir(data_dir) or not os.path.isdir(processed_dir)):
         print("ERROR: directory '%s' does not exist!" % (data_dir))
         exit()
+    if watch_mode:
+        watch_data(data_dir, processed_dir, options, metrics_file, poll)
+        return
     data_files = get_data_files(data_dir)
+    if jobs > 1:
+        load_files(data_files, None, processed_dir, options, jobs,
+            metrics_file)
+        return
     try:
         cnxn_str = "DSN=%s;UID=%s;PWD=%s" % (DB, USER, PWD)
         print("Connecting to database ..."),
@@ -355,7 +1308,8 @@ def main():
         print(conn_err)
         exit()
     cursor = cnxn.cursor()
-    load_files(data_files, cursor, processed_dir)
+    load_files(data_files, cursor, processed_dir, options,
+        metrics_file=metrics_file)
     util.close_cnxn(cursor, cnxn)
 
 if __name__ == "__main__":
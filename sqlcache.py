@@ -0,0 +1,180 @@
+"""
+Caches the results of the SQL files run by ion_run_sql.py and jci_run_sql.py
+on disk, so that running the same query again does not touch the source
+database.
+
+Results are keyed by a hash of the database they came from and of the SQL
+text with comments and extra whitespace removed (see normalize()). Each is
+kept in CACHE_DIR as a gzip'd stream of pickles: a header dict, the batches
+of rows as lists of tuples, and None to mark the end. Results older than
+CACHE_TTL seconds are not used, and once CACHE_DIR grows past CACHE_SIZE
+bytes the least recently used results are removed.
+
+The cache is only used when asked for, with the scripts' '--cache' option or
+by setting CACHE_ENV in the environment.
+"""
+
+import cPickle
+import gzip
+import hashlib
+import os
+import re
+import time
+import util
+
+# Directory holding the cached results.
+CACHE_DIR = os.path.join(util.STATE_DIR, "sql_cache")
+
+# Seconds for which a cached result is used.
+CACHE_TTL = 60 * 60
+
+# Bytes the cached results may take up in total.
+CACHE_SIZE = 512 * 1024 * 1024
+
+# Environment variable that turns the cache on when set to a non-empty value.
+CACHE_ENV = "ENERGYDB_SQL_CACHE"
+
+# Comments, and quoted strings and identifiers, matched in one pass so that
+# quotes inside comments and comment markers inside quotes are not mistaken
+# for either. Only the quoted groups are kept by normalize().
+TOKEN_RE = re.compile(r"(--[^\n]*|/\*.*?\*/)"
+    r"|('(?:[^']|'')*'|\"[^\"]*\"|\[[^\]]*\])", re.DOTALL)
+
+# Runs of whitespace outside quotes.
+SPACE_RE = re.compile(r"\s+")
+
+# Long options of the scripts that use the cache, see get_options().
+OPTIONS = ["cache", "refresh", "no-cache"]
+
+def get_options(opts):
+    """
+    Returns (USE_CACHE, REFRESH) from OPTS, the (option, value) pairs parsed
+    by getopt from the OPTIONS: '--cache' turns the cache on (as does
+    CACHE_ENV), '--refresh' turns it on but runs the query anyway, and
+    '--no-cache' turns it off, whatever the other options say.
+    """
+    flags = [opt for opt, val in opts]
+    use_cache = (bool(os.getenv(CACHE_ENV)) or "--cache" in flags
+        or "--refresh" in flags)
+    if "--no-cache" in flags:
+        return False, False
+    return use_cache, "--refresh" in flags
+
+def normalize(sql):
+    """
+    Return SQL with comments removed and whitespace collapsed to single
+    spaces, outside of quoted strings and identifiers, so that queries that
+    differ only in layout share a cache entry.
+    """
+    parts = []
+    outside = []
+    pos = 0
+    for match in TOKEN_RE.finditer(sql):
+        outside.append(sql[pos:match.start()])
+        pos = match.end()
+        if match.group(1):
+            outside.append(" ")
+            continue
+        parts.append(SPACE_RE.sub(" ", "".join(outside)))
+        parts.append(match.group(2))
+        outside = []
+    outside.append(sql[pos:])
+    parts.append(SPACE_RE.sub(" ", "".join(outside)))
+    return "".join(parts).strip().rstrip(";").strip()
+
+def cache_path(sql, dsn):
+    """
+    Return the path of the cached result of SQL on data source DSN.
+    """
+    key = hashlib.sha1("%s\0%s" % (dsn, normalize(sql))).hexdigest()
+    return os.path.join(CACHE_DIR, key + ".pkl.gz")
+
+def load(sql, dsn):
+    """
+    Return the cached result of SQL on data source DSN as (COLUMNS, BATCHES),
+    where COLUMNS are the column names and BATCHES yields lists of row
+    tuples, or None if there is no result younger than CACHE_TTL seconds.
+    """
+    path = cache_path(sql, dsn)
+    try:
+        f = gzip.open(path, "rb")
+        header = cPickle.load(f)
+    except (IOError, EOFError, cPickle.UnpicklingError):
+        return None
+    if header["created"] + CACHE_TTL < time.time():
+        f.close()
+        return None
+    # Touched so that eviction sees the result as recently used.
+    os.utime(path, None)
+    return header["columns"], read_batches(f)
+
+def read_batches(f):
+    """
+    Yield the batches of rows of open cache file F, and close it.
+    """
+    with f:
+        while True:
+            batch = cPickle.load(f)
+            if batch is None:
+                return
+            yield batch
+
+def store(sql, dsn, columns, batches):
+    """
+    Yield the batches of rows in BATCHES, the result of SQL on data source
+    DSN with column names COLUMNS, while writing them to the cache. The
+    result is only cached once BATCHES is exhausted, after which the cache
+    is trimmed (see evict()).
+    """
+    if not os.path.isdir(CACHE_DIR):
+        os.makedirs(CACHE_DIR)
+    path = cache_path(sql, dsn)
+    tmp_path = "%s.%d.tmp" % (path, os.getpid())
+    complete = False
+    try:
+        with gzip.open(tmp_path, "wb") as f:
+            cPickle.dump({"created": time.time(), "dsn": dsn,
+                "sql": normalize(sql), "columns": columns}, f,
+                cPickle.HIGHEST_PROTOCOL)
+            for batch in batches:
+                rows = [tuple(row) for row in batch]
+                cPickle.dump(rows, f, cPickle.HIGHEST_PROTOCOL)
+                yield rows
+            cPickle.dump(None, f, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, path)
+        complete = True
+    finally:
+        if not complete and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    evict()
+
+def evict():
+    """
+    Remove cached results older than CACHE_TTL seconds, then the least
+    recently used ones until the rest take up at most CACHE_SIZE bytes.
+    Files of results still being written are left alone.
+    """
+    now = time.time()
+    entries = []
+    for name in os.listdir(CACHE_DIR):
+        path = os.path.join(CACHE_DIR, name)
+        if name.endswith(".tmp"):
+            continue
+        try:
+            stat = os.stat(path)
+            if stat.st_mtime + CACHE_TTL < now:
+                os.remove(path)
+            else:
+                entries.append((stat.st_mtime, stat.st_size, path))
+        except OSError:
+            # Removed by another run in the meantime.
+            pass
+    total = sum(size for mtime, size, path in entries)
+    for mtime, size, path in sorted(entries):
+        if total <= CACHE_SIZE:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total -= size
@@ -0,0 +1,250 @@
+"""
+Streams meter readings from the ION or JCI database straight into the
+Postgres energy database, without writing intermediate data files. Takes the
+same meter info file as the getter scripts (ion_get_data.py, jci_get_data.py)
+and registers meters the same way as the loader script (load_data_files.py).
+"""
+
+import datafile
+import getopt
+import ion_get_data
+import jci_get_data
+import load_data_files
+import os
+import pyodbc
+import sys
+import util
+
+# Getter script of each source database.
+SOURCES = {"ion": ion_get_data, "jci": jci_get_data}
+
+# Reading type a meter is registered with until all its readings are seen.
+PROVISIONAL_READING_TYPE = "Interval"
+
+class MeterValueWriter(object):
+    """
+    Stands in for a datafile.BodyWriter, inserting each batch of readings into
+    the 'meter_value' table instead of a file. The meter described by data
+    file header HEADER (minus its reading type) is registered when the first
+    batch arrives, so meters without readings are never created.
+    Uses cursor MYCURSOR. 'span' holds the [first, last] timestamps inserted.
+    LAYOUT is as in load_data_files.insert_readings().
+    """
+
+    def __init__(self, header, mycursor, layout=None):
+        self.header = header
+        self.cursor = mycursor
+        self.layout = layout
+        self.meter_id = None
+        self.count = 0
+        self.span = []
+
+    def write_batch(self, buf):
+        """
+        Insert the readings of datafile.ReadingBuffer BUF.
+        """
+        if self.meter_id is None:
+            meter_id = load_data_files.register_meter(
+                self.header + [PROVISIONAL_READING_TYPE], self.cursor)
+            if meter_id == -1:
+                raise ValueError("ERROR: Meter could not be registered")
+            print("Meter ID: %d" % (meter_id))
+            self.meter_id = meter_id
+        self.count += load_data_files.insert_readings(self.meter_id, buf,
+            self.cursor, layout=self.layout)
+        if not self.span:
+            self.span = [buf.first(), buf.last()]
+        else:
+            self.span[1] = buf.last()
+
+def set_reading_type(meter_id, reading_type, mycursor):
+    """
+    Set the reading type of meter METER_ID in the 'meter' table to
+    READING_TYPE. Nothing is committed. Raises ValueError if READING_TYPE is
+    unknown. Uses cursor MYCURSOR.
+    """
+    if reading_type == PROVISIONAL_READING_TYPE:
+        return
+    reading_type_id = load_data_files.get_id(reading_type, "reading_type",
+        "name", mycursor)
+    if reading_type_id == -1:
+        raise ValueError("ERROR: Reading type '%s' not found" % (reading_type))
+    mycursor.execute("UPDATE meter SET reading_type_id = %d WHERE id = %d"
+        % (reading_type_id, meter_id))
+
+def stream_meter_data(source, extract_file, window=None, metrics_file=None,
+        layout=None):
+    """
+    Stream the readings of the meters in EXTRACT_FILE from database SOURCE
+    ('ion' or 'jci') into the energy database. If WINDOW is given, readings
+    are queried one WINDOW-long time window at a time (see
+    util.split_windows()). The time spent in each stage is summed up at the
+    end and, if METRICS_FILE is given, appended to it (see
+    util.report_metrics()). If LAYOUT is given, 'meter_value' is partitioned
+    that way (see load_data_files.ensure_partitions()).
+    """
+    getter = SOURCES[source]
+    try:
+        meter_list = getter.get_meter_list(extract_file)
+    except ValueError, badHeader:
+        print(badHeader)
+        getter.usage()
+        exit()
+
+    try:
+        print("Connecting to database '%s' ..." % (getter.DB.upper())),
+        src_cnxn = pyodbc.connect("DSN=%s;UID=%s;PWD=%s"
+            % (getter.DB, getter.USER, getter.PASSWD))
+        util.done()
+        print("Connecting to database '%s' ..." % (util.PG_DB.upper())),
+        pg_cnxn = pyodbc.connect("DSN=%s;UID=%s;PWD=%s"
+            % (util.PG_DB, util.PG_USER, util.PG_PWD))
+        util.done()
+    except pyodbc.Error, connect_err:
+        util.fail()
+        print(connect_err)
+        exit()
+    src_cursor = src_cnxn.cursor()
+    pg_cursor = pg_cnxn.cursor()
+    # Created now, as creating them later would commit a meter's readings.
+    try:
+        load_data_files.create_rollup_tables(pg_cursor)
+    except pyodbc.Error, rollup_err:
+        print(rollup_err)
+        exit()
+    catalog = getter.get_catalog(meter_list, src_cursor)
+
+    print("Begin streaming ...\n")
+    err_count = 0
+    for meter_row in meter_list:
+        err_count += stream_meter(meter_row, getter, src_cursor, pg_cursor,
+            window, catalog, layout)
+    print("\nStreaming finished.")
+    if err_count == 0:
+        print("No errors encountered.")
+    else:
+        print("%d of %d IDs failed to process" % (err_count, len(meter_list)))
+    util.report_metrics(metrics_file)
+    util.close_cnxn(pg_cursor, pg_cnxn)
+    util.close_cnxn(src_cursor, src_cnxn)
+
+def stream_meter(mtr_row, getter, src_cursor, pg_cursor, window=None,
+        catalog=None, layout=None):
+    """
+    Stream the readings of the meter described in MTR_ROW, read with getter
+    script GETTER on cursor SRC_CURSOR, into the energy database with cursor
+    PG_CURSOR. The readings, the meter's final reading type and its updated
+    rollups (see load_data_files.update_rollups()) are committed together.
+    WINDOW and CATALOG are as in the getters' extract(); LAYOUT is as in
+    stream_meter_data().
+    Return 0 if successful, 1 if error(s) occur.
+    """
+    meter_id = int(mtr_row[0])
+    print("Processing Source ID: %d" % (meter_id))
+
+    meter_info = getter.describe(mtr_row, src_cursor, catalog)
+    if not meter_info:
+        util.tryNext()
+        return 1
+    start, end = getter.get_range(mtr_row)
+    try:
+        windows = util.split_windows(start, end, window)
+    except ValueError, window_err:
+        print(window_err)
+        util.tryNext()
+        return 1
+
+    writer = MeterValueWriter(meter_info, pg_cursor, layout)
+    tracker = datafile.ReadingTypeTracker()
+    try:
+        complete, last = datafile.write_readings(writer, src_cursor, windows,
+            getter.readings_query(mtr_row, src_cursor), tracker,
+            getter.mark_key(mtr_row))
+        if complete and writer.meter_id is not None:
+            set_reading_type(writer.meter_id, tracker.reading_type(),
+                pg_cursor)
+            load_data_files.update_rollups(writer.meter_id, writer.span[0],
+                writer.span[1], tracker.reading_type(), pg_cursor)
+    except (pyodbc.Error, ValueError), stream_err:
+        print(stream_err)
+        complete = False
+    if not complete:
+        # The meter is registered in the same transaction, so nothing of
+        # it is left behind.
+        pg_cursor.rollback()
+        load_data_files.known_partitions.clear()
+        util.tryNext()
+        return 1
+    pg_cursor.commit()
+
+    if writer.meter_id is None:
+        print("No readings found.\n")
+    else:
+        print("%d readings inserted into 'meter_value' table.\n"
+            % (writer.count))
+    return 0
+
+def usage():
+    """
+    Usage message.
+    """
+    print("\nUSAGE:  python %s [ --window W ] [ --partition LAYOUT ] "
+        "[ --metrics M ] [ ion | jci ] [ FILE.csv ]" % (sys.argv[0]))
+    print("\n\tStreams the readings of the meters in FILE.csv from the ION or")
+    print("\tJCI database straight into the energy database, without")
+    print("\twriting data files.")
+    print("\nDESCRIPTION")
+    print("\tFILE.csv has the same structure as the info file of the")
+    print("\tcorresponding getter script (ion_get_data.py, jci_get_data.py).")
+    print("\nOPTIONS")
+    print("\t--window W -- query readings one time window at a time, where W")
+    print("\tis 'month', 'week', 'day' or a number of days.")
+    print("\t--partition LAYOUT -- 'meter_value' is partitioned by 'month' or")
+    print("\tby 'meter-month'; create the partitions the readings need (see")
+    print("\tload_data_files.py).")
+    print("\t--metrics M -- append the time, rows and bytes of each stage of")
+    print("\teach meter to file M as JSON lines. A summary per stage is always")
+    print("\tprinted at the end of the run.\n")
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "", ["window=", "partition=",
+            "metrics="])
+    except getopt.GetoptError, opt_err:
+        print(opt_err)
+        usage()
+        exit()
+    window = None
+    layout = None
+    metrics_file = None
+    for opt, val in opts:
+        if opt == "--metrics":
+            metrics_file = val
+        elif opt == "--partition":
+            try:
+                layout = load_data_files.get_layout(val)
+            except ValueError, layout_err:
+                print(layout_err)
+                usage()
+                exit()
+        elif opt == "--window":
+            try:
+                window = util.get_window(val)
+            except ValueError, window_err:
+                print(window_err)
+                usage()
+                exit()
+    if len(args) != 2 or args[0] not in SOURCES:
+        usage()
+        exit()
+    extract_info_file = args[1]
+    if (not os.path.isfile(extract_info_file)):
+        print("ERROR: file '%s' not found!\n" % (extract_info_file))
+        exit()
+    else:
+        print("\nUsing file '%s' ...\n" % (extract_info_file))
+    stream_meter_data(args[0], extract_info_file, window, metrics_file,
+        layout)
+
+if __name__ == "__main__":
+    main()
@@ -3,8 +3,20 @@ Contains useful variables and methods used by the LBNL building energy
 datbase scripts.
 """
 
+import collections
+import datetime
+import json
 import os
+import pyodbc
+import Queue
 import shutil
+import sys
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+# Imported up front: datetime.strptime() imports it on first use, which
+# fails when that first use is in several worker threads at once.
+import _strptime
 
 # Metasys database
 METASYS_DB = "metasys"
@@ -24,6 +36,34 @@ PG_PWD = os.getenv('ENERGYDBPASS')
 # Directory where meter data files are saved to.
 DATA_OUTPUT_FILE_PATH = "/home/danielxu/data/data_files/"
 
+# Directory holding state kept between getter runs (e.g. watermarks). Kept
+# outside DATA_OUTPUT_FILE_PATH so the loader never mistakes it for data.
+STATE_DIR = "/home/danielxu/data/state/"
+
+# Seconds for which a source metadata catalog snapshot is reused.
+CATALOG_TTL = 24 * 60 * 60
+
+# Maximum number of IDs in one 'IN (...)' list of a catalog query.
+CATALOG_CHUNK = 500
+
+# Number of rows fetched from a source cursor at a time.
+FETCH_SIZE = 10000
+
+# Number of fetched batches of rows that may wait to be written while the
+# next one is fetched.
+PIPELINE_DEPTH = 4
+
+# Time window lengths accepted by split_windows(), besides a number of days.
+WINDOW_UNITS = {"day": 1, "week": 7}
+
+# Timings recorded by Stage, keyed by (stage name, item), in the order the
+# stages first ran. See report_metrics().
+metrics = collections.OrderedDict()
+
+# Local time the run started, written with every metrics line to tell runs
+# apart.
+RUN_STARTED = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
 # Default meter info file header length
 DEFAULT_LINE_LEN = 4
 
@@ -76,3 +116,413 @@ def move(src, dst):
     print("Moving file '%s' to directory '%s' ..." % (src, dst)),
     shutil.move(src, dst)
     done()
+
+class Stage(object):
+    """
+    Times one stage of a run (e.g. fetching readings) for ITEM, the meter or
+    file it works on, and adds the wall time to 'metrics' on exit. Entering
+    the same NAME and ITEM again adds to the same record, so a stage that is
+    interleaved with others (fetch, write, fetch, ...) is timed as a whole.
+    Call count() to add the rows and bytes handled. A stage left by an
+    exception, or on which fail() was called, is counted as failed. Safe to
+    use from worker threads.
+    """
+
+    def __init__(self, name, item=None):
+        self.key = (name, item)
+        self.rows = 0
+        self.bytes = 0
+        self.failed = False
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        merge_metrics([{"stage": self.key[0], "item": self.key[1], "calls": 1,
+            "failed": int(self.failed or exc_type is not None),
+            "seconds": time.time() - self.started, "rows": self.rows,
+            "bytes": self.bytes}])
+        self.rows = self.bytes = 0
+        self.failed = False
+
+    def count(self, rows=0, nbytes=0):
+        """
+        Add ROWS rows and NBYTES bytes to what this stage has handled.
+        """
+        self.rows += rows
+        self.bytes += nbytes
+
+    def fail(self):
+        """
+        Count the current run of this stage as failed.
+        """
+        self.failed = True
+
+# Guards 'metrics' across worker threads.
+_metrics_lock = threading.Lock()
+
+def merge_metrics(records):
+    """
+    Add the stage timings in RECORDS, dicts as returned by take_metrics(), to
+    'metrics'. Used to collect the timings of worker processes.
+    """
+    with _metrics_lock:
+        for record in records:
+            key = (record["stage"], record["item"])
+            if key not in metrics:
+                metrics[key] = dict(record)
+                continue
+            for field in ("calls", "failed", "seconds", "rows", "bytes"):
+                metrics[key][field] += record[field]
+
+def take_metrics():
+    """
+    Return the stage timings recorded so far as a list of dicts with keys
+    stage, item, calls, failed, seconds, rows and bytes, and clear them.
+    """
+    with _metrics_lock:
+        records = metrics.values()
+        metrics.clear()
+    return records
+
+def report_metrics(metrics_file=None):
+    """
+    Print the recorded stage timings summed per stage, slowest stage first.
+    If METRICS_FILE is given, also append one JSON line per stage and item to
+    it, so runs can be compared or the slowest meters found. Nothing is
+    printed if no stages were timed.
+    """
+    records = take_metrics()
+    if not records:
+        return
+    if metrics_file:
+        script = os.path.basename(sys.argv[0])
+        with open(metrics_file, "ab") as f:
+            for record in records:
+                f.write(json.dumps(dict(record, script=script,
+                    run=RUN_STARTED), sort_keys=True) + "\n")
+
+    totals = collections.OrderedDict()
+    for record in records:
+        total = totals.setdefault(record["stage"], {"items": 0, "calls": 0,
+            "failed": 0, "seconds": 0.0, "rows": 0, "bytes": 0})
+        total["items"] += 1
+        for field in ("calls", "failed", "seconds", "rows", "bytes"):
+            total[field] += record[field]
+
+    print("\n%-24s %6s %7s %6s %10s %11s %11s %9s" % ("stage", "items",
+        "calls", "failed", "seconds", "rows", "rows/sec", "MB"))
+    for name, total in sorted(totals.items(), key=lambda t: -t[1]["seconds"]):
+        rate = total["rows"] / total["seconds"] if total["seconds"] else 0
+        print("%-24s %6d %7d %6d %10.3f %11d %11d %9.2f" % (name,
+            total["items"], total["calls"], total["failed"],
+            total["seconds"], total["rows"], rate, total["bytes"] / 1e6))
+    if metrics_file:
+        print("\nStage timings appended to '%s'." % (metrics_file))
+
+def get_workers(value):
+    """
+    Returns VALUE, the argument of a '--workers' style option, as a positive
+    integer. Raises ValueError if VALUE is not a positive integer.
+    """
+    workers = int(value)
+    if (workers < 1):
+        raise ValueError("ERROR: Worker count must be a positive integer.\n")
+    return workers
+
+def connect_pool(cnxn_str, size):
+    """
+    Open SIZE connections with connection string CNXN_STR and return them in a
+    bounded queue. Closes any opened connections and re-raises the error if a
+    connection cannot be made.
+    """
+    pool = Queue.Queue(size)
+    print("Opening %d connections ..." % (size)),
+    try:
+        for i in range(size):
+            pool.put(pyodbc.connect(cnxn_str))
+    except pyodbc.Error:
+        fail()
+        close_pool(pool)
+        raise
+    done()
+    return pool
+
+def close_pool(pool):
+    """
+    Close every connection held in connection queue POOL.
+    """
+    print("Closing connections ..."),
+    while not pool.empty():
+        pool.get_nowait().close()
+    done()
+
+def run_parallel(extract_fn, meter_list, pool, workers):
+    """
+    Call EXTRACT_FN(meter_row, cursor) for every row of METER_LIST using
+    WORKERS threads. The rows may also be groups of rows (see
+    batch_groups()), if EXTRACT_FN takes those. Each call borrows a
+    connection from connection queue POOL and gets a fresh cursor on it, so
+    at most POOL's size connections are in use at once. Returns the sum of
+    the values returned by EXTRACT_FN, i.e. the number of meters that failed.
+    """
+    def work(meter_row):
+        cnxn = pool.get()
+        try:
+            cursor = cnxn.cursor()
+            try:
+                return extract_fn(meter_row, cursor)
+            finally:
+                cursor.close()
+        except pyodbc.Error, extract_err:
+            print(extract_err)
+            tryNext()
+            return 1
+        finally:
+            pool.put(cnxn)
+
+    thread_pool = ThreadPool(workers)
+    try:
+        results = thread_pool.map(work, meter_list, chunksize=1)
+    finally:
+        thread_pool.close()
+        thread_pool.join()
+    return sum(results)
+
+def batch_groups(meter_list, size, key):
+    """
+    Split METER_LIST into lists of at most SIZE rows that share KEY(row),
+    e.g. a date range, keeping the order in which each key first appears.
+    """
+    groups = collections.OrderedDict()
+    for meter_row in meter_list:
+        groups.setdefault(key(meter_row), []).append(meter_row)
+    return [rows[i:i + size] for rows in groups.values()
+        for i in range(0, len(rows), size)]
+
+# Guards read-modify-write of the watermark files across worker threads.
+_watermark_lock = threading.Lock()
+
+def watermark_path(db):
+    """
+    Return the path of the high-water mark file for database DB.
+    """
+    return os.path.join(STATE_DIR, "%s_watermarks.json" % (db.lower()))
+
+def load_watermarks(db):
+    """
+    Return the high-water marks recorded for database DB as a dict mapping a
+    meter key to the timestamp string of the last reading extracted for it.
+    Returns an empty dict if no marks have been recorded yet.
+    """
+    path = watermark_path(db)
+    if (not os.path.isfile(path)):
+        return {}
+    with open(path, "rb") as f:
+        return json.load(f)
+
+def save_watermark(db, marks, key, mark):
+    """
+    Set the high-water mark of meter KEY in MARKS to MARK and write MARKS to
+    the watermark file of database DB. The file is replaced atomically so an
+    interrupted run never leaves a truncated file behind.
+    """
+    path = watermark_path(db)
+    with _watermark_lock:
+        marks[key] = mark
+        if (not os.path.isdir(STATE_DIR)):
+            os.makedirs(STATE_DIR)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            json.dump(marks, f, indent=1, sort_keys=True)
+        os.rename(tmp_path, path)
+
+def format_mark(timestamp, digits=6):
+    """
+    Return datetime TIMESTAMP as a string usable in a CAST, keeping DIGITS
+    fractional second digits. Fractions are truncated rather than rounded so
+    the mark never lies after TIMESTAMP.
+    """
+    mark = timestamp.strftime("%Y-%m-%d %H:%M:%S.%f")
+    return mark[:len(mark) - 6 + digits]
+
+def incremental_range(mark, start, end):
+    """
+    Return (START, END, START_OP) bounding an incremental extraction for a
+    meter whose high-water mark is MARK. If MARK is at or after START the
+    range begins just after MARK (START_OP '>'), otherwise at START
+    (START_OP '>='). A blank END means up to the current UTC time. Raises
+    ValueError if MARK or START is not a timestamp (see parse_timestamp()).
+    """
+    if (not end):
+        end = datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+    if (mark and parse_timestamp(mark) >= parse_timestamp(start)):
+        return mark, end, ">"
+    return start, end, ">="
+
+def file_stamp(timestamp):
+    """
+    Return timestamp string TIMESTAMP with everything but its digits removed,
+    e.g. '2015-05-01 13:00:00' -> '20150501130000', for use in file names.
+    """
+    return "".join(c for c in timestamp if c.isdigit())
+
+def get_loaded_watermarks(source, digits=6):
+    """
+    Return a dict mapping (description, unit) of each meter from source system
+    SOURCE in the energy database to the timestamp string of its latest loaded
+    reading, with DIGITS fractional second digits (see format_mark()), as
+    many as the source database's timestamps take. Both keys are lowercase.
+    Returns an empty dict if the energy database cannot be queried.
+    """
+    sql = """
+        SELECT      m.description, u.old_unit,
+                    MAX(v.time_stamp_utc) AS last_reading
+        FROM        meter m
+        JOIN        meter_value v ON v.meter_id = m.id
+        JOIN        unit u ON u.id = m.unit_id
+        JOIN        source_system s ON s.id = m.source_system_id
+        WHERE       s.name ILIKE '%s'
+        GROUP BY    m.description, u.old_unit
+    """ % (source)
+
+    print("Getting loaded watermarks from database '%s' ..." % (PG_DB)),
+    try:
+        cnxn = pyodbc.connect("DSN=%s;UID=%s;PWD=%s" % (PG_DB, PG_USER, PG_PWD))
+        try:
+            rows = cnxn.cursor().execute(sql).fetchall()
+        finally:
+            cnxn.close()
+    except pyodbc.Error, watermark_err:
+        fail()
+        print(watermark_err)
+        return {}
+    done()
+    return dict(((r.description.lower(), r.old_unit.lower()),
+        format_mark(r.last_reading, digits)) for r in rows)
+
+def parse_timestamp(timestamp):
+    """
+    Return timestamp string TIMESTAMP (a date, optionally followed by a time
+    with or without fractional seconds) as a datetime. Raises ValueError if
+    TIMESTAMP is in none of these forms.
+    """
+    for fmt in ("%Y-%m-%d", "%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M:%S.%f"):
+        try:
+            return datetime.datetime.strptime(timestamp.strip(), fmt)
+        except ValueError:
+            pass
+    raise ValueError("ERROR: Bad timestamp '%s'" % (timestamp))
+
+def get_window(value):
+    """
+    Returns VALUE, the argument of a '--window' option, if it is a valid
+    window length: 'month', 'week', 'day' or a positive number of days.
+    Raises ValueError otherwise.
+    """
+    if (value == "month" or value in WINDOW_UNITS):
+        return value
+    if (not value.isdigit() or int(value) < 1):
+        raise ValueError("ERROR: Bad window length '%s'.\n" % (value))
+    return value
+
+def next_window(timestamp, window):
+    """
+    Return the start of the WINDOW-long time window following the one that
+    contains datetime TIMESTAMP. Windows start at midnight, and monthly
+    windows on the first of the month.
+    """
+    if (window == "month"):
+        return datetime.datetime(timestamp.year + timestamp.month // 12,
+            timestamp.month % 12 + 1, 1)
+    days = WINDOW_UNITS.get(window) or int(window)
+    midnight = datetime.datetime(timestamp.year, timestamp.month, timestamp.day)
+    return midnight + datetime.timedelta(days=days)
+
+def split_windows(start, end, window=None, start_op=">="):
+    """
+    Split the range from START to END into consecutive WINDOW-long windows
+    (see get_window()) and return them as a list of (start, end, start_op)
+    tuples. Only the first window keeps START_OP; the others start with
+    '>=' at the previous window's end. If WINDOW is NONE the range is returned
+    whole. Raises ValueError if START or END cannot be parsed.
+    """
+    if (not window):
+        return [(start, end, start_op)]
+    end_time = parse_timestamp(end)
+    window_time = parse_timestamp(start)
+    windows = []
+    while True:
+        window_time = next_window(window_time, window)
+        if (window_time >= end_time):
+            windows.append((start, end, start_op))
+            return windows
+        window_end = window_time.strftime("%Y-%m-%d %H:%M:%S")
+        windows.append((start, window_end, start_op))
+        start, start_op = window_end, ">="
+
+def fetch_batches(my_cursor, size=FETCH_SIZE):
+    """
+    Yield lists of up to SIZE rows from cursor MY_CURSOR until it is exhausted.
+    """
+    while True:
+        rows = my_cursor.fetchmany(size)
+        if (not rows):
+            return
+        yield rows
+
+def catalog_path(db):
+    """
+    Return the path of the metadata catalog snapshot for database DB.
+    """
+    return os.path.join(STATE_DIR, "%s_catalog.json" % (db.lower()))
+
+def load_catalog(db):
+    """
+    Return the metadata catalog snapshot of database DB: a dict mapping a
+    table name to a dict of {ID string: name}. Snapshots older than
+    CATALOG_TTL seconds are ignored, in which case an empty catalog is
+    returned.
+    """
+    path = catalog_path(db)
+    if (not os.path.isfile(path)):
+        return {}
+    with open(path, "rb") as f:
+        snapshot = json.load(f)
+    if (snapshot.get("created", 0) + CATALOG_TTL < time.time()):
+        return {}
+    return snapshot
+
+def save_catalog(db, catalog):
+    """
+    Write metadata catalog CATALOG of database DB to its snapshot file. A new
+    catalog is stamped with the current time; an updated one keeps its
+    original stamp so that it still expires CATALOG_TTL seconds after it was
+    first taken.
+    """
+    catalog.setdefault("created", time.time())
+    if (not os.path.isdir(STATE_DIR)):
+        os.makedirs(STATE_DIR)
+    path = catalog_path(db)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        json.dump(catalog, f)
+    os.rename(tmp_path, path)
+
+def fetch_names(catalog, table, sql, ids, my_cursor):
+    """
+    Add the names of IDS missing from CATALOG[TABLE] to CATALOG. SQL must
+    select (id, name) pairs and contain one '%s' for a comma-separated ID
+    list; it is run on cursor MY_CURSOR once per CATALOG_CHUNK missing IDs.
+    Returns the number of names added.
+    """
+    names = catalog.setdefault(table, {})
+    missing = sorted(i for i in ids if str(i) not in names)
+    added = 0
+    for i in range(0, len(missing), CATALOG_CHUNK):
+        id_list = ",".join(str(m) for m in missing[i:i + CATALOG_CHUNK])
+        for row in my_cursor.execute(sql % (id_list)).fetchall():
+            names[str(row[0])] = row[1]
+            added += 1
+    return added
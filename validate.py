@@ -0,0 +1,234 @@
+"""
+Checks and cleans the readings of a data file before the loader script
+(load_data_files.py) inserts them. A file's timestamps and readings are read
+into NumPy arrays and checked as a whole, so that multi-million-row files
+take seconds. NumPy is only needed when validation is asked for.
+
+The following are flagged:
+
+    out of order -- readings with an earlier timestamp than the one before
+    duplicate    -- readings with the same timestamp as another reading
+    gap          -- intervals more than GAP_FACTOR times the median interval
+    NULL run     -- runs of consecutive NULL readings
+    sentinel     -- readings in SENTINEL_READINGS, or infinite
+    rollback     -- readings of a Totalization meter below the highest
+                    reading since its last reset (see RESET_RATIO in
+                    datafile.py), i.e. the counter ran backwards
+
+and flagged rows are handled according to one of MODES:
+
+    drop       -- readings are sorted by time; duplicates (all but the first),
+                  sentinels, rollbacks and NULL readings are left out
+    repair     -- readings are sorted by time; of duplicates only the last is
+                  kept, sentinels become NULL and rollbacks are held at the
+                  highest reading before them
+    quarantine -- as drop, and the rows left out are written, with the
+                  reason, to a csv file in QUARANTINE_DIR of the processed
+                  directory
+
+Gaps cannot be fixed from the file alone and are only reported.
+"""
+
+import csv
+import datafile
+import os
+import struct
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Ways of handling flagged rows, see above.
+MODES = ("drop", "repair", "quarantine")
+
+# Readings the source systems write when a meter has no value.
+SENTINEL_READINGS = (-9999.0, -999.0)
+
+# An interval longer than this many times the median interval is a gap.
+GAP_FACTOR = 3
+
+# Directory, under the processed directory, of the quarantine files.
+QUARANTINE_DIR = "quarantine"
+
+def get_mode(value):
+    """
+    Returns VALUE, the argument of a '--validate' option, if it is one of
+    MODES. Raises ValueError if it is not, or if NumPy is not installed.
+    """
+    if value not in MODES:
+        raise ValueError("ERROR: Unknown validation mode '%s'.\n" % (value))
+    if numpy is None:
+        raise ValueError("ERROR: Validation needs NumPy, which is not "
+            "installed.\n")
+    return value
+
+def read_arrays(data_file):
+    """
+    Return the readings of DATA_FILE as two arrays: the timestamps, as
+    microseconds since datafile.EPOCH (int64), and the readings (float64,
+    NaN where NULL). Raises ValueError if a field cannot be parsed.
+    """
+    if datafile.file_format(data_file) == "binary":
+        return read_binary_arrays(data_file)
+    with datafile.open_data(data_file) as f:
+        text = f.read().split("\n", 1)
+    lines = text[1].splitlines() if len(text) > 1 else []
+    # Timestamps and readings never hold a comma or a quote, so the fields
+    # can be split in one go rather than a row at a time.
+    fields = ",".join(lines).split(",") if lines else []
+    if len(fields) != 2 * len(lines):
+        raise ValueError("ERROR: Rows must have 2 fields")
+    if fields and datafile.is_epoch(fields[0]):
+        stamps = numpy.array(fields[0::2], dtype=numpy.int64)
+    else:
+        stamps = numpy.array(fields[0::2], dtype="datetime64[us]")
+    readings = numpy.array(fields[1::2])
+    readings = numpy.where(numpy.isin(readings, datafile.NULL_READINGS),
+        "nan", readings).astype(numpy.float64)
+    return stamps.astype(numpy.int64), readings
+
+def read_binary_arrays(data_file):
+    """
+    Return the readings of binary DATA_FILE as read_arrays() does.
+    """
+    stamps = []
+    readings = []
+    with open(data_file, "rb") as f:
+        f.readline()
+        while True:
+            count = f.read(4)
+            if not count:
+                break
+            n = struct.unpack("<I", count)[0]
+            stamps.append(numpy.frombuffer(f.read(8 * n), dtype="<i8"))
+            values = numpy.frombuffer(f.read(8 * n), dtype="<f8").copy()
+            values[numpy.frombuffer(f.read(n), dtype=numpy.uint8) != 0] = \
+                numpy.nan
+            readings.append(values)
+    if not stamps:
+        return numpy.zeros(0, numpy.int64), numpy.zeros(0, numpy.float64)
+    return (numpy.concatenate(stamps).astype(numpy.int64),
+        numpy.concatenate(readings))
+
+def find_rollbacks(values):
+    """
+    Return (ROLLBACK, PEAK) for the readings VALUES of a totalizer, in time
+    order and without NULLs: ROLLBACK is TRUE for each reading below the
+    highest reading before it since the last reset, and PEAK holds that
+    highest reading (the reading itself if it is no rollback).
+    """
+    rollback = numpy.zeros(len(values), dtype=bool)
+    peak = values.copy()
+    prev = values[:-1]
+    resets = numpy.flatnonzero((values[1:] < prev)
+        & (values[1:] <= prev * datafile.RESET_RATIO)) + 1
+    bounds = numpy.concatenate(([0], resets, [len(values)]))
+    # Resets are rare, so this loop is short.
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        segment = numpy.maximum.accumulate(values[start:end])
+        peak[start:end] = segment
+        rollback[start + 1:end] = values[start + 1:end] < segment[:-1]
+    return rollback, peak
+
+def null_runs(null):
+    """
+    Return the lengths of the runs of TRUE in boolean array NULL.
+    """
+    edges = numpy.diff(numpy.concatenate(([0], null.astype(numpy.int8), [0])))
+    return numpy.flatnonzero(edges == -1) - numpy.flatnonzero(edges == 1)
+
+def check(data_file, reading_type, mode):
+    """
+    Check and clean the readings of DATA_FILE, whose meter has reading type
+    READING_TYPE, in mode MODE (see MODES). Returns (STAMPS, VALUES, REJECTS,
+    REPORT): the arrays of the readings to load, as from read_arrays(), a
+    list of (timestamp, reading, reason) of the rows left out, and a dict
+    counting what was flagged.
+    """
+    stamps, values = read_arrays(data_file)
+    report = {"rows": len(stamps), "out of order": 0, "duplicate": 0,
+        "gap": 0, "NULL run": 0, "sentinel": 0, "rollback": 0}
+    if not len(stamps):
+        return stamps, values, [], report
+
+    report["out of order"] = int((numpy.diff(stamps) < 0).sum())
+    order = numpy.argsort(stamps, kind="mergesort")
+    stamps = stamps[order]
+    values = values[order]
+
+    same = stamps[1:] == stamps[:-1]
+    duplicate = numpy.zeros(len(stamps), dtype=bool)
+    if mode == "repair":
+        duplicate[:-1] = same
+    else:
+        duplicate[1:] = same
+    report["duplicate"] = int(duplicate.sum())
+
+    intervals = numpy.diff(stamps[~duplicate])
+    if len(intervals):
+        report["gap"] = int((intervals
+            > GAP_FACTOR * numpy.median(intervals)).sum())
+
+    null = numpy.isnan(values)
+    sentinel = ~null & (numpy.isinf(values)
+        | numpy.isin(values, SENTINEL_READINGS))
+    report["sentinel"] = int((sentinel & ~duplicate).sum())
+
+    rollback = numpy.zeros(len(stamps), dtype=bool)
+    peak = values
+    if reading_type == "Totalization":
+        valid = numpy.flatnonzero(~duplicate & ~null & ~sentinel)
+        valid_rollback, valid_peak = find_rollbacks(values[valid])
+        rollback[valid] = valid_rollback
+        peak = values.copy()
+        peak[valid] = valid_peak
+    report["rollback"] = int(rollback.sum())
+
+    runs = null_runs(null & ~duplicate)
+    report["NULL run"] = len(runs)
+    report["longest NULL run"] = int(runs.max()) if len(runs) else 0
+
+    rejects = []
+    if mode == "repair":
+        values = numpy.where(rollback, peak, values)
+        values[sentinel] = numpy.nan
+        keep = ~duplicate
+    else:
+        keep = ~(duplicate | sentinel | rollback | null)
+        if mode == "quarantine":
+            for reason, mask in (("duplicate", duplicate),
+                    ("sentinel", sentinel & ~duplicate),
+                    ("rollback", rollback), ("NULL", null & ~duplicate)):
+                rejects.extend((s, v, reason) for s, v
+                    in zip(stamps[mask].tolist(), values[mask].tolist()))
+    report["removed"] = int(len(keep) - keep.sum())
+    return stamps[keep], values[keep], rejects, report
+
+def to_readings(stamps, values):
+    """
+    Yield the (timestamp, reading) pairs of the arrays STAMPS and VALUES, as
+    from read_arrays(), as a datetime and a float (None where NULL).
+    """
+    times = stamps.astype("datetime64[us]").astype(object)
+    for i, value in enumerate(values.tolist()):
+        yield times[i], None if value != value else value
+
+def quarantine(data_file, rejects, process_dir):
+    """
+    Write REJECTS, (timestamp, reading, reason) tuples as returned by check()
+    for DATA_FILE, to a csv file in QUARANTINE_DIR under PROCESS_DIR, and
+    return its path.
+    """
+    quarantine_dir = os.path.join(process_dir, QUARANTINE_DIR)
+    if not os.path.isdir(quarantine_dir):
+        os.makedirs(quarantine_dir)
+    path = os.path.join(quarantine_dir,
+        os.path.basename(data_file) + ".quarantine.csv")
+    with open(path, "wb") as f:
+        writer = csv.writer(f, delimiter=',')
+        writer.writerow(["time_stamp_utc", "reading", "reason"])
+        for stamp, value, reason in sorted(rejects):
+            writer.writerow([datafile.from_epoch(stamp),
+                "NULL" if value != value else value, reason])
+    return path
@@ -0,0 +1,169 @@
+"""
+Watches a data directory for data files that are ready to be loaded, for the
+loader script's watch mode (load_data_files.py --watch).
+
+The getters write each data file under a datafile.PARTIAL_SUFFIX name and
+rename it into place once it is complete, so a file is ready as soon as it
+shows up under its final name. On Linux the directory is watched with
+inotify, reached through ctypes, for files renamed into it or closed after
+being written. Where inotify cannot be set up, or on a network file system
+whose changes inotify does not see, the directory is listed every
+POLL_INTERVAL seconds instead, and a file is taken to be ready once its size
+and modification time are the same in two listings in a row.
+"""
+
+import ctypes
+import ctypes.util
+import datafile
+import errno
+import os
+import select
+import struct
+import time
+
+# Seconds between listings of a directory that is polled.
+POLL_INTERVAL = 2.0
+
+# inotify events (see inotify(7)): a file written and closed, a file renamed
+# into the directory, and events lost because the queue overflowed.
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+
+# inotify_init1() flag closing the descriptor in child processes.
+IN_CLOEXEC = 0x00080000
+
+# Fixed part of an inotify event: watch descriptor, mask, cookie and the
+# length of the file name that follows.
+EVENT_HEADER = struct.Struct("iIII")
+
+# Bytes read from the inotify descriptor at once; many events fit.
+EVENT_BUFFER = 64 * 1024
+
+def is_ready(path):
+    """
+    Return TRUE if PATH is a file that is not still being written, by the
+    getters' convention (see datafile.PARTIAL_SUFFIX).
+    """
+    return (not path.endswith(datafile.PARTIAL_SUFFIX)
+        and os.path.isfile(path))
+
+def list_ready(path):
+    """
+    Return the paths of the files in directory PATH that are ready, sorted.
+    """
+    return sorted(f for f in (os.path.join(path, name)
+        for name in os.listdir(path)) if is_ready(f))
+
+class InotifyWatcher(object):
+    """
+    Watches directory PATH with inotify. Raises OSError if inotify cannot be
+    set up. Call close() when done.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        try:
+            init, add_watch = libc.inotify_init1, libc.inotify_add_watch
+        except AttributeError:
+            raise OSError(errno.ENOSYS, "inotify is not available")
+        self.fd = init(IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        if add_watch(self.fd, path, IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+            err = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(err, os.strerror(err))
+
+    def wait(self, timeout):
+        """
+        Wait up to TIMEOUT seconds for files to become ready, and return
+        their paths, sorted (none if the wait timed out or was interrupted by
+        a signal).
+        """
+        try:
+            readable = select.select([self.fd], [], [], timeout)[0]
+        except select.error, select_err:
+            if select_err.args[0] == errno.EINTR:
+                return []
+            raise
+        if not readable:
+            return []
+        data = os.read(self.fd, EVENT_BUFFER)
+        names = set()
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            if mask & IN_Q_OVERFLOW:
+                # Events were lost, so look at everything.
+                return list_ready(self.path)
+            name = data[offset:offset + length].rstrip("\0")
+            offset += length
+            if name:
+                names.add(name)
+        return sorted(f for f in (os.path.join(self.path, name)
+            for name in names) if is_ready(f))
+
+    def close(self):
+        """
+        Stop watching.
+        """
+        os.close(self.fd)
+
+class PollingWatcher(object):
+    """
+    Watches directory PATH by listing it every INTERVAL seconds.
+    """
+
+    def __init__(self, path, interval=POLL_INTERVAL):
+        self.path = path
+        self.interval = interval
+        self.seen = {}
+        self.listed = 0
+
+    def wait(self, timeout):
+        """
+        As InotifyWatcher.wait(). The directory is listed at most once every
+        'interval' seconds, and a file is only returned once its size and
+        modification time are unchanged since the listing before.
+        """
+        delay = self.listed + self.interval - time.time()
+        if delay > timeout:
+            time.sleep(timeout)
+            return []
+        if delay > 0:
+            time.sleep(delay)
+        self.listed = time.time()
+        seen = {}
+        for path in list_ready(self.path):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            seen[path] = (stat.st_size, stat.st_mtime)
+        ready = sorted(path for path, state in seen.items()
+            if self.seen.get(path) == state)
+        self.seen = seen
+        return ready
+
+    def close(self):
+        """
+        Stop watching.
+        """
+        self.seen = {}
+
+def watcher(path, poll=False):
+    """
+    Return a watcher of directory PATH: an InotifyWatcher, or a
+    PollingWatcher if POLL is TRUE or inotify cannot be set up.
+    """
+    if not poll:
+        try:
+            return InotifyWatcher(path)
+        except OSError, inotify_err:
+            print("Cannot watch '%s' with inotify (%s)." % (path,
+                inotify_err))
+    print("Polling '%s' every %g seconds." % (path, POLL_INTERVAL))
+    return PollingWatcher(path)
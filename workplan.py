@@ -0,0 +1,229 @@
+"""
+Plans and runs the extraction of meters whose readings are too unevenly
+spread for a meter-per-job split to keep the workers of a getter script
+(ion_get_data.py, jci_get_data.py) equally busy: one row of an info file may
+be a sparse meter-year, the next a 1-second meter over five years.
+
+Before extracting, the readings of each meter are counted per month with one
+cheap query (the getters' count_readings()), and months holding more than
+the target number of rows per piece are counted again per day. Consecutive
+slices are then gathered into pieces of about the target size. All pieces
+of all meters are extracted longest first, so the largest ones do not end
+up alone at the end of the run, each into a body file of its own (see
+datafile.body_path()). Once all pieces of a meter are in, their bodies are
+stitched together in time order into the meter's usual data file, with one
+header, so the loader sees one file per meter as before.
+"""
+
+import collections
+import datafile
+import functools
+import os
+import shutil
+import threading
+import util
+
+# Time slices the readings are first counted in; slices holding more than
+# the target rows of a piece are counted again in REFINE_SLICE slices.
+COUNT_SLICE = "month"
+REFINE_SLICE = "day"
+
+# Guards 'plans' across the planning threads.
+_plans_lock = threading.Lock()
+
+class Piece(object):
+    """
+    One time range, from START (compared with START_OP) to END, of the
+    meter described in MTR_ROW, estimated to hold ROWS readings. After it is
+    extracted, 'complete', 'last' and 'tracker' are as returned by
+    datafile.write_readings() and fed to it.
+    """
+
+    def __init__(self, mtr_row, index, start, end, start_op, rows):
+        self.mtr_row = mtr_row
+        self.index = index
+        self.start = start
+        self.end = end
+        self.start_op = start_op
+        self.rows = rows
+        self.complete = False
+        self.last = None
+        self.tracker = datafile.ReadingTypeTracker()
+
+def count_slices(getter, mtr_row, start, end, piece_rows, my_cursor):
+    """
+    Return the (start, end, rows) slices of the readings of the meter
+    described in MTR_ROW from START to END, counted with GETTER's
+    count_readings() on cursor MY_CURSOR: COUNT_SLICE slices, of which those
+    holding more than PIECE_ROWS rows are split into REFINE_SLICE slices.
+    Raises pyodbc.Error if a count fails.
+    """
+    slices = [(lo, hi) for lo, hi, op in util.split_windows(start, end,
+        COUNT_SLICE)]
+    counts = getter.count_readings(mtr_row, slices, my_cursor)
+    result = []
+    for (lo, hi), rows in zip(slices, counts):
+        if rows <= piece_rows:
+            result.append((lo, hi, rows))
+            continue
+        days = [(d_lo, d_hi) for d_lo, d_hi, op in util.split_windows(lo, hi,
+            REFINE_SLICE)]
+        if len(days) == 1:
+            result.append((lo, hi, rows))
+            continue
+        result.extend((d_lo, d_hi, d_rows) for (d_lo, d_hi), d_rows
+            in zip(days, getter.count_readings(mtr_row, days, my_cursor)))
+    return result
+
+def make_pieces(mtr_row, slices, start_op, piece_rows):
+    """
+    Gather the consecutive (start, end, rows) SLICES of the meter described
+    in MTR_ROW into Pieces of at most PIECE_ROWS rows, unless a slice alone
+    holds more. The first piece starts with START_OP.
+    """
+    pieces = []
+    lo = None
+    rows = 0
+    for s_lo, s_hi, s_rows in slices:
+        if lo is not None and rows + s_rows > piece_rows:
+            pieces.append(Piece(mtr_row, len(pieces), lo, s_lo,
+                start_op if not pieces else ">=", rows))
+            lo = None
+        if lo is None:
+            lo, rows = s_lo, 0
+        rows += s_rows
+        hi = s_hi
+    if lo is not None:
+        pieces.append(Piece(mtr_row, len(pieces), lo, hi,
+            start_op if not pieces else ">=", rows))
+    return pieces
+
+def plan_meter(getter, plans, mtr_row, my_cursor, marks=None, seeds=None,
+        window=None, catalog=None, fmt="csv", piece_rows=None):
+    """
+    Describe the meter described in MTR_ROW with GETTER's plan_extract() and
+    split its range into Pieces of about PIECE_ROWS rows. The plan, (plan,
+    pieces), is stored in PLANS under the meter's mark key. The other
+    arguments are as in the getters' extract(). Returns 0 if successful, 1
+    otherwise.
+    """
+    plan = getter.plan_extract(mtr_row, my_cursor, marks, seeds, window,
+        catalog, fmt)
+    if not plan:
+        return 1
+    start, end, start_op = plan[1][0][0], plan[1][-1][1], plan[1][0][2]
+    try:
+        with util.Stage("plan", getter.mark_key(mtr_row)) as stage:
+            slices = count_slices(getter, mtr_row, start, end, piece_rows,
+                my_cursor)
+            pieces = make_pieces(mtr_row, slices, start_op, piece_rows)
+            stage.count(sum(piece.rows for piece in pieces))
+    except ValueError, range_err:
+        print(range_err)
+        util.tryNext()
+        return 1
+    print("Source ID %s: about %d readings in %d pieces.\n"
+        % (mtr_row[0], sum(piece.rows for piece in pieces), len(pieces)))
+    with _plans_lock:
+        plans[getter.mark_key(mtr_row)] = (plan, pieces)
+    return 0
+
+def extract_piece(getter, plans, piece, my_cursor, window=None, fmt="csv"):
+    """
+    Extract PIECE, one of the Pieces in PLANS, with GETTER on cursor
+    MY_CURSOR into a body file in format FMT, querying its readings one
+    WINDOW-long window at a time. Returns 0 if successful, 1 otherwise.
+    """
+    key = getter.mark_key(piece.mtr_row)
+    output_path = plans[key][0][2]
+    print("Extracting piece %d of Source ID %s from '%s' to '%s' ..."
+        % (piece.index + 1, piece.mtr_row[0], piece.start, piece.end))
+    try:
+        windows = util.split_windows(piece.start, piece.end, window,
+            piece.start_op)
+    except ValueError, window_err:
+        print(window_err)
+        return 1
+    with datafile.BodyWriter(datafile.body_path(output_path, piece.index),
+            fmt) as writer:
+        piece.complete, piece.last = datafile.write_readings(writer,
+            my_cursor, windows, getter.readings_query(piece.mtr_row,
+            my_cursor), piece.tracker, key)
+    return 0 if piece.complete else 1
+
+def stitch(getter, plan, pieces, marks=None):
+    """
+    Join the body files of the extracted PIECES of a meter, whose plan
+    (METER_INFO, WINDOWS, OUTPUT_PATH) is PLAN, into its data file with
+    GETTER's finish_extract() (MARKS as there). Returns 0 if successful, 1
+    otherwise; the piece files are removed either way.
+    """
+    meter_info, windows, output_path = plan
+    mtr_row = pieces[0].mtr_row
+    paths = [datafile.body_path(output_path, piece.index) for piece in pieces]
+    print("Processing Source ID: %s" % (mtr_row[0]))
+    if not all(piece.complete for piece in pieces):
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+        print("Not all pieces could be extracted.")
+        util.tryNext()
+        return 1
+    tracker = pieces[0].tracker
+    last = pieces[0].last
+    for piece in pieces[1:]:
+        tracker.merge(piece.tracker)
+        last = piece.last or last
+    # Pieces are written in time order, and gzip members and binary blocks
+    # can simply be concatenated.
+    with open(datafile.body_path(output_path), "wb") as body:
+        for path in paths:
+            with open(path, "rb") as piece_body:
+                shutil.copyfileobj(piece_body, body)
+            os.remove(path)
+    return getter.finish_extract(mtr_row, meter_info, output_path, True, last,
+        tracker, marks)
+
+def extract_split(getter, meter_list, pool, workers, piece_rows, marks=None,
+        seeds=None, window=None, catalog=None, fmt="csv"):
+    """
+    Extract the meters in METER_LIST with GETTER (a getter script module),
+    split into pieces of about PIECE_ROWS readings that WORKERS threads
+    extract longest first, each over a connection from connection queue POOL
+    (see util.run_parallel()). The other arguments are as in the getters'
+    extract(). Returns the number of meters that failed. A meter listed
+    more than once is extracted once.
+    """
+    plans = {}
+    unique = collections.OrderedDict()
+    for mtr_row in meter_list:
+        if getter.mark_key(mtr_row) in unique:
+            print("Source ID %s is listed twice; extracted once.\n"
+                % (mtr_row[0]))
+            continue
+        unique[getter.mark_key(mtr_row)] = mtr_row
+    meter_list = unique.values()
+    print("Planning the extraction of %d meters ...\n" % (len(meter_list)))
+    err_count = util.run_parallel(functools.partial(plan_meter, getter,
+        plans, marks=marks, seeds=seeds, window=window, catalog=catalog,
+        fmt=fmt, piece_rows=piece_rows), meter_list, pool, workers)
+
+    pieces = [piece for plan, meter_pieces in plans.values()
+        for piece in meter_pieces]
+    # Longest first; ties in the order the meters are listed.
+    order = dict((getter.mark_key(row), i) for i, row
+        in enumerate(meter_list))
+    pieces.sort(key=lambda piece: (-piece.rows,
+        order[getter.mark_key(piece.mtr_row)], piece.index))
+    print("Extracting %d pieces with %d workers ...\n"
+        % (len(pieces), workers))
+    util.run_parallel(functools.partial(extract_piece, getter, plans,
+        window=window, fmt=fmt), pieces, pool, workers)
+
+    print("Joining pieces ...\n")
+    for mtr_row in meter_list:
+        key = getter.mark_key(mtr_row)
+        if key in plans:
+            plan, meter_pieces = plans.pop(key)
+            err_count += stitch(getter, plan, meter_pieces, marks)
+    return err_count